@@ -0,0 +1,192 @@
+"""What running lesson timers of Secret Insights cost the server, with many learners at the same time.
+
+Start the app, then point this at it:
+
+    streamlit run streamlit_app.py --server.headless true
+    python benchmark_threads.py --learners 50 --hold 30 --pid <pid of streamlit>
+
+Every learner is a real browser session on the app's websocket, all of them at the same time: log in with the secret
+account, open Secret Insights and start an auto-advancing lesson. From then on the learner does what the browser
+does for a `run_every` fragment: ask the server to rerun the fragment every time the interval of its auto-rerun
+message has passed. Reported are the time of the script runs, the latency of the fragment ticks (and how many of
+them took longer than the interval, i.e. a timer that falls behind), and with --pid the threads and the CPU time
+of the server over the hold period.
+"""
+import argparse
+import asyncio
+import os
+import statistics
+import time
+from tornado.websocket import websocket_connect
+from streamlit.proto.BackMsg_pb2 import BackMsg
+from streamlit.proto.ClientState_pb2 import ClientState
+from streamlit.proto.ForwardMsg_pb2 import ForwardMsg
+from streamlit.proto.WidgetStates_pb2 import WidgetState
+
+
+def percentile(values, p):
+    ordered = sorted(values)
+    return ordered[min(int(len(ordered) * p / 100), len(ordered) - 1)]
+
+
+def summary(values):
+    if not values:
+        return "-"
+    return (f"p50 {percentile(values, 50) * 1000:.1f} ms  p99 {percentile(values, 99) * 1000:.1f} ms  "
+            f"max {max(values) * 1000:.1f} ms")
+
+
+def server_usage(pid):
+    """Threads and CPU seconds (user + system) of the server process."""
+    with open(f"/proc/{pid}/stat") as f:
+        fields = f.read().rsplit(")", 1)[1].split()
+    return int(fields[17]), (int(fields[11]) + int(fields[12])) / os.sysconf("SC_CLK_TCK")
+
+
+class Session:
+    """One browser tab: keeps the widget states like the frontend does and sends them with every rerun."""
+
+    def __init__(self, url, timeout):
+        self.url = url
+        self.timeout = timeout
+        # (element type, label) -> element proto of the last run
+        self.elements = {}
+        self.states = {}
+        self.page_script_hash = ""
+        # fragment id -> interval of its run_every
+        self.auto_reruns = {}
+
+    async def connect(self):
+        self.ws = await websocket_connect(self.url, subprotocols=["streamlit"], max_message_size=64 * 1024 * 1024)
+
+    def set(self, kind, label, **value):
+        element = self.elements[(kind, label)]
+        state = WidgetState(id=element.id, **value)
+        if "trigger_value" not in value:
+            # triggers (buttons) only count for the run they are sent with
+            self.states[element.id] = state
+        return state
+
+    async def rerun(self, *triggers, fragment_id=None):
+        """Send a rerun with the current widget states and wait for it to finish; returns the seconds it took."""
+        client_state = ClientState(query_string="", page_script_hash=self.page_script_hash)
+        client_state.widget_states.widgets.extend(list(self.states.values()) + list(triggers))
+        if fragment_id is not None:
+            client_state.fragment_id = fragment_id
+            if "is_auto_rerun" in ClientState.DESCRIPTOR.fields_by_name:
+                client_state.is_auto_rerun = True
+        message = BackMsg()
+        message.rerun_script.CopyFrom(client_state)
+
+        start = time.perf_counter()
+        await self.ws.write_message(message.SerializeToString(), binary=True)
+        await asyncio.wait_for(self.receive_until_finished(), self.timeout)
+        return time.perf_counter() - start
+
+    async def receive_until_finished(self):
+        while True:
+            data = await self.ws.read_message()
+            if data is None:
+                raise ConnectionError("the server closed the session")
+            message = ForwardMsg()
+            message.ParseFromString(data)
+            kind = message.WhichOneof("type")
+            if kind == "new_session":
+                self.page_script_hash = getattr(message.new_session, "page_script_hash", "")
+            elif kind == "delta" and message.delta.WhichOneof("type") == "new_element":
+                element = message.delta.new_element
+                widget = getattr(element, element.WhichOneof("type") or "", None)
+                if widget is not None and hasattr(widget, "id") and hasattr(widget, "label"):
+                    self.elements[(element.WhichOneof("type"), widget.label)] = widget
+            elif kind == "auto_rerun":
+                self.auto_reruns[message.auto_rerun.fragment_id] = message.auto_rerun.interval
+            elif kind == "script_finished":
+                # a st.rerun() ends the run early and the server starts the next one by itself
+                if message.script_finished != ForwardMsg.FINISHED_EARLY_FOR_RERUN:
+                    return
+
+    async def start_lesson(self, duration):
+        """Log in, open Secret Insights and start an auto-advancing lesson; the seconds of those script runs."""
+        runs = [await self.rerun()]
+        self.set("text_input", "Username", string_value="secret")
+        self.set("text_input", "Password", string_value="secret123")
+        runs.append(await self.rerun(self.set("button", "Login", trigger_value=True)))
+
+        navigation = self.elements[("radio", "Go to:")]
+        self.set("radio", "Go to:", int_value=list(navigation.options).index("🔍 Secret Insights"))
+        runs.append(await self.rerun())
+        self.set("number_input", "Lesson Duration (seconds)", int_value=duration)
+        self.set("checkbox", "Auto Advance Lesson", bool_value=True)
+        runs.append(await self.rerun())
+        if not self.auto_reruns:
+            raise RuntimeError("the lesson timer did not ask for auto reruns")
+        return runs
+
+    async def tick(self, until, ticks, late):
+        """Rerun the fragments like the browser does, until the hold period is over."""
+        fragment_id, interval = next(iter(self.auto_reruns.items()))
+        next_tick = time.perf_counter() + interval
+        while next_tick < until:
+            await asyncio.sleep(max(next_tick - time.perf_counter(), 0))
+            elapsed = await self.rerun(fragment_id=fragment_id)
+            ticks.append(elapsed)
+            if elapsed > interval:
+                late.append(elapsed)
+            next_tick += interval
+
+    def close(self):
+        self.ws.close()
+
+
+async def main(args):
+    usage_before = server_usage(args.pid) if args.pid else None
+    sessions = [Session(args.url, args.timeout) for _ in range(args.learners)]
+    await asyncio.gather(*(s.connect() for s in sessions))
+
+    start = time.perf_counter()
+    starts = await asyncio.gather(*(s.start_lesson(args.duration) for s in sessions), return_exceptions=True)
+    errors = [r for r in starts if isinstance(r, BaseException)]
+    runs = [run for r in starts if not isinstance(r, BaseException) for run in r]
+    print(f"learners:            {args.learners} ({len(errors)} failed to start"
+          f"{': ' + repr(errors[0]) if errors else ''})")
+    print(f"starting, all:       {time.perf_counter() - start:.1f} s")
+    print(f"script runs:         {summary(runs)}")
+
+    running = [s for s, r in zip(sessions, starts) if not isinstance(r, BaseException)]
+    ticks, late = [], []
+    peak_threads = 0
+    hold_start = time.perf_counter()
+    until = hold_start + args.hold
+    tickers = asyncio.gather(*(s.tick(until, ticks, late) for s in running), return_exceptions=True)
+    usage_start = server_usage(args.pid) if args.pid else None
+    while not tickers.done():
+        if args.pid:
+            peak_threads = max(peak_threads, server_usage(args.pid)[0])
+        await asyncio.wait([tickers], timeout=0.5)
+    tick_errors = [r for r in tickers.result() if isinstance(r, BaseException)]
+    hold = time.perf_counter() - hold_start
+
+    print(f"fragment ticks:      {len(ticks)} in {hold:.1f} s ({len(ticks) / hold:.1f}/s, "
+          f"{len(tick_errors)} sessions failed)")
+    print(f"tick latency:        {summary(ticks)}")
+    print(f"ticks over interval: {len(late)}")
+    if args.pid:
+        threads_after, cpu_after = server_usage(args.pid)
+        print(f"server threads:      {usage_before[0]} before / {peak_threads} peak / {threads_after} after")
+        print(f"server cpu:          {cpu_after - usage_start[1]:.2f} s over the hold "
+              f"({(cpu_after - usage_start[1]) / hold * 100:.0f}% of a core)")
+    if ticks:
+        print(f"tick, mean:          {statistics.mean(ticks) * 1000:.1f} ms")
+    for s in sessions:
+        s.close()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Concurrent learners with a running lesson timer")
+    parser.add_argument("--url", default="ws://127.0.0.1:8501/_stcore/stream")
+    parser.add_argument("--learners", type=int, default=50)
+    parser.add_argument("--duration", type=int, default=600, help="lesson duration in seconds")
+    parser.add_argument("--hold", type=float, default=30, help="seconds to keep all the timers running")
+    parser.add_argument("--timeout", type=float, default=30, help="max seconds one script run may take")
+    parser.add_argument("--pid", type=int, help="pid of the streamlit server, to read its threads and cpu time")
+    asyncio.run(main(parser.parse_args()))
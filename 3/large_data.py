@@ -0,0 +1,157 @@
+import numpy as np
+import pandas as pd
+
+# Helpers for the uploaded CSV/Parquet files: reading them in chunks under a memory cap, and downsampling the
+# series to a few thousand points before they are charted (the browser never gets millions of points)
+
+CHUNK_ROWS = 250_000
+
+
+def _numeric(chunk):
+    """Keep the numeric columns only, as small as they fit (float32, smallest int type)."""
+    chunk = chunk.select_dtypes(include="number")
+    for column in chunk.columns:
+        if pd.api.types.is_float_dtype(chunk[column]):
+            chunk[column] = chunk[column].astype(np.float32)
+        else:
+            chunk[column] = pd.to_numeric(chunk[column], downcast="integer")
+    return chunk
+
+
+def _chunks(file, name, chunk_rows):
+    if name.lower().endswith(".parquet"):
+        try:
+            import pyarrow.parquet as pq
+        except ImportError:
+            raise ValueError("reading Parquet files needs pyarrow (pip install pyarrow)")
+        for batch in pq.ParquetFile(file).iter_batches(batch_size=chunk_rows):
+            yield batch.to_pandas()
+    else:
+        yield from pd.read_csv(file, chunksize=chunk_rows)
+
+
+def read_table(file, name, memory_cap, chunk_rows=CHUNK_ROWS):
+    """Read a CSV or Parquet file chunk by chunk, keeping its numeric columns until memory_cap bytes are used.
+
+    Returns the frame and a dict with the number of rows, the memory used and whether the file was cut off.
+    """
+    chunks, used, truncated = [], 0, False
+    for chunk in _chunks(file, name, chunk_rows):
+        chunk = _numeric(chunk)
+        size = int(chunk.memory_usage(index=False).sum())
+        if used + size > memory_cap:
+            # take what still fits of this chunk and stop reading
+            rows = int(len(chunk) * (memory_cap - used) / size) if size else 0
+            chunks.append(chunk.iloc[:rows])
+            used += int(chunks[-1].memory_usage(index=False).sum())
+            truncated = True
+            break
+        chunks.append(chunk)
+        used += size
+
+    data = pd.concat(chunks, ignore_index=True) if chunks else pd.DataFrame()
+    if data.shape[1] == 0:
+        raise ValueError(f"{name} has no numeric columns to chart")
+    return data, {"rows": len(data), "columns": data.shape[1], "memory_mb": round(used / 2 ** 20, 1),
+                  "truncated": truncated}
+
+
+def _selectable(y):
+    # NaNs would break the argmin/argmax; they get the mean, only for picking the points
+    y = np.asarray(y, dtype=np.float64)
+    if np.isnan(y).any():
+        y = np.where(np.isnan(y), np.nanmean(y) if not np.isnan(y).all() else 0, y)
+    return y
+
+
+def lttb_indices(y, n_out):
+    """Largest-Triangle-Three-Buckets: the indices of n_out points that keep the shape of the line."""
+    n = len(y)
+    if n_out >= n or n_out < 3:
+        return np.arange(n)
+    y = _selectable(y)
+    x = np.arange(n, dtype=np.float64)
+
+    # first and last point are always kept, the rest is split into n_out - 2 buckets
+    edges = np.linspace(1, n - 1, n_out - 1).astype(np.int64)
+    indices = np.empty(n_out, dtype=np.int64)
+    indices[0], indices[-1] = 0, n - 1
+    a = 0
+    for i in range(n_out - 2):
+        start, end = edges[i], edges[i + 1]
+        next_end = edges[i + 2] if i + 2 < len(edges) else n
+        avg_x, avg_y = x[end:next_end].mean(), y[end:next_end].mean()
+        # the point of this bucket that makes the largest triangle with the last picked point and the average of
+        # the next bucket
+        area = np.abs((x[a] - avg_x) * (y[start:end] - y[a]) - (x[a] - x[start:end]) * (avg_y - y[a]))
+        a = start + int(np.argmax(area))
+        indices[i + 1] = a
+    return indices
+
+
+def minmax_indices(y, n_out):
+    """The min and the max of n_out / 2 equal buckets; cheaper than LTTB and keeps every spike."""
+    n = len(y)
+    buckets = n_out // 2
+    if n_out >= n or buckets < 1:
+        return np.arange(n)
+    y = _selectable(y)
+
+    size = n // buckets
+    body = y[:size * buckets].reshape(buckets, size)
+    offsets = np.arange(buckets) * size
+    picked = [offsets + body.argmin(axis=1), offsets + body.argmax(axis=1), [0, n - 1]]
+    if size * buckets < n:
+        tail = y[size * buckets:]
+        picked.append([size * buckets + tail.argmin(), size * buckets + tail.argmax()])
+    return np.unique(np.concatenate(picked))
+
+
+def downsample(data, columns, n_points, method="lttb"):
+    """The rows of data that are needed to draw the columns with about n_points points.
+
+    Every column picks its own points (n_points / number of columns each) and the rows of all of them are kept,
+    so the lines can still share the index.
+    """
+    if len(data) <= n_points:
+        return data[columns]
+    pick = lttb_indices if method == "lttb" else minmax_indices
+    per_column = max(n_points // max(len(columns), 1), 4)
+    rows = np.unique(np.concatenate([pick(data[column].to_numpy(), per_column) for column in columns]))
+    return data[columns].iloc[rows]
+
+
+def grid_sample_indices(x, y, n_out):
+    """One point per cell of a grid with about n_out cells: a scatter plot that still shows the spread and the
+    outliers, without the millions of points on top of each other."""
+    x, y = np.asarray(x, dtype=np.float64), np.asarray(y, dtype=np.float64)
+    valid = np.flatnonzero(~(np.isnan(x) | np.isnan(y)))
+    if len(valid) <= n_out:
+        return valid
+    side = max(int(np.sqrt(n_out)), 1)
+
+    def cell(values):
+        low, high = values.min(), values.max()
+        return ((values - low) / ((high - low) or 1) * (side - 1)).astype(np.int64)
+
+    cells = cell(x[valid]) * side + cell(y[valid])
+    # any point of a cell will do; writing them all and keeping whichever landed is much faster than np.unique
+    picked = np.full(side * side, -1, dtype=np.int64)
+    picked[cells] = valid
+    return np.sort(picked[picked >= 0])
+
+
+if __name__ == "__main__":
+    # the time to downsample grows with the file, the number of points that go to the browser doesn't
+    import time
+
+    for n in (10_000, 1_000_000, 10_000_000):
+        frame = pd.DataFrame({"A": np.cumsum(np.random.randn(n)).astype(np.float32),
+                              "B": np.random.randn(n).astype(np.float32)})
+        for method in ("lttb", "minmax"):
+            start = time.perf_counter()
+            points = downsample(frame, ["A", "B"], 2000, method)
+            print(f"{n:>10} rows, {method:6}: {len(points)} points in {(time.perf_counter() - start) * 1000:.1f} ms")
+        start = time.perf_counter()
+        points = grid_sample_indices(frame["A"], frame["B"], 2000)
+        print(f"{n:>10} rows, grid  : {len(points)} points in {(time.perf_counter() - start) * 1000:.1f} ms")
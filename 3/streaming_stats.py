@@ -0,0 +1,165 @@
+import numpy as np
+import pandas as pd
+
+# describe() for data that doesn't have to fit in memory: one pass over chunks of a column, with a fixed amount of
+# memory per column (count, mean, variance, min/max and a small sketch for the quantiles)
+
+CHUNK_ROWS = 1_000_000
+
+
+class QuantileSketch:
+    """Approximate quantiles in bounded memory (a simplified KLL sketch).
+
+    Values go into level 0; a level that holds more than `size` values is sorted and every other value moves one
+    level up, where it counts twice. Memory stays around size * log2(n / size) values, the rank error around 1%.
+    """
+
+    def __init__(self, size=2048, seed=0):
+        self.size = size
+        self.levels = [np.empty(0)]
+        self.rng = np.random.default_rng(seed)
+
+    def update(self, values):
+        self.levels[0] = np.concatenate([self.levels[0], values])
+        level = 0
+        while level < len(self.levels):
+            if len(self.levels[level]) > self.size:
+                if level + 1 == len(self.levels):
+                    self.levels.append(np.empty(0))
+                items = np.sort(self.levels[level])
+                # an odd one out stays here, the others are halved; a random offset keeps it unbiased
+                keep = items[len(items) - len(items) % 2:]
+                promoted = items[self.rng.integers(2):len(items) - len(items) % 2:2]
+                self.levels[level] = keep
+                self.levels[level + 1] = np.concatenate([self.levels[level + 1], promoted])
+            level += 1
+
+    def quantiles(self, qs):
+        values = np.concatenate(self.levels)
+        if not len(values):
+            return [np.nan] * len(qs)
+        weights = np.concatenate([np.full(len(items), 2.0 ** level) for level, items in enumerate(self.levels)])
+        order = np.argsort(values)
+        cumulative = np.cumsum(weights[order])
+        ranks = np.asarray(qs) * cumulative[-1]
+        return values[order][np.minimum(np.searchsorted(cumulative, ranks), len(values) - 1)].tolist()
+
+
+class ColumnStats:
+    """Running count/mean/variance (chunk-wise Welford, so it stays exact), min, max and quantiles of one column."""
+
+    def __init__(self, sketch_size=2048):
+        self.count = 0
+        self.mean = 0.0
+        self.m2 = 0.0
+        self.min = np.inf
+        self.max = -np.inf
+        self.sketch = QuantileSketch(sketch_size)
+
+    def update(self, values):
+        values = np.asarray(values, dtype=np.float64)
+        values = values[~np.isnan(values)]
+        n = len(values)
+        if not n:
+            return
+        mean = values.mean()
+        m2 = ((values - mean) ** 2).sum()
+        # merge the statistics of the chunk into the running ones
+        total = self.count + n
+        delta = mean - self.mean
+        self.mean += delta * n / total
+        self.m2 += m2 + delta ** 2 * self.count * n / total
+        self.count = total
+        self.min = min(self.min, values.min())
+        self.max = max(self.max, values.max())
+        self.sketch.update(values)
+
+    def describe(self):
+        q25, q50, q75 = self.sketch.quantiles([0.25, 0.5, 0.75])
+        empty = self.count == 0
+        return {
+            "count": float(self.count),
+            "mean": np.nan if empty else self.mean,
+            "std": np.sqrt(self.m2 / (self.count - 1)) if self.count > 1 else np.nan,
+            "min": np.nan if empty else self.min,
+            "25%": q25,
+            "50%": q50,
+            "75%": q75,
+            "max": np.nan if empty else self.max,
+        }
+
+
+def frame_chunks(data, columns, chunk_rows=CHUNK_ROWS):
+    """Chunks of an in-memory frame; the slices are views, nothing is copied."""
+    arrays = {column: data[column].to_numpy() for column in columns}
+    for start in range(0, len(data), chunk_rows):
+        yield {column: values[start:start + chunk_rows] for column, values in arrays.items()}
+
+
+def npy_chunks(paths, columns, chunk_rows=CHUNK_ROWS):
+    """Chunks of columns stored as .npy files ({column: path}); memory-mapped, so only one chunk is read at a time."""
+    arrays = {column: np.load(paths[column], mmap_mode="r") for column in columns}
+    length = min(len(values) for values in arrays.values())
+    for start in range(0, length, chunk_rows):
+        yield {column: np.asarray(values[start:start + chunk_rows]) for column, values in arrays.items()}
+
+
+def csv_chunks(path, columns, chunk_rows=CHUNK_ROWS):
+    """Chunks of a CSV file, reading only the columns that are asked for."""
+    for chunk in pd.read_csv(path, usecols=list(columns), chunksize=chunk_rows):
+        yield {column: chunk[column].to_numpy() for column in columns}
+
+
+class StatsEngine:
+    """describe() with the results cached per column: selecting one more column only reads that column.
+
+    `chunks(columns)` returns the chunks ({column: array}) of the given columns, e.g.
+    `lambda columns: frame_chunks(data, columns)`.
+    """
+
+    def __init__(self, chunks, sketch_size=2048):
+        self.chunks = chunks
+        self.sketch_size = sketch_size
+        self.results = {}
+
+    def describe(self, columns):
+        missing = [column for column in columns if column not in self.results]
+        if missing:
+            # one pass for all the missing columns
+            stats = {column: ColumnStats(self.sketch_size) for column in missing}
+            for chunk in self.chunks(missing):
+                for column in missing:
+                    stats[column].update(chunk[column])
+            for column in missing:
+                self.results[column] = stats[column].describe()
+        return pd.DataFrame({column: self.results[column] for column in columns})
+
+
+if __name__ == "__main__":
+    # compare with describe(): time and peak memory for the first columns, and for adding one more column
+    import time
+    import tracemalloc
+
+    n = 10_000_000
+    rng = np.random.default_rng(0)
+    data = pd.DataFrame({"A": rng.standard_normal(n), "B": rng.exponential(size=n),
+                         "C": rng.integers(0, 1000, n).astype(np.float64), "D": rng.uniform(size=n)})
+
+    def measure(label, func):
+        tracemalloc.start()
+        start = time.perf_counter()
+        result = func()
+        elapsed = time.perf_counter() - start
+        peak = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+        print(f"{label:32} {elapsed * 1000:8.1f} ms  peak {peak / 2 ** 20:7.1f} MB")
+        return result
+
+    engine = StatsEngine(lambda columns: frame_chunks(data, columns))
+    exact = measure("describe() A, B", lambda: data[["A", "B"]].describe())
+    approx = measure("engine A, B", lambda: engine.describe(["A", "B"]))
+    measure("describe() A, B, C", lambda: data[["A", "B", "C"]].describe())
+    measure("engine A, B, C (only C)", lambda: engine.describe(["A", "B", "C"]))
+    measure("engine A, B (cached)", lambda: engine.describe(["A", "B"]))
+    print("\nlargest difference with describe():")
+    print((approx - exact).abs().max(axis=1).to_string())
@@ -3,7 +3,11 @@ import pandas as pd
 import numpy as np
 import matplotlib.pyplot as plt
 import time
+import io
+import os
 from PIL import Image
+from large_data import read_table, downsample, grid_sample_indices
+from streaming_stats import StatsEngine, frame_chunks
 import plotly.express as px
 from datetime import datetime
 
@@ -12,6 +16,18 @@ if 'logged_in' not in st.session_state:
     st.session_state.logged_in = False
 if 'secret_mode' not in st.session_state:
     st.session_state.secret_mode = False
+# seed of the sample data; the same seed gives everyone the same (cached) data until "New sample data" is clicked
+if 'data_seed' not in st.session_state:
+    st.session_state.data_seed = 0
+# how long every section took to render, per section: runs, total and last time in ms
+if 'section_timings' not in st.session_state:
+    st.session_state.section_timings = {}
+# uploaded CSV/Parquet files: name -> {"file_id", "data", "info", "stats"}
+if 'datasets' not in st.session_state:
+    st.session_state.datasets = {}
+# file ids of uploads that were removed with their Remove button, so they aren't read again while still in the uploader
+if 'removed_uploads' not in st.session_state:
+    st.session_state.removed_uploads = set()
 
 # Configure page
 st.set_page_config(
@@ -21,9 +37,155 @@ st.set_page_config(
     initial_sidebar_state="expanded"
 )
 
+# ---------------------
+# Cached Images & Data
+# ---------------------
+# Streamlit reruns the whole script on every widget change, so anything expensive is computed once here and
+# shared between all users and reruns instead
+IMAGE_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "premium_photo-1694819488591-a43907d1c5cc.jpeg")
+IMAGE_SIZES = {"medium": (500, 600)}
+
+
+@st.cache_resource
+def image_variants(path):
+    """Decode the image once and keep a ready-to-send JPEG for every size in IMAGE_SIZES."""
+    variants = {}
+    with Image.open(path) as image:
+        image = image.convert("RGB")
+        for name, size in IMAGE_SIZES.items():
+            buffer = io.BytesIO()
+            image.resize(size).save(buffer, format="JPEG", quality=85)
+            variants[name] = buffer.getvalue()
+    return variants
+
+
+@st.cache_data(max_entries=20)
+def sales_data(seed):
+    rng = np.random.default_rng(seed)
+    return pd.DataFrame({
+        'Date': pd.date_range(start='2024-01-01', periods=30, freq='D'),
+        'Sales': rng.integers(100, 1000, size=30),
+        'Traffic': rng.integers(500, 2000, size=30)
+    })
+
+
+@st.cache_data(max_entries=20)
+def random_data(rows, columns, seed):
+    rng = np.random.default_rng(seed)
+    return pd.DataFrame(rng.standard_normal((rows, len(columns))), columns=list(columns))
+
+
+@st.cache_data(max_entries=100)
+def summary(columns, seed):
+    """describe() of the selected columns of the advanced features data."""
+    return random_data(100, ('A', 'B', 'C', 'D'), seed)[list(columns)].describe()
+
+
+# resize the image variants right at startup, so the first visitor of Layout & Media doesn't wait for them
+image_variants(IMAGE_PATH)
+
+
+# ---------------------
+# Uploaded Datasets
+# ---------------------
+# memory the parsed uploads of one session may use (numeric columns only), and the number of points a chart gets;
+# the rest of the rows is downsampled away before anything goes to the browser
+UPLOAD_MEMORY_CAP_MB = 500
+CHART_POINTS = 2000
+
+
+def load_uploads(files):
+    """Parse the uploaded CSV/Parquet files (once per upload) and list them with a button to remove them.
+
+    Only adds: the uploader is empty again whenever the user comes back from another section, so a file that is
+    not in it anymore stays until its Remove button is clicked.
+    """
+    datasets = st.session_state.datasets
+    for file in files:
+        if not file.name.lower().endswith((".csv", ".parquet")) or file.file_id in st.session_state.removed_uploads:
+            continue
+        if file.name in datasets and datasets[file.name]["file_id"] == file.file_id:
+            continue
+        used = sum(d["info"]["memory_mb"] for name, d in datasets.items() if name != file.name)
+        memory_cap = max(UPLOAD_MEMORY_CAP_MB - used, 0) * 2 ** 20
+        with st.spinner(f"Reading {file.name}..."):
+            try:
+                data, info = read_table(file, file.name, memory_cap)
+            except Exception as e:
+                st.error(f"Could not read {file.name}: {e}")
+                continue
+        # the summary statistics are computed in chunks and kept per column, see streaming_stats.py
+        stats = StatsEngine(lambda columns, data=data: frame_chunks(data, columns))
+        datasets[file.name] = {"file_id": file.file_id, "data": data, "info": info, "stats": stats}
+
+    for name, dataset in list(datasets.items()):
+        info = dataset["info"]
+        text_col, button_col = st.columns([4, 1])
+        text_col.write(f"📄 {name}: {info['rows']:,} rows, {info['columns']} numeric columns, {info['memory_mb']} MB")
+        if button_col.button("Remove", key=f"remove-{name}"):
+            st.session_state.removed_uploads.add(dataset["file_id"])
+            del datasets[name]
+            st.rerun()
+        if info["truncated"]:
+            st.warning(f"Only the first {info['rows']:,} rows of {name} fit in the {UPLOAD_MEMORY_CAP_MB} MB limit.")
+
+
+def choose_dataset(label):
+    """Pick the sample data or one of the uploaded files; returns the dataset dict, None for the sample data."""
+    names = list(st.session_state.datasets)
+    if not names:
+        return None
+    choice = st.selectbox(label, ["Sample data"] + names)
+    return st.session_state.datasets.get(choice)
+
+
+# the arguments starting with _ are not hashed by Streamlit; file_id identifies the upload instead
+@st.cache_data(max_entries=64)
+def chart_points(file_id, columns, n_points, method, _data):
+    return downsample(_data, list(columns), n_points, method)
+
+
+@st.cache_data(max_entries=64)
+def scatter_points(file_id, x, y, n_points, _data):
+    return _data[[x, y]].iloc[grid_sample_indices(_data[x].to_numpy(), _data[y].to_numpy(), n_points)]
+
+
+def show_large_chart(dataset, chart_type):
+    data = dataset["data"]
+    columns = data.columns.tolist()
+    if chart_type == "Scatter Plot":
+        x = st.selectbox("X axis", columns)
+        y = st.selectbox("Y axis", columns, index=min(1, len(columns) - 1))
+        points = scatter_points(dataset["file_id"], x, y, CHART_POINTS, data)
+        st.plotly_chart(px.scatter(points, x=x, y=y, title=f"{y} vs {x}"))
+    else:
+        selected = st.multiselect("Columns", columns, default=columns[:2])
+        if not selected:
+            return
+        method = st.radio("Downsampling", ["lttb", "minmax"], horizontal=True,
+                          help="LTTB keeps the shape of the line, min/max keeps every spike and is faster")
+        points = chart_points(dataset["file_id"], tuple(selected), CHART_POINTS, method, data)
+        {"Line Chart": st.line_chart, "Bar Chart": st.bar_chart, "Area Chart": st.area_chart}[chart_type](points)
+    st.caption(f"{len(points):,} of {len(data):,} rows drawn")
+
+
+def new_data_button():
+    if st.button("🎲 New sample data"):
+        st.session_state.data_seed += 1
+
 # ---------------------
 # Secret Insights (Unlocked Content)
 # ---------------------
+@st.fragment(run_every=1)
+def lesson_timer(lesson_duration):
+    # only this fragment reruns every second; the deadline is kept in session_state, so no script thread
+    # has to sleep (and stay busy) for the whole lesson
+    elapsed = time.time() - st.session_state.lesson_started_at
+    st.progress(min(elapsed / lesson_duration, 1.0), text=f"{max(lesson_duration - elapsed, 0):.0f}s left")
+    if elapsed >= lesson_duration:
+        st.success("Time's up for this lesson!")
+
+
 def show_secret_insights():
     st.header("🔍 Secret Insights")
     st.info("Congratulations! You've unlocked secret insights to further deepen your learning experience.")
@@ -84,13 +246,14 @@ def show_secret_insights():
         if answer:
             st.write(f"Great choice: {answer}!")
     
-    # If auto-advance is enabled, show a countdown timer for the lesson
+    # If auto-advance is enabled, show a countdown timer for the lesson; it starts again for every new lesson
     if auto_advance:
-        progress_bar = st.progress(0)
-        for i in range(lesson_duration):
-            progress_bar.progress((i + 1) / lesson_duration)
-            time.sleep(1)
-        st.success("Time's up for this lesson!")
+        if st.session_state.get('timed_lesson') != st.session_state.current_lesson:
+            st.session_state.timed_lesson = st.session_state.current_lesson
+            st.session_state.lesson_started_at = time.time()
+        lesson_timer(lesson_duration)
+    elif 'timed_lesson' in st.session_state:
+        del st.session_state.timed_lesson
     
     # Button to go to the next lesson (manual or after auto-advance)
     if st.button("Next Lesson"):
@@ -216,20 +379,22 @@ def show_home():
 def show_visualization():
     st.header("📊 Data Visualization")
     
-    # Generate sample data
-    dates = pd.date_range(start='2024-01-01', periods=30, freq='D')
-    data = pd.DataFrame({
-        'Date': dates,
-        'Sales': np.random.randint(100, 1000, size=30),
-        'Traffic': np.random.randint(500, 2000, size=30)
-    })
-    
     # Interactive chart selection
+    dataset = choose_dataset("Select Dataset")
     chart_type = st.selectbox(
         "Select Chart Type",
         ["Line Chart", "Bar Chart", "Area Chart", "Scatter Plot"]
     )
     
+    # Uploaded files (see Interactive Widgets) are downsampled before they are charted
+    if dataset is not None:
+        show_large_chart(dataset, chart_type)
+        return
+    
+    # Sample data (cached, see sales_data)
+    new_data_button()
+    data = sales_data(st.session_state.data_seed)
+    
     if chart_type == "Line Chart":
         st.line_chart(data.set_index('Date'))
     elif chart_type == "Bar Chart":
@@ -260,10 +425,12 @@ def show_widgets():
         st.subheader("Advanced Inputs")
         color = st.color_picker("Pick a color")
         date = st.date_input("Select a date")
-        files = st.file_uploader("Upload files", accept_multiple_files=True)
+        files = st.file_uploader("Upload files", accept_multiple_files=True,
+                                 help="CSV and Parquet files can be charted in Data Visualization and Advanced Features")
         
         st.write(f"Selected color: {color}")
         st.write(f"Selected date: {date}")
+        load_uploads(files or [])
 
 def show_layout():
     st.header("📱 Layout & Media")
@@ -273,7 +440,7 @@ def show_layout():
     
     with tab1:
         st.write("Sample chart")
-        chart_data = pd.DataFrame(np.random.randn(20, 3), columns=['A', 'B', 'C'])
+        chart_data = random_data(20, ('A', 'B', 'C'), st.session_state.data_seed)
         st.line_chart(chart_data)
     
     with tab2:
@@ -293,15 +460,18 @@ def show_layout():
         col1, col2, col3 = st.columns([1, 2, 1])  # Adjust column width
 
         with col2:
-            image = Image.open("premium_photo-1694819488591-a43907d1c5cc.jpeg")
-            resized_image = image.resize((500, 600))
-            st.image(resized_image, caption="A cute dog")
+            st.image(image_variants(IMAGE_PATH)["medium"], caption="A cute dog")
 
 def show_advanced_features():
     st.header("🔧 Advanced Features")
     
     st.subheader("Interactive Data Analysis")
-    data = pd.DataFrame(np.random.randn(100, 4), columns=['A', 'B', 'C', 'D'])
+    dataset = choose_dataset("Select Dataset")
+    if dataset is None:
+        new_data_button()
+        data = random_data(100, ('A', 'B', 'C', 'D'), st.session_state.data_seed)
+    else:
+        data = dataset["data"]
     
     selected_columns = st.multiselect(
         "Select columns to analyze",
@@ -309,14 +479,57 @@ def show_advanced_features():
         default=data.columns[0:2].tolist()
     )
     
-    if selected_columns:
+    if selected_columns and dataset is None:
         st.line_chart(data[selected_columns])
         st.subheader("Statistical Summary")
-        st.write(data[selected_columns].describe())
+        st.write(summary(tuple(selected_columns), st.session_state.data_seed))
+    elif selected_columns:
+        columns = tuple(selected_columns)
+        st.line_chart(chart_points(dataset["file_id"], columns, CHART_POINTS, "minmax", data))
+        st.subheader("Statistical Summary")
+        # only the newly selected columns are computed; the quartiles are approximate (within about 1%)
+        st.write(dataset["stats"].describe(selected_columns))
+
+# ---------------------
+# Rerun Timings
+# ---------------------
+def render_timed(name, render):
+    """Render a section and keep track of how long that took."""
+    start = time.perf_counter()
+    render()
+    elapsed_ms = (time.perf_counter() - start) * 1000
+
+    timing = st.session_state.section_timings.setdefault(name, {"runs": 0, "total_ms": 0.0, "last_ms": 0.0})
+    timing["runs"] += 1
+    timing["total_ms"] += elapsed_ms
+    timing["last_ms"] = elapsed_ms
+
+
+def show_timings():
+    with st.sidebar.expander("⏱ Rerun timings"):
+        rows = [{"Section": name, "Runs": t["runs"], "Last (ms)": round(t["last_ms"], 1),
+                 "Average (ms)": round(t["total_ms"] / t["runs"], 1)}
+                for name, t in st.session_state.section_timings.items()]
+        if rows:
+            st.dataframe(pd.DataFrame(rows), hide_index=True)
+        else:
+            st.write("No sections rendered yet.")
 
 # ---------------------
 # Main Navigation
 # ---------------------
+SECTIONS = {
+    "🏠 Home": show_home,
+    "📊 Data Visualization": show_visualization,
+    "🎮 Interactive Widgets": show_widgets,
+    "📱 Layout & Media": show_layout,
+    "🔧 Advanced Features": show_advanced_features,
+    "🔍 Secret Insights": show_secret_insights,
+    "📚 Cheat Sheet": show_cheatsheet,
+    "🔮 Magic": show_new_features,
+}
+
+
 def main():
     st.title("🚀 Streamlit Interactive Learning")
     st.markdown("Welcome to this interactive platform! Learn about various Streamlit features through hands-on modules and unlock secret insights along the way.")
@@ -338,24 +551,12 @@ def main():
         # Reset any other session states if needed
         if 'current_lesson' in st.session_state:
             del st.session_state.current_lesson
+        if 'timed_lesson' in st.session_state:
+            del st.session_state.timed_lesson
         st.rerun()
     
-    if section == "🏠 Home":
-        show_home()
-    elif section == "📊 Data Visualization":
-        show_visualization()
-    elif section == "🎮 Interactive Widgets":
-        show_widgets()
-    elif section == "📱 Layout & Media":
-        show_layout()
-    elif section == "🔧 Advanced Features":
-        show_advanced_features()
-    elif section == "🔍 Secret Insights":
-        show_secret_insights()
-    elif section == "📚 Cheat Sheet":
-        show_cheatsheet()
-    elif section == "🔮 Magic":
-        show_new_features()
+    render_timed(section, SECTIONS[section])
+    show_timings()
 
 # ---------------------
 # Login Section
@@ -0,0 +1,194 @@
+import asyncio
+import heapq
+import itertools
+import math
+import time
+from contextlib import asynccontextmanager, contextmanager
+from contextvars import ContextVar
+import metrics
+
+
+# lower number goes first; streamlit users should not wait behind a batch job
+PRIORITIES = {"interactive": 0, "batch": 1}
+BATCH_PATHS = ("/ask-question/batch", "/jobs")
+
+_priority = ContextVar("priority", default="interactive")
+
+
+@contextmanager
+def priority(level: str):
+    token = _priority.set(level if level in PRIORITIES else "interactive")
+    try:
+        yield
+    finally:
+        _priority.reset(token)
+
+
+def current_priority():
+    return _priority.get()
+
+
+class Overloaded(Exception):
+    """The upstream is at its limits and the wait queue is full (429) or the wait took too long (503)."""
+
+    def __init__(self, name: str, status: int, retry_after: float):
+        super().__init__(f"{name} is overloaded, try again in {retry_after:.0f}s")
+        self.status = status
+        self.retry_after = retry_after
+
+
+class TokenBucket:
+    def __init__(self, rate: float, burst: float):
+        # rate 0 means no rate limit
+        self.rate = rate
+        self.burst = max(burst, 1)
+        self.tokens = self.burst
+        self.updated = time.monotonic()
+
+    def _refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def try_take(self):
+        if self.rate <= 0:
+            return True
+        self._refill()
+        if self.tokens >= 1:
+            self.tokens -= 1
+            return True
+        return False
+
+    def wait_time(self):
+        return 0 if self.rate <= 0 else max(1 - self.tokens, 0) / self.rate
+
+
+class AdmissionController:
+    """Concurrency limit + token bucket rate limit for one upstream, with a bounded priority queue in front.
+
+    `async with gate.slot():` waits for a free slot (interactive requests before batch ones), or raises Overloaded
+    right away when the queue is full, or after max_wait. A full queue doesn't turn away a request while a waiter of
+    a lower priority is in it: the newest of those is rejected instead and the request takes its place.
+    """
+
+    def __init__(self, name: str, max_concurrency: int = 16, rate: float = 0, burst: float = None,
+                 max_queue: int = 100, max_wait: float = 10):
+        self.name = name
+        self.max_concurrency = max_concurrency
+        self.bucket = TokenBucket(rate, burst if burst is not None else max(rate, 1))
+        self.max_queue = max_queue
+        self.max_wait = max_wait
+        self.active = 0
+        # (priority, sequence, future); cancelled waiters stay in the heap and are skipped
+        self._queue = []
+        self._waiting = 0
+        self._sequence = itertools.count()
+        self._timer = None
+        # moving average of how long a slot is held, for the Retry-After estimate
+        self._hold = 1.0
+        self.admitted = 0
+        self.rejected = 0
+
+    def retry_after(self):
+        return max(math.ceil(self._waiting * self._hold / self.max_concurrency + self.bucket.wait_time()), 1)
+
+    def _dispatch(self):
+        self._timer = None
+        while self._queue and self.active < self.max_concurrency:
+            if self._queue[0][2].done():
+                heapq.heappop(self._queue)
+                continue
+            if not self.bucket.try_take():
+                # come back when the next token is there
+                self._timer = asyncio.get_running_loop().call_later(self.bucket.wait_time(), self._dispatch)
+                return
+            _, _, future = heapq.heappop(self._queue)
+            self.active += 1
+            future.set_result(None)
+
+    async def _acquire(self, level: str):
+        if self.active < self.max_concurrency and not self._waiting and self.bucket.try_take():
+            self.active += 1
+            return
+
+        if self._waiting >= self.max_queue and not self._evict(PRIORITIES[level]):
+            self.rejected += 1
+            metrics.admission_rejected.inc(upstream=self.name, reason="queue_full")
+            raise Overloaded(self.name, 429, self.retry_after())
+
+        future = asyncio.get_running_loop().create_future()
+        heapq.heappush(self._queue, (PRIORITIES[level], next(self._sequence), future))
+        self._waiting += 1
+        metrics.admission_queue_depth.inc(upstream=self.name, priority=level)
+        start = time.monotonic()
+        if self._timer is None:
+            self._dispatch()
+        try:
+            await asyncio.wait_for(asyncio.shield(future), self.max_wait)
+        except BaseException as e:
+            if future.done() and not future.cancelled() and future.exception() is None:
+                # the slot was given to us just as we gave up; pass it on
+                self.active -= 1
+                self._dispatch()
+            future.cancel()
+            if isinstance(e, asyncio.TimeoutError):
+                self.rejected += 1
+                metrics.admission_rejected.inc(upstream=self.name, reason="wait_timeout")
+                raise Overloaded(self.name, 503, self.retry_after()) from None
+            raise
+        finally:
+            self._waiting -= 1
+            metrics.admission_queue_depth.dec(upstream=self.name, priority=level)
+            metrics.admission_wait_seconds.observe(time.monotonic() - start, upstream=self.name, priority=level)
+
+    def _evict(self, rank: int):
+        """Reject the newest waiter with a lower priority than rank, to make room; False if there is none."""
+        waiters = [entry for entry in self._queue if entry[0] > rank and not entry[2].done()]
+        if not waiters:
+            return False
+        # it stays in the heap until _dispatch skips it, and leaves the count when its _acquire sees the error
+        max(waiters)[2].set_exception(Overloaded(self.name, 429, self.retry_after()))
+        self.rejected += 1
+        metrics.admission_rejected.inc(upstream=self.name, reason="evicted")
+        return True
+
+    @asynccontextmanager
+    async def slot(self):
+        level = _priority.get()
+        await self._acquire(level)
+        self.admitted += 1
+        start = time.monotonic()
+        try:
+            yield
+        finally:
+            self._hold = 0.9 * self._hold + 0.1 * (time.monotonic() - start)
+            self.active -= 1
+            self._dispatch()
+
+    def stats(self):
+        return {
+            "active": self.active,
+            "max_concurrency": self.max_concurrency,
+            "queued": self._waiting,
+            "max_queue": self.max_queue,
+            "admitted": self.admitted,
+            "rejected": self.rejected,
+            "avg_hold_ms": round(self._hold * 1000, 1),
+        }
+
+
+class PriorityMiddleware:
+    """Sets the priority of a request: the X-Priority header if given, otherwise batch for the batch endpoints
+    and interactive for everything else."""
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            return await self.app(scope, receive, send)
+        level = dict(scope["headers"]).get(b"x-priority", b"").decode()
+        if not level:
+            level = "batch" if scope["path"].startswith(BATCH_PATHS) else "interactive"
+        with priority(level):
+            await self.app(scope, receive, send)
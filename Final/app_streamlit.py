@@ -1,8 +1,26 @@
 import streamlit as st
 import os
+import json
+import threading
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
 from models import APIKeyModel
 from asyncio import run
 import requests
+from requests.adapters import HTTPAdapter
+from websockets.sync.client import connect
+
+# where the FastAPI backend runs; the default is the service name from docker compose
+BACKEND_URL = os.environ.get("BACKEND_URL", "http://fastapi:8000")
+# BACKEND_URL = "http://127.0.0.1:8000" when running without Docker compose
+ENDPOINT = BACKEND_URL + "/ask-question/stream"
+WS_ENDPOINT = BACKEND_URL.replace("http", "ws", 1) + "/ws/chat"
+# "websocket": every browser session keeps one connection to the backend that all its prompts go over;
+# "http": one POST per prompt
+TRANSPORT = os.environ.get("BACKEND_TRANSPORT", "websocket")
+# (connect, read) timeouts in seconds; the read timeout is the max wait between two streamed lines
+TIMEOUT = (float(os.environ.get("BACKEND_CONNECT_TIMEOUT", 3)), float(os.environ.get("BACKEND_READ_TIMEOUT", 60)))
 
 if "logged_in" not in st.session_state:
     st.session_state.logged_in = False
@@ -31,23 +49,162 @@ def login_page():
 
     st.button("Login", on_click=handle_login, args=('key_entry', username, password))
 
+@st.cache_resource
+def get_session():
+    """One HTTP session per server process, so the connections to the backend are kept open and reused."""
+    session = requests.Session()
+    adapter = HTTPAdapter(pool_connections=4, pool_maxsize=int(os.environ.get("BACKEND_POOL_SIZE", 32)))
+    session.mount("http://", adapter)
+    session.mount("https://", adapter)
+    return session
+
+@st.cache_resource
+def get_executor():
+    """Worker threads that wait for the backend, so the Streamlit script thread doesn't have to."""
+    return ThreadPoolExecutor(max_workers=int(os.environ.get("BACKEND_POOL_SIZE", 32)), thread_name_prefix="backend")
+
+class Answer:
+    """Filled in by a worker thread while the backend streams the answer; the page only reads it."""
+
+    def __init__(self, prompt):
+        self.prompt = prompt
+        self.text = ""
+        self.sources = None
+        self.error = None
+        self.done = False
+        self.start = time.perf_counter()
+        self.first_token = None
+        self.total = None
+        # sent along as X-Request-ID (or as request_id over the WebSocket), so the trace of this answer can be found
+        # in the backend (/traces)
+        self.request_id = uuid.uuid4().hex
+
+def apply_event(answer, event):
+    if event["event"] == "token":
+        if answer.first_token is None:
+            answer.first_token = time.perf_counter() - answer.start
+        answer.text += event["data"]
+    elif event["event"] == "sources":
+        answer.sources = event["data"]
+    elif event["event"] == "error":
+        answer.error = event["data"]
+
+def finish(answer):
+    answer.total = time.perf_counter() - answer.start
+    answer.done = True
+
+def fetch_answer(session, prompt, answer):
+    """Runs in a worker thread; reads the streamed events of the backend into `answer`."""
+    try:
+        # the backend sends one JSON event per line, so we can show the answer while it is being generated
+        with session.post(ENDPOINT, json={"prompt": prompt}, stream=True, timeout=TIMEOUT,
+                          headers={"X-Request-ID": answer.request_id}) as response:
+            response.raise_for_status()
+            for line in response.iter_lines(decode_unicode=True):
+                if line:
+                    apply_event(answer, json.loads(line))
+    except requests.RequestException as e:
+        answer.error = f"Could not reach the backend: {e}"
+    finally:
+        finish(answer)
+
+class ChatConnection:
+    """The WebSocket of one browser session; a reader thread fills in the answer its events belong to.
+
+    A new prompt while the last answer is still coming makes the backend cancel that answer.
+    """
+
+    def __init__(self):
+        self.ws = None
+        self.answers = {}
+        self.lock = threading.Lock()
+
+    def _connect(self):
+        self.ws = connect(WS_ENDPOINT, open_timeout=TIMEOUT[0])
+        threading.Thread(target=self._read, args=(self.ws,), daemon=True, name="backend-ws").start()
+
+    def ask(self, answer):
+        message = json.dumps({"prompt": answer.prompt, "id": answer.request_id, "request_id": answer.request_id})
+        with self.lock:
+            self.answers[answer.request_id] = answer
+            try:
+                if self.ws is None:
+                    self._connect()
+                self.ws.send(message)
+            except Exception:
+                # the backend restarted or closed the idle connection; one more try on a new one
+                try:
+                    self._connect()
+                    self.ws.send(message)
+                except Exception as e:
+                    self.answers.pop(answer.request_id, None)
+                    answer.error = f"Could not reach the backend: {e}"
+                    finish(answer)
+
+    def _read(self, ws):
+        try:
+            for text in ws:
+                event = json.loads(text)
+                answer = self.answers.get(event.get("id"))
+                if answer is None:
+                    # heartbeats, and the leftovers of answers that were replaced
+                    continue
+                apply_event(answer, event)
+                if event["event"] in ("done", "cancelled"):
+                    self.answers.pop(answer.request_id, None)
+                    finish(answer)
+        except Exception:
+            pass
+        finally:
+            with self.lock:
+                if self.ws is ws:
+                    self.ws = None
+                    for answer in self.answers.values():
+                        answer.error = "The connection to the backend was lost"
+                        finish(answer)
+                    self.answers.clear()
+
+def show_answer(answer):
+    st.write(answer.text)
+    if answer.sources:
+        st.write(answer.sources)
+    if answer.error:
+        st.error(answer.error)
+    if answer.done and answer.first_token is not None:
+        st.caption(f"First token after {answer.first_token * 1000:.0f} ms, "
+                   f"full answer after {answer.total * 1000:.0f} ms (request id {answer.request_id})")
+
+@st.fragment(run_every=0.3)
+def poll_answer():
+    """Only this fragment reruns while the answer comes in; once it's done the whole page reruns once."""
+    answer = st.session_state.answer
+    show_answer(answer)
+    if answer.done:
+        st.rerun()
+
 def key_page():
     """Render the key entry page."""
     st.title("Key Entry Page")
     st.write(f"Welcome, {st.session_state.username}!")
     prompt = st.text_input("Enter your prompt...")
-    prompt_dict = {}
-    prompt_dict["prompt"] = prompt
-    
-    ENDPOINT = "http://fastapi:8000/ask-question"
-    # ENDPOINT = "http://127.0.0.1:8000/ask-question" Commented for Docker compose
-        
+
     if st.button("Submit"):
-        response = requests.post(ENDPOINT, json=prompt_dict)
-        response.raise_for_status()
-        data = response.json()
-        result = data.get('response')
-        st.write(result)
+        # hand the request to a worker thread (or the connection of this session) and return right away
+        answer = Answer(prompt)
+        st.session_state.answer = answer
+        if TRANSPORT == "websocket":
+            if "chat" not in st.session_state:
+                st.session_state.chat = ChatConnection()
+            st.session_state.chat.ask(answer)
+        else:
+            get_executor().submit(fetch_answer, get_session(), prompt, answer)
+
+    answer = st.session_state.get("answer")
+    if answer is not None:
+        if answer.done:
+            show_answer(answer)
+        else:
+            poll_answer()
 
 if st.session_state.page == "login":
     login_page()
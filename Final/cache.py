@@ -0,0 +1,263 @@
+import json
+import random
+import re
+import time
+import zlib
+from collections import OrderedDict, deque
+
+import numpy as np
+
+
+def normalize_query(query: str):
+    """Lowercase, collapse whitespace and drop the trailing ?!. so trivially different queries share a key.
+
+    Everything else stays: "c++", "c#" and "c" are different questions, and so are "-5 > 5" and "5 > -5".
+    """
+    return " ".join(query.lower().split()).rstrip("?!. ")
+
+
+class SearchCache:
+    """In-process LRU cache with TTL expiry, bounded by number of entries and by (approximate) size in bytes.
+
+    The keys are normalized queries; pass another `key` function for keys that must not be touched (URLs).
+    """
+
+    def __init__(self, ttl: float = 300, max_entries: int = 1024, max_bytes: int = 32 * 1024 * 1024,
+                 key=normalize_query):
+        self.key = key
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        # key -> (expires_at, size, value); the order of the dict is the LRU order (oldest first)
+        self._entries = OrderedDict()
+        self.size_bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+
+    def get(self, query: str):
+        key = self.key(query)
+        entry = self._entries.get(key)
+        if entry is None:
+            self.misses += 1
+            return None
+
+        expires_at, size, value = entry
+        if expires_at < time.monotonic():
+            self._remove(key)
+            self.expirations += 1
+            self.misses += 1
+            return None
+
+        self._entries.move_to_end(key)
+        self.hits += 1
+        return value
+
+    def put(self, query: str, value):
+        key = self.key(query)
+        size = len(json.dumps(value, default=str))
+        if size > self.max_bytes:
+            # would evict everything else and still not fit
+            return
+
+        if key in self._entries:
+            self._remove(key)
+        self._entries[key] = (time.monotonic() + self.ttl, size, value)
+        self.size_bytes += size
+
+        while len(self._entries) > self.max_entries or self.size_bytes > self.max_bytes:
+            oldest = next(iter(self._entries))
+            self._remove(oldest)
+            self.evictions += 1
+
+    def clear(self):
+        self._entries.clear()
+        self.size_bytes = 0
+
+    def _remove(self, key: str):
+        _, size, _ = self._entries.pop(key)
+        self.size_bytes -= size
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        return {
+            "entries": len(self._entries),
+            "size_bytes": self.size_bytes,
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+            "expirations": self.expirations,
+            "hit_ratio": self.hits / lookups if lookups else 0.0,
+        }
+
+
+# words that barely change the meaning of a question; "who is X" and "who was X" should look the same
+STOP_WORDS = {"a", "an", "the", "is", "was", "are", "were", "be", "been", "of", "to", "in", "on", "do", "does", "did",
+              "me", "tell", "about", "please", "can", "you"}
+
+
+# numbers (with their sign, decimals, times and dates) and words, keeping a trailing + or # ("c++", "c#")
+TOKEN = re.compile(r"(?<!\w)[-+]?\d+(?:[.,:/-]\d+)*|\w+[+#]*")
+
+
+def tokenize(text: str):
+    return TOKEN.findall(text.lower())
+
+
+# words that do change the answer, even though the rest of the question is the same ("best" vs "worst", "before"
+# vs "after", "today" vs nothing); two prompts only share an answer if they have the same ones
+QUALIFIERS = {
+    "not", "no", "never", "without", "except", "before", "after", "first", "last", "latest", "newest", "oldest",
+    "next", "previous", "best", "worst", "most", "least", "top", "cheapest", "largest", "smallest", "biggest",
+    "highest", "lowest", "fastest", "slowest", "today", "yesterday", "tomorrow", "tonight", "now", "current",
+    "currently", "recent", "upcoming", "ago", "january", "february", "march", "april", "may", "june", "july",
+    "august", "september", "october", "november", "december", "monday", "tuesday", "wednesday", "thursday",
+    "friday", "saturday", "sunday",
+}
+
+
+def key_terms(text: str):
+    """The numbers (in order, with their sign) and the qualifier words of a prompt."""
+    tokens = tokenize(text)
+    numbers = tuple(t for t in tokens if t[-1].isdigit() and (t[0].isdigit() or t[0] in "+-"))
+    return numbers, frozenset(t for t in tokens if t in QUALIFIERS)
+
+
+def hash_embed(text: str, dim: int = 512):
+    """Offline embedding: hash words and character trigrams into a fixed size, L2-normalised vector."""
+    vector = np.zeros(dim, dtype=np.float32)
+    words = [w for w in tokenize(text) if w not in STOP_WORDS]
+    for word in words:
+        # whole words carry most of the weight, the trigrams make it robust to typos and plurals
+        features = [(word, 1.0)] + [(word[i:i + 3], 0.5) for i in range(max(len(word) - 2, 1))]
+        for feature, weight in features:
+            h = zlib.crc32(feature.encode())
+            sign = 1.0 if h & 1 else -1.0
+            vector[(h >> 1) % dim] += sign * weight
+
+    norm = np.linalg.norm(vector)
+    if norm > 0:
+        vector /= norm
+    return vector
+
+
+class SemanticCache:
+    """Answer cache that matches on similarity of the prompt instead of exact text.
+
+    The embeddings live in one preallocated NumPy matrix, so a lookup is a single matrix-vector product.
+    When the cache is full the least recently used entry is overwritten. A similar prompt with other numbers,
+    dates or qualifiers ("... in 1900", "worst" instead of "best") is not a hit, however close it is. Answers made a
+    different way (the variant, e.g. with the fan-out search) are only a hit for requests of that same variant.
+    """
+
+    def __init__(self, threshold: float = 0.95, max_entries: int = 2048, ttl: float = 3600, dim: int = 512,
+                 sample_rate: float = 0.05, embed=hash_embed, terms=key_terms):
+        self.threshold = threshold
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.dim = dim
+        self.sample_rate = sample_rate
+        self.embed = embed
+        self.terms = terms
+
+        self._vectors = np.zeros((max_entries, dim), dtype=np.float32)
+        self._prompts = [None] * max_entries
+        self._values = [None] * max_entries
+        self._terms = [None] * max_entries
+        self._variants = np.full(max_entries, "", dtype=object)
+        self._expires_at = np.zeros(max_entries, dtype=np.float64)
+        self._last_used = np.zeros(max_entries, dtype=np.float64)
+        self._count = 0
+        # (variant, normalized prompt) -> slot, so storing the same prompt again overwrites it instead of taking a new slot
+        self._slots = {}
+
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        # close enough, but about other numbers/dates/qualifiers
+        self.rejected = 0
+        # random sample of hits (and misses that were close) so someone can check for false hits by hand
+        self.samples = deque(maxlen=200)
+
+    def get(self, prompt: str, variant: str = ""):
+        if self._count == 0:
+            self.misses += 1
+            return None
+
+        now = time.monotonic()
+        scores = self._vectors[:self._count] @ self.embed(prompt, self.dim)
+        scores[self._expires_at[:self._count] < now] = -1.0
+        scores[self._variants[:self._count] != variant] = -1.0
+        best = int(np.argmax(scores))
+        score = float(scores[best])
+
+        if score < self.threshold:
+            self.misses += 1
+            if score >= self.threshold - 0.1:
+                self._sample(prompt, best, score, hit=False)
+            return None
+
+        # the closest entry that asks about the same numbers and qualifiers
+        terms = self.terms(prompt)
+        candidates = np.flatnonzero(scores >= self.threshold)
+        for slot in candidates[np.argsort(-scores[candidates])]:
+            if self._terms[slot] == terms:
+                self.hits += 1
+                self._last_used[slot] = now
+                self._sample(prompt, slot, float(scores[slot]), hit=True)
+                return self._values[slot]
+
+        self.misses += 1
+        self.rejected += 1
+        self._sample(prompt, best, score, hit=False)
+        return None
+
+    def put(self, prompt: str, value, variant: str = ""):
+        now = time.monotonic()
+        key = (variant, normalize_query(prompt))
+        if key in self._slots:
+            slot = self._slots[key]
+        elif self._count < self.max_entries:
+            slot = self._count
+            self._count += 1
+        else:
+            # expired entries go first, otherwise the least recently used one
+            expired = np.flatnonzero(self._expires_at < now)
+            slot = int(expired[0]) if len(expired) else int(np.argmin(self._last_used))
+            del self._slots[(self._variants[slot], normalize_query(self._prompts[slot]))]
+            self.evictions += 1
+
+        self._slots[key] = slot
+        self._vectors[slot] = self.embed(prompt, self.dim)
+        self._prompts[slot] = prompt
+        self._values[slot] = value
+        self._terms[slot] = self.terms(prompt)
+        self._variants[slot] = variant
+        self._expires_at[slot] = now + self.ttl
+        self._last_used[slot] = now
+
+    def clear(self):
+        self._count = 0
+        self._slots = {}
+        self._prompts = [None] * self.max_entries
+        self._values = [None] * self.max_entries
+        self._terms = [None] * self.max_entries
+        self._variants[:] = ""
+
+    def _sample(self, prompt: str, slot: int, score: float, hit: bool):
+        if random.random() < self.sample_rate:
+            self.samples.append({"prompt": prompt, "matched": self._prompts[slot], "score": round(score, 4),
+                                 "hit": hit})
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        return {
+            "entries": self._count,
+            "threshold": self.threshold,
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+            "rejected": self.rejected,
+            "hit_ratio": self.hits / lookups if lookups else 0.0,
+        }
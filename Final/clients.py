@@ -0,0 +1,176 @@
+import asyncio
+import os
+from langchain_openai import ChatOpenAI
+from tavily import AsyncTavilyClient
+
+
+# the env variables the clients are built from; setting one of these through /api-key-setup rebuilds the clients
+KEY_NAMES = ("OPENAI_API_KEY", "TAVILY_API_KEY", "ANTHROPIC_API_KEY", "GOOGLE_API_KEY")
+
+# live: the real services; fake: the local stand-ins from loadtest/fakes.py (no keys needed);
+# record: the real services, but every call is also written to RECORD_DIR so it can be replayed by the fakes later
+UPSTREAM_MODE = os.environ.get("UPSTREAM_MODE", "live")
+RECORD_DIR = os.environ.get("RECORD_DIR", "recordings")
+
+# seconds the replaced clients stay open after a key change, so the requests that are still using them can finish
+CLIENT_CLOSE_GRACE = float(os.environ.get("CLIENT_CLOSE_GRACE", 60))
+
+# more than one chat model, e.g. "openai:gpt-4o-mini:3,anthropic:claude-3-5-haiku-latest:1" (provider:model:weight);
+# LLM_ROUTING is "weighted" or "latency", LLM_CASCADE_TO is the provider:model that gets the unsure answers
+# (see providers.py). without LLM_PROVIDERS there is just the one gpt-4o-mini
+LLM_PROVIDERS = os.environ.get("LLM_PROVIDERS", "")
+LLM_ROUTING = os.environ.get("LLM_ROUTING", "weighted")
+LLM_CASCADE_TO = os.environ.get("LLM_CASCADE_TO", "")
+# seconds one provider of the pool gets before the next one is tried; keep it below OPENAI_TIMEOUT
+LLM_PROVIDER_TIMEOUT = float(os.environ.get("LLM_PROVIDER_TIMEOUT", 10))
+
+
+class Clients:
+    """Holds the tavily and openai clients.
+
+    They are created on first use (so the app starts without keys) and rebuilt when a key changes. A rebuild only
+    swaps the references: requests that already got the old client keep using it until they are done, and the old
+    clients (with their connection pools) are closed CLIENT_CLOSE_GRACE seconds later.
+    """
+
+    def __init__(self):
+        self._tavily = None
+        self._llm = None
+        self.generation = 0
+        # background tasks (warm-ups, closing old clients); kept here so they aren't garbage collected half-way
+        self._tasks = set()
+        # replaced (tavily, llm) pairs that are not closed yet
+        self._retired = []
+
+    def run_in_background(self, coro):
+        task = asyncio.create_task(coro)
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+        return task
+
+    @staticmethod
+    def _build_tavily():
+        if UPSTREAM_MODE == "fake":
+            from loadtest.fakes import FakeTavilyClient
+            return FakeTavilyClient()
+
+        client = AsyncTavilyClient(api_key=os.environ.get("TAVILY_API_KEY"))
+        if UPSTREAM_MODE == "record":
+            from loadtest.fakes import RecordingTavilyClient
+            os.makedirs(RECORD_DIR, exist_ok=True)
+            return RecordingTavilyClient(client, os.path.join(RECORD_DIR, "tavily.jsonl"))
+        return client
+
+    @staticmethod
+    def _build_llm():
+        if UPSTREAM_MODE == "fake" and not LLM_PROVIDERS:
+            from loadtest.fakes import FakeChatModel
+            return FakeChatModel()
+
+        if LLM_PROVIDERS:
+            from providers import ProviderPool, Provider, parse_providers, make_chat_model
+            large = None
+            if LLM_CASCADE_TO:
+                provider, model = LLM_CASCADE_TO.split(":")[:2]
+                large = Provider(LLM_CASCADE_TO, make_chat_model(provider, model))
+            return ProviderPool(parse_providers(LLM_PROVIDERS), routing=LLM_ROUTING, large=large,
+                                timeout=LLM_PROVIDER_TIMEOUT)
+
+        model = ChatOpenAI(model="gpt-4o-mini", api_key=os.environ.get("OPENAI_API_KEY"))
+        if UPSTREAM_MODE == "record":
+            from loadtest.fakes import RecordingChatModel
+            os.makedirs(RECORD_DIR, exist_ok=True)
+            return RecordingChatModel(model, os.path.join(RECORD_DIR, "openai.jsonl"))
+        return model
+
+    def tavily(self):
+        if self._tavily is None:
+            self._tavily = self._build_tavily()
+        return self._tavily
+
+    def llm(self):
+        if self._llm is None:
+            self._llm = self._build_llm()
+        return self._llm
+
+    def llm_stats(self):
+        """The stats of the provider pool (LLM_PROVIDERS), without building the llm if it isn't there yet."""
+        if self._llm is None or not hasattr(self._llm, "providers"):
+            return None
+        return self._llm.stats()
+
+    def rebuild(self, key_name: str = None):
+        # build the new clients first and swap them in one go, so nobody sees a half-updated state;
+        # nothing is awaited in here, so no other request can run in between.
+        # a client without a key stays None and will be built (and fail with a clear error) on first use
+        if key_name is not None and key_name not in KEY_NAMES:
+            return
+        fake = UPSTREAM_MODE == "fake"
+        tavily = self._build_tavily() if fake or os.environ.get("TAVILY_API_KEY") else None
+        llm = self._build_llm() if fake or LLM_PROVIDERS or os.environ.get("OPENAI_API_KEY") else None
+        old = (self._tavily, self._llm)
+        self._tavily, self._llm = tavily, llm
+        self.generation += 1
+        print(f"clients rebuilt (generation {self.generation})")
+        self._retired.append(old)
+        self.run_in_background(self._close_later(old))
+
+    async def _close_later(self, old: tuple):
+        await asyncio.sleep(CLIENT_CLOSE_GRACE)
+        if old in self._retired:
+            self._retired.remove(old)
+            await self._close_clients(*old, keep=[self._llm] + [llm for _, llm in self._retired])
+
+    async def warm_up(self):
+        """Resolve the hosts and open the first connection at startup, so the first user doesn't pay for it."""
+        loop = asyncio.get_running_loop()
+        if UPSTREAM_MODE == "fake":
+            return
+        for host in ("api.openai.com", "api.tavily.com"):
+            try:
+                await loop.getaddrinfo(host, 443)
+            except OSError as e:
+                print(f"warm-up: could not resolve {host}: {e}")
+
+        # listing the models is free and leaves a TLS connection in the pool that the chat calls reuse.
+        # the tavily client opens a new connection per search, so for tavily only the DNS lookup helps
+        try:
+            for client in self._openai_clients(self.llm()):
+                await client.models.list()
+        except Exception as e:
+            print(f"warm-up: openai not reachable yet: {e!r}")
+
+    @staticmethod
+    def _openai_clients(llm):
+        # the openai connection pools of the model, or of every openai model in a provider pool
+        models = [p.model for p in getattr(llm, "providers", [])] or [llm]
+        # the recording wrapper keeps the real model in .model
+        models = [getattr(m, "model", m) for m in models]
+        return [m.root_async_client for m in models if hasattr(m, "root_async_client")]
+
+    async def _close_clients(self, tavily, llm, keep: list = ()):
+        # the http pools of the tavily client (inside the recording wrapper, if there is one) and the openai clients.
+        # langchain shares one openai pool between all the models of the process, so an openai pool is only closed
+        # if none of the models in `keep` uses it
+        closers = []
+        if tavily is not None:
+            closers.append(getattr(getattr(tavily, "client", tavily), "close", None))
+        if llm is not None:
+            in_use = {id(client._client) for model in keep if model is not None
+                      for client in self._openai_clients(model)}
+            closers += [client.close for client in self._openai_clients(llm) if id(client._client) not in in_use]
+        for close in closers:
+            if close is None:
+                continue
+            try:
+                await close()
+            except Exception as e:
+                print(f"closing an old client failed: {e!r}")
+
+    async def close(self):
+        for task in self._tasks:
+            task.cancel()
+        for old in self._retired:
+            await self._close_clients(*old)
+        self._retired.clear()
+        await self._close_clients(self._tavily, self._llm)
@@ -0,0 +1,129 @@
+import math
+import re
+import threading
+import zlib
+from collections import Counter
+
+
+WORD = re.compile(r"\w+")
+TOKEN = re.compile(r"\w+|[^\w\s]")
+
+_encoding = None
+_loader = None
+
+
+def _load_encoding():
+    global _encoding
+    try:
+        # tiktoken comes with langchain_openai; without it we stay with the rough estimate
+        import tiktoken
+        _encoding = tiktoken.get_encoding("o200k_base")
+    except Exception as e:
+        print(f"tiktoken encoding not available, estimating token counts instead: {e!r}")
+
+
+def token_counter():
+    """The exact tiktoken count once the encoding is loaded, a rough estimate until then (or if it can't be).
+
+    Loading the encoding can mean downloading it, so that happens in a thread on first use, not at import and not
+    in a request.
+    """
+    global _loader
+    if _loader is None:
+        _loader = threading.Thread(target=_load_encoding, daemon=True, name="tiktoken")
+        _loader.start()
+    encoding = _encoding
+    if encoding is not None:
+        return lambda text: len(encoding.encode(text))
+    return lambda text: len(TOKEN.findall(text))
+
+
+def count_tokens(text: str):
+    return token_counter()(text)
+
+
+def minhash(text: str, num_hashes: int = 64, shingle_size: int = 5):
+    """MinHash signature of the word shingles of a text."""
+    words = WORD.findall(text.lower())
+    shingles = {" ".join(words[i:i + shingle_size]) for i in range(max(len(words) - shingle_size + 1, 1))}
+    hashes = [zlib.crc32(s.encode()) for s in shingles]
+    # cheap family of hash functions: xor the shingle hash with a different seed for every slot
+    return [min(h ^ seed for h in hashes) for seed in _SEEDS[:num_hashes]]
+
+
+_SEEDS = [zlib.crc32(f"seed-{i}".encode()) for i in range(256)]
+
+
+def similarity(a: list, b: list):
+    """Estimated Jaccard similarity of two MinHash signatures."""
+    return sum(x == y for x, y in zip(a, b)) / len(a)
+
+
+def relevance_scores(query: str, snippets: list):
+    """BM25 score of every snippet against the query, using the snippets themselves as the corpus."""
+    docs = [WORD.findall(s.lower()) for s in snippets]
+    terms = set(WORD.findall(query.lower()))
+    avg_len = sum(len(d) for d in docs) / len(docs) if docs else 0
+    doc_freq = Counter(t for d in docs for t in set(d))
+    k1, b = 1.5, 0.75
+
+    scores = []
+    for doc in docs:
+        tf = Counter(doc)
+        score = 0.0
+        for term in terms:
+            if term not in tf:
+                continue
+            idf = math.log(1 + (len(docs) - doc_freq[term] + 0.5) / (doc_freq[term] + 0.5))
+            score += idf * tf[term] * (k1 + 1) / (tf[term] + k1 * (1 - b + b * len(doc) / (avg_len or 1)))
+        scores.append(score)
+    return scores
+
+
+def assemble_context(query: str, results: list, token_budget: int = 2000, duplicate_threshold: float = 0.8):
+    """Build the context for the prompt out of the search results.
+
+    Near duplicates are removed, the rest is ranked by relevance to the query (combined with the score tavily gives)
+    and packed into the token budget. Returns the context and a small report of what happened.
+    """
+    contents = [r.get("content") or "" for r in results]
+    # one counter for the whole context, so the before/after numbers are comparable
+    count_tokens = token_counter()
+    tokens_before = sum(count_tokens(c) for c in contents)
+
+    # 1. drop near duplicates, keeping the first occurrence (tavily already returns them roughly by relevance)
+    kept, signatures, duplicates = [], [], 0
+    for i, content in enumerate(contents):
+        if not content.strip():
+            continue
+        signature = minhash(content)
+        if any(similarity(signature, s) >= duplicate_threshold for s in signatures):
+            duplicates += 1
+            continue
+        kept.append(i)
+        signatures.append(signature)
+
+    # 2. rerank; both scores are scaled to 0-1 so neither dominates
+    bm25 = dict(zip(kept, relevance_scores(query, [contents[i] for i in kept])))
+    top = max(bm25.values(), default=0) or 1
+    ranked = sorted(kept, key=lambda i: -(bm25[i] / top + float(results[i].get("score") or 0)))
+
+    # 3. pack into the budget; a snippet that does not fit is skipped so a smaller one after it can still go in
+    packed, used = [], 0
+    for i in ranked:
+        tokens = count_tokens(contents[i])
+        if used + tokens > token_budget:
+            continue
+        packed.append(contents[i])
+        used += tokens
+
+    report = {
+        "snippets": len(contents),
+        "empty": sum(1 for c in contents if not c.strip()),
+        "duplicates_removed": duplicates,
+        "snippets_used": len(packed),
+        "tokens_before": tokens_before,
+        "tokens_used": used,
+        "tokens_saved": tokens_before - used,
+    }
+    return "\n".join(packed), report
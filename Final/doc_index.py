@@ -0,0 +1,376 @@
+import asyncio
+import os
+import sqlite3
+import threading
+import time
+import zlib
+import numpy as np
+from cache import hash_embed
+from pages import split_passages
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+# open for as long as the process lives, it holds the lock on the index (see open_index)
+_lock_file = None
+
+
+class DocIndex:
+    """Persistent index of the search results seen so far, so related questions can be answered without Tavily.
+
+    Every result is cut into chunks; the chunk vectors live in a memory-mapped .npy file and the text (with the
+    title, url and the time it was added) in SQLite. A query is one matrix-vector product over the vectors.
+
+    - adding the same chunk again only refreshes its time, so popular content doesn't go stale
+    - at more than max_chunks the oldest chunks are dropped; dropped rows are only marked, compact() rewrites the
+      files without them once a quarter of the rows is dead
+    - compaction copies the live rows into a new vectors file and a new table while searches go on, and switches
+      to both in one SQLite transaction, so a crash halfway leaves the old, consistent index
+    - add_later does the adding (and the compaction it may need) in the background, one at a time, so a request
+      never waits for it
+    """
+
+    def __init__(self, path: str, dim: int = 256, max_chunks: int = 1_000_000, chunk_words: int = 120,
+                 embed=hash_embed, max_pending: int = 100):
+        self.path = path
+        self.dim = dim
+        self.max_chunks = max_chunks
+        self.chunk_words = chunk_words
+        self.embed = embed
+        self.max_pending = max_pending
+        # _lock: what a search reads (the rows, the vectors file, the arrays); _write_lock: one writer at a time,
+        # so a compaction can copy the rows without holding _lock
+        self._lock = threading.Lock()
+        self._write_lock = threading.Lock()
+        self._writer = asyncio.Lock()
+        self._tasks = set()
+        self.needs_compaction = False
+        self.hits = 0
+        self.misses = 0
+        self.added = 0
+        self.refreshed = 0
+        self.compactions = 0
+        # adds skipped because too many were waiting already
+        self.dropped = 0
+
+        os.makedirs(path, exist_ok=True)
+        self.db = sqlite3.connect(os.path.join(path, "docs.db"), isolation_level=None, check_same_thread=False)
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.execute("PRAGMA synchronous=NORMAL")
+        self.db.execute("CREATE TABLE IF NOT EXISTS docs (row INTEGER PRIMARY KEY, key INTEGER, url TEXT, title TEXT, "
+                        "content TEXT, added_at REAL)")
+        self.db.execute("CREATE TABLE IF NOT EXISTS meta (name TEXT PRIMARY KEY, value INTEGER)")
+        self.generation = self._meta("generation")
+        # a compaction names the index after its generation (the old one is dropped with the old table)
+        if self.db.execute("SELECT 1 FROM sqlite_master WHERE type = 'index' AND tbl_name = 'docs'").fetchone() is None:
+            self.db.execute(f"CREATE INDEX docs_key_{self.generation} ON docs (key)")
+        self._open_vectors()
+
+        # the times and alive flags of all rows are kept in memory, so a query can skip dropped and stale rows
+        # without touching SQLite; the dead rows are exactly the ones without a docs row
+        rows = self.db.execute("SELECT row, added_at FROM docs").fetchall()
+        self.count = max((row for row, _ in rows), default=-1) + 1
+        self.added_at = np.zeros(self.capacity, dtype=np.float64)
+        self.alive = np.zeros(self.capacity, dtype=bool)
+        for row, added_at in rows:
+            self.added_at[row] = added_at
+            self.alive[row] = True
+
+    def _meta(self, name: str):
+        row = self.db.execute("SELECT value FROM meta WHERE name = ?", (name,)).fetchone()
+        return 0 if row is None else row[0]
+
+    def _vectors_path(self, generation: int):
+        return os.path.join(self.path, f"vectors-{generation}.npy")
+
+    def _open_vectors(self, capacity: int = 1024):
+        path = self._vectors_path(self.generation)
+        if os.path.exists(path):
+            self.vectors = np.load(path, mmap_mode="r+")
+        else:
+            self.vectors = np.lib.format.open_memmap(path, mode="w+", dtype=np.float32, shape=(capacity, self.dim))
+        self.capacity = len(self.vectors)
+        # files of older generations are left behind by a compaction that crashed or finished
+        for name in os.listdir(self.path):
+            if name.startswith("vectors-") and name != os.path.basename(path):
+                os.remove(os.path.join(self.path, name))
+
+    def _grow(self, needed: int):
+        # double the file; rare, and the old rows are copied in blocks so it never needs all of them in memory
+        capacity = self.capacity
+        while capacity < needed:
+            capacity *= 2
+        tmp = os.path.join(self.path, "vectors-grow.tmp")
+        vectors = np.lib.format.open_memmap(tmp, mode="w+", dtype=np.float32, shape=(capacity, self.dim))
+        for start in range(0, self.count, 65536):
+            end = min(start + 65536, self.count)
+            vectors[start:end] = self.vectors[start:end]
+        vectors.flush()
+        del vectors
+        os.replace(tmp, self._vectors_path(self.generation))
+        self.vectors = np.load(self._vectors_path(self.generation), mmap_mode="r+")
+        self.capacity = capacity
+        self.added_at = np.concatenate([self.added_at, np.zeros(capacity - len(self.added_at))])
+        self.alive = np.concatenate([self.alive, np.zeros(capacity - len(self.alive), dtype=bool)])
+
+    def _chunks(self, results: list):
+        for result in results:
+            for chunk in split_passages(result.get("content") or "", self.chunk_words):
+                key = zlib.crc32(f"{result['url']}\n{chunk}".encode())
+                yield key, result["url"], result.get("title") or "", chunk
+
+    def add(self, results: list):
+        """Add the chunks of search results ({"url", "title", "content"}); chunks that are already there are
+        refreshed instead of added twice."""
+        now = time.time()
+        with self._write_lock, self._lock:
+            new = []
+            for key, url, title, chunk in self._chunks(results):
+                existing = self.db.execute("SELECT row FROM docs WHERE key = ? AND url = ? AND content = ?",
+                                           (key, url, chunk)).fetchone()
+                if existing is not None:
+                    self.db.execute("UPDATE docs SET added_at = ? WHERE row = ?", (now, existing[0]))
+                    self.added_at[existing[0]] = now
+                    self.refreshed += 1
+                else:
+                    new.append((key, url, title, chunk))
+            if not new:
+                return 0
+
+            if self.count + len(new) > self.capacity:
+                self._grow(self.count + len(new))
+            rows = range(self.count, self.count + len(new))
+            self.vectors[rows.start:rows.stop] = np.stack([self.embed(f"{title} {chunk}", self.dim)
+                                                           for _, _, title, chunk in new])
+            # the vectors are on disk before the rows that point to them
+            self.vectors.flush()
+            self.db.execute("BEGIN")
+            self.db.executemany("INSERT INTO docs VALUES (?, ?, ?, ?, ?, ?)",
+                                [(row, key, url, title, chunk, now) for row, (key, url, title, chunk)
+                                 in zip(rows, new)])
+            self.db.execute("COMMIT")
+            self.added_at[rows.start:rows.stop] = now
+            self.alive[rows.start:rows.stop] = True
+            self.count += len(new)
+            self.added += len(new)
+            self._evict()
+        return len(new)
+
+    def _evict(self):
+        alive = int(self.alive[:self.count].sum())
+        if alive > self.max_chunks:
+            # drop the oldest chunks
+            ages = np.where(self.alive[:self.count], self.added_at[:self.count], np.inf)
+            oldest = np.argpartition(ages, alive - self.max_chunks)[:alive - self.max_chunks]
+            self.db.execute("BEGIN")
+            self.db.executemany("DELETE FROM docs WHERE row = ?", [(int(row),) for row in oldest])
+            self.db.execute("COMMIT")
+            self.alive[oldest] = False
+        if self.count > 1000 and self.count - self.alive[:self.count].sum() > self.count / 4:
+            # not here: add runs with _lock held, and a compaction of a big index takes seconds
+            self.needs_compaction = True
+
+    def compact(self):
+        """Rewrite the files without the dead rows. Searches only wait for the switch to the new files at the end."""
+        with self._write_lock:
+            # nothing else writes while we hold _write_lock, so the rows can be copied without _lock
+            keep = np.flatnonzero(self.alive[:self.count])
+            generation = self.generation + 1
+            capacity = max(len(keep) * 2, 1024)
+            vectors = np.lib.format.open_memmap(self._vectors_path(generation), mode="w+", dtype=np.float32,
+                                                shape=(capacity, self.dim))
+            for start in range(0, len(keep), 65536):
+                rows = keep[start:start + 65536]
+                vectors[start:start + len(rows)] = self.vectors[rows]
+            vectors.flush()
+            del vectors
+
+            # the new table on a connection of its own, so the searches on self.db don't see it half done (WAL);
+            # the new row of a chunk is its position among the rows that are kept, i.e. among the docs rows in order
+            db = sqlite3.connect(os.path.join(self.path, "docs.db"), isolation_level=None)
+            try:
+                db.execute("BEGIN")
+                db.execute("DROP TABLE IF EXISTS docs_new")
+                db.execute("CREATE TABLE docs_new (row INTEGER PRIMARY KEY, key INTEGER, url TEXT, title TEXT, "
+                           "content TEXT, added_at REAL)")
+                db.execute("INSERT INTO docs_new SELECT ROW_NUMBER() OVER (ORDER BY row) - 1, key, url, title, "
+                           "content, added_at FROM docs ORDER BY row")
+                db.execute(f"CREATE INDEX docs_key_{generation} ON docs_new (key)")
+                db.execute("COMMIT")
+            finally:
+                db.close()
+
+            with self._lock:
+                self.db.execute("BEGIN")
+                self.db.execute("DROP TABLE docs")
+                self.db.execute("ALTER TABLE docs_new RENAME TO docs")
+                self.db.execute("INSERT OR REPLACE INTO meta VALUES ('generation', ?)", (generation,))
+                self.db.execute("COMMIT")
+
+                self.generation = generation
+                self._open_vectors()
+                added_at = self.added_at[keep]
+                self.added_at = np.zeros(self.capacity, dtype=np.float64)
+                self.added_at[:len(keep)] = added_at
+                self.alive = np.zeros(self.capacity, dtype=bool)
+                self.alive[:len(keep)] = True
+                self.count = len(keep)
+                self.needs_compaction = False
+                self.compactions += 1
+
+    def search(self, query: str, k: int = 5, max_age: float = None):
+        """The k chunks most similar to the query ({"url", "title", "content", "score", "age"}), best first;
+        chunks older than max_age seconds are skipped."""
+        vector = self.embed(query, self.dim)
+        with self._lock:
+            if not self.count:
+                return []
+            scores = np.empty(self.count, dtype=np.float32)
+            # in blocks, so a query over a million rows doesn't allocate a million-row temporary
+            for start in range(0, self.count, 262144):
+                end = min(start + 262144, self.count)
+                scores[start:end] = self.vectors[start:end] @ vector
+            usable = self.alive[:self.count].copy()
+            if max_age is not None:
+                usable &= self.added_at[:self.count] >= time.time() - max_age
+            scores[~usable] = -np.inf
+
+            k = min(k, int(usable.sum()))
+            if k <= 0:
+                return []
+            top = np.argpartition(-scores, k - 1)[:k]
+            top = top[np.argsort(-scores[top])]
+            docs = {row: (url, title, content, added_at) for row, url, title, content, added_at in self.db.execute(
+                f"SELECT row, url, title, content, added_at FROM docs WHERE row IN ({','.join('?' * k)})",
+                [int(row) for row in top])}
+        now = time.time()
+        return [{"url": docs[row][0], "title": docs[row][1], "content": docs[row][2], "score": float(scores[row]),
+                 "age": now - docs[row][3]} for row in top.tolist() if row in docs]
+
+    async def add_async(self, results: list):
+        return await asyncio.to_thread(self.add, results)
+
+    def add_later(self, results: list):
+        """Add the results in the background, after the adds that are already waiting; skipped when max_pending of
+        them are waiting (the same results will come again if they matter)."""
+        if len(self._tasks) >= self.max_pending:
+            self.dropped += 1
+            return
+        task = asyncio.create_task(self._add_in_background(results))
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+
+    async def _add_in_background(self, results: list):
+        # one at a time (asyncio.Lock is first come, first served), so waiting adds don't each hold a thread
+        async with self._writer:
+            try:
+                await asyncio.to_thread(self.add, results)
+                if self.needs_compaction:
+                    await asyncio.to_thread(self.compact)
+            except Exception as e:
+                print(f"adding to the document index failed: {e!r}")
+
+    async def stop(self):
+        """Wait for the adds that are still waiting, so they aren't lost on shutdown."""
+        if self._tasks:
+            await asyncio.wait(list(self._tasks))
+
+    async def search_async(self, query: str, k: int = 5, max_age: float = None):
+        return await asyncio.to_thread(self.search, query, k, max_age)
+
+    def stats(self):
+        alive = int(self.alive[:self.count].sum())
+        lookups = self.hits + self.misses
+        return {
+            "chunks": alive,
+            "dead_rows": self.count - alive,
+            "max_chunks": self.max_chunks,
+            "vectors_bytes": self.capacity * self.dim * 4,
+            "added": self.added,
+            "refreshed": self.refreshed,
+            "compactions": self.compactions,
+            "pending_adds": len(self._tasks),
+            "dropped_adds": self.dropped,
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_ratio": self.hits / lookups if lookups else 0.0,
+        }
+
+
+def open_index():
+    """The document index if DOC_INDEX=true; with several workers only the first one gets it (the files can have
+    only one writer), the others go to Tavily as before."""
+    if os.environ.get("DOC_INDEX", "false").lower() != "true":
+        return None
+    path = os.environ.get("DOC_INDEX_PATH", "data/doc_index")
+    os.makedirs(path, exist_ok=True)
+    global _lock_file
+    if fcntl is not None:
+        _lock_file = open(os.path.join(path, "lock"), "w")
+        try:
+            fcntl.flock(_lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except OSError:
+            print(f"document index {path} is used by another worker, this one runs without it")
+            _lock_file.close()
+            return None
+    return DocIndex(path, dim=int(os.environ.get("DOC_INDEX_DIM", 256)),
+                    max_chunks=int(os.environ.get("DOC_INDEX_MAX_CHUNKS", 1_000_000)))
+
+
+if __name__ == "__main__":
+    # query latency at a million chunks; the vectors are random, embedding a million texts would take a while
+    import argparse
+    import tempfile
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--chunks", type=int, default=1_000_000)
+    parser.add_argument("--dim", type=int, default=256)
+    parser.add_argument("--queries", type=int, default=200)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as path:
+        index = DocIndex(path, dim=args.dim, max_chunks=args.chunks)
+        rng = np.random.default_rng(0)
+        start = time.perf_counter()
+        batch = 100_000
+        index._grow(args.chunks)
+        for offset in range(0, args.chunks, batch):
+            n = min(batch, args.chunks - offset)
+            vectors = rng.standard_normal((n, args.dim)).astype(np.float32)
+            index.vectors[offset:offset + n] = vectors / np.linalg.norm(vectors, axis=1, keepdims=True)
+            index.db.execute("BEGIN")
+            index.db.executemany("INSERT INTO docs VALUES (?, ?, ?, ?, ?, ?)",
+                                 [(offset + i, offset + i, f"https://example.com/{offset + i}", f"doc {offset + i}",
+                                   f"content of chunk {offset + i}", time.time()) for i in range(n)])
+            index.db.execute("COMMIT")
+            index.added_at[offset:offset + n] = time.time()
+            index.alive[offset:offset + n] = True
+            index.count += n
+        index.vectors.flush()
+        print(f"built {args.chunks:,} chunks in {time.perf_counter() - start:.1f} s "
+              f"({index.capacity * args.dim * 4 / 2 ** 20:.0f} MB of vectors)")
+
+        for k in (5, 20):
+            latencies = []
+            for i in range(args.queries):
+                start = time.perf_counter()
+                index.search(f"question number {i}", k=k, max_age=3600)
+                latencies.append(time.perf_counter() - start)
+            latencies.sort()
+            print(f"top-{k}: p50 {latencies[len(latencies) // 2] * 1000:.1f} ms, "
+                  f"p95 {latencies[int(len(latencies) * 0.95)] * 1000:.1f} ms, "
+                  f"p99 {latencies[int(len(latencies) * 0.99)] * 1000:.1f} ms")
+
+        start = time.perf_counter()
+        index.add([{"url": "https://example.com/new", "title": "new", "content": "a new search result " * 50}])
+        print(f"incremental add: {(time.perf_counter() - start) * 1000:.1f} ms")
+
+        # drop a third and compact
+        index.alive[:args.chunks // 3] = False
+        index.db.execute("DELETE FROM docs WHERE row < ?", (args.chunks // 3,))
+        start = time.perf_counter()
+        index.compact()
+        print(f"compaction to {index.count:,} chunks: {time.perf_counter() - start:.1f} s")
+        index.db.close()
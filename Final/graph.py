@@ -0,0 +1,117 @@
+import re
+import time
+from typing import Optional, TypedDict
+from langgraph.graph import StateGraph, END
+import metrics
+from metrics import span
+from nodes import simple_response, get_info, search_timings
+
+
+# the agent pipeline behind /ask-question:
+#
+#   router --direct--> direct (llm only, like /query-llm)
+#          --search--> search (tavily + llm)
+#          --deep----> deep_search (sub-query fan-out + llm)
+#
+# the router is a cheap heuristic classifier, so a "hey wassup" doesn't pay for a web search
+
+ROUTES = ("direct", "search", "deep")
+
+# nothing but greetings and thanks; "hey who is X" is a question with a greeting in front, not small talk
+SMALL_TALK = re.compile(r"^(?:\s*(?:hi|hey|hello|yo|sup|wassup|what'?s up|thanks|thank you|thx|"
+                        r"good (?:morning|afternoon|evening|night)|how are (?:you|u)(?: doing)?|bye|goodbye)"
+                        r"(?:\s+(?:there|so much|a lot|very much|again|everyone|all|guys))?[\s,.!?]*)+$",
+                        re.IGNORECASE)
+# tasks that only need the text the user gave, not facts from the web
+NO_FACTS_NEEDED = re.compile(r"^\s*(write|translate|rewrite|rephrase|summari[sz]e|fix|correct|format)\b",
+                             re.IGNORECASE)
+# ... and the text is actually there: after a colon or a line break, or in quotes
+SOURCE_TEXT = re.compile(r"[:\n]\s*\S.{40,}|\"[^\"]{40,}\"", re.DOTALL)
+# "summarize today's news" needs the news first (only the instruction counts, not the dates in the text itself)
+TIME_WORDS = re.compile(r"\b(today|tonight|yesterday|tomorrow|now|latest|current|currently|recent|recently|news|"
+                        r"breaking|this (week|month|year)|(19|20)\d\d)\b", re.IGNORECASE)
+# arithmetic with at least one operator between two numbers; a bare "2024" is a question about the year
+MATH = re.compile(r"^(?:what is|what's|whats|calculate|compute)?\s*(?=[^=]*\d\s*[-+*/^%x]\s*[\d(])"
+                  r"[\d\s+\-*/().^%=x]+\??$", re.IGNORECASE)
+BROAD = re.compile(r"\b(compare|comparison|vs\.?|versus|difference between|differences|pros and cons|history of|"
+                   r"overview of|everything about|in depth|in detail)\b", re.IGNORECASE)
+
+
+def classify(prompt: str):
+    """Pick a route for the prompt: direct, search or deep."""
+    if SMALL_TALK.match(prompt) or MATH.match(prompt.strip()):
+        return "direct"
+    source = SOURCE_TEXT.search(prompt)
+    if NO_FACTS_NEEDED.match(prompt) and source and not TIME_WORDS.search(prompt[:source.start()]):
+        return "direct"
+    if BROAD.search(prompt) or len(prompt.split()) > 25:
+        return "deep"
+    return "search"
+
+
+class AgentState(TypedDict):
+    prompt: str
+    use_cache: bool
+    # set by the router (or given by the request to override it)
+    route: Optional[str]
+    # read the result pages instead of only the snippets (see pages.py)
+    read_pages: bool
+    response: Optional[str]
+
+
+def choose_route(prompt: str, override: str = None):
+    """The route for a prompt (the override wins if there is one), counted in the router metrics."""
+    with span("router") as attributes:
+        route = override or classify(prompt)
+        attributes["route"] = route
+    metrics.router_decisions.inc(route=route, overridden=override is not None)
+    if route == "direct":
+        # what the search would have cost on average
+        timing = search_timings["single"]
+        if timing["count"]:
+            metrics.router_latency_saved.inc(timing["seconds"] / timing["count"])
+    return route
+
+
+def router(state: AgentState):
+    return {"route": choose_route(state["prompt"], state.get("route"))}
+
+
+async def direct(state: AgentState):
+    return {"response": await simple_response(state["prompt"])}
+
+
+async def search(state: AgentState):
+    return {"response": await get_info(state["prompt"], state["use_cache"], read_pages=state["read_pages"])}
+
+
+async def deep_search(state: AgentState):
+    return {"response": await get_info(state["prompt"], state["use_cache"], fan_out=True,
+                                         read_pages=state["read_pages"])}
+
+
+builder = StateGraph(AgentState)
+builder.add_node("router", router)
+builder.add_node("direct", direct)
+builder.add_node("search", search)
+builder.add_node("deep_search", deep_search)
+builder.set_entry_point("router")
+builder.add_conditional_edges("router", lambda state: state["route"],
+                              {"direct": "direct", "search": "search", "deep": "deep_search"})
+builder.add_edge("direct", END)
+builder.add_edge("search", END)
+builder.add_edge("deep_search", END)
+agent = builder.compile()
+
+
+async def run_agent(prompt: str, use_cache: bool = True, route: str = None, read_pages: bool = False):
+    state = await agent.ainvoke({"prompt": prompt, "use_cache": use_cache, "route": route, "read_pages": read_pages,
+                                 "response": None})
+    return state["response"]
+
+
+if __name__ == "__main__":
+    for p in ["hey wassup", "who is dimebag darrell", "compare pantera and metallica", "translate hello to dutch",
+              "12 * (3 + 4)"]:
+        start = time.perf_counter()
+        print(f"{classify(p):7} {p}  ({(time.perf_counter() - start) * 1e6:.0f} us)")
@@ -0,0 +1,306 @@
+import asyncio
+import json
+import os
+import random
+import sqlite3
+import threading
+import time
+import uuid
+from admission import Overloaded, priority
+from resilience import CircuitOpenError
+
+
+class JobQueue:
+    """Durable queue for big batches of questions, in SQLite, worked off by a few tasks inside the backend.
+
+    Every prompt is an item; a worker leases one item at a time and writes its answer back right away, so a crash
+    or restart loses at most the items that were being answered, and those are picked up again once their lease
+    runs out (or right away after a clean shutdown). Several worker processes can share the file. The work runs
+    with the batch priority and pauses while the live traffic is busy, so interactive users go first.
+
+    An item that fails is tried again after a backoff (retry_backoff, doubled per attempt, at most retry_max), and
+    after max_attempts attempts (crashed workers included) it is given up with its last error.
+    """
+
+    def __init__(self, path: str, compute, workers: int = 2, lease: float = 120, max_attempts: int = 3,
+                 poll: float = 1, busy=lambda: False, retry_backoff: float = 5, retry_max: float = 300):
+        self.path = path
+        self.compute = compute
+        self.workers = workers
+        self.lease = lease
+        self.max_attempts = max_attempts
+        self.retry_backoff = retry_backoff
+        self.retry_max = retry_max
+        self.poll = poll
+        self.busy = busy
+        self.owner = uuid.uuid4().hex
+        self._local = threading.local()
+        self._tasks = []
+        self._wake = asyncio.Event()
+        self.answered = 0
+        self.errors = 0
+
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        db = self._db()
+        db.execute("PRAGMA journal_mode=WAL")
+        db.execute("CREATE TABLE IF NOT EXISTS jobs (id TEXT PRIMARY KEY, status TEXT, use_cache INTEGER, "
+                   "total INTEGER, done INTEGER DEFAULT 0, failed INTEGER DEFAULT 0, created_at REAL, "
+                   "updated_at REAL)")
+        db.execute("CREATE TABLE IF NOT EXISTS items (job_id TEXT, idx INTEGER, prompt TEXT, status TEXT, "
+                   "response TEXT, error TEXT, attempts INTEGER DEFAULT 0, lease_owner TEXT, lease_until REAL, "
+                   "available_at REAL DEFAULT 0, PRIMARY KEY (job_id, idx))")
+        if "available_at" not in [column[1] for column in db.execute("PRAGMA table_info(items)")]:
+            # a file from before the retry backoff
+            db.execute("ALTER TABLE items ADD COLUMN available_at REAL DEFAULT 0")
+        # the rowid of an item is its place in the queue (oldest job first, then by index), and an index on status
+        # keeps the rowids of every status in order: the next pending item is the first index entry, no sorting
+        db.execute("CREATE INDEX IF NOT EXISTS items_queue ON items (status)")
+        db.execute("CREATE INDEX IF NOT EXISTS items_todo ON items (status, lease_until)")
+
+    def _db(self):
+        # one connection per thread, like the shared cache
+        db = getattr(self._local, "db", None)
+        if db is None:
+            db = sqlite3.connect(self.path, isolation_level=None, timeout=10)
+            db.execute("PRAGMA synchronous=NORMAL")
+            self._local.db = db
+        return db
+
+    # --- the API side ---
+
+    def _submit(self, prompts: list, use_cache: bool):
+        job_id = uuid.uuid4().hex
+        now = time.time()
+        db = self._db()
+        db.execute("BEGIN")
+        db.execute("INSERT INTO jobs (id, status, use_cache, total, created_at, updated_at) VALUES (?, ?, ?, ?, ?, ?)",
+                   (job_id, "queued" if prompts else "done", int(use_cache), len(prompts), now, now))
+        db.executemany("INSERT INTO items (job_id, idx, prompt, status) VALUES (?, ?, ?, 'pending')",
+                       [(job_id, i, prompt) for i, prompt in enumerate(prompts)])
+        db.execute("COMMIT")
+        return job_id
+
+    async def submit(self, prompts: list, use_cache: bool = True):
+        job_id = await asyncio.to_thread(self._submit, prompts, use_cache)
+        self._wake.set()
+        return job_id
+
+    def _job(self, job_id: str):
+        row = self._db().execute("SELECT id, status, total, done, failed, created_at, updated_at FROM jobs "
+                                 "WHERE id = ?", (job_id,)).fetchone()
+        if row is None:
+            return None
+        job = dict(zip(("job_id", "status", "total", "done", "failed", "created_at", "updated_at"), row))
+        job["progress"] = (job["done"] + job["failed"]) / job["total"] if job["total"] else 1.0
+        return job
+
+    async def job(self, job_id: str):
+        return await asyncio.to_thread(self._job, job_id)
+
+    def _jobs(self, limit: int):
+        ids = self._db().execute("SELECT id FROM jobs ORDER BY created_at DESC LIMIT ?", (limit,)).fetchall()
+        return [self._job(job_id) for job_id, in ids]
+
+    async def jobs(self, limit: int = 50):
+        return await asyncio.to_thread(self._jobs, limit)
+
+    def _cancel(self, job_id: str):
+        # items that are being answered right now still finish, nothing new is started
+        db = self._db()
+        db.execute("BEGIN IMMEDIATE")
+        try:
+            cancelled = db.execute("UPDATE jobs SET status = 'cancelled', updated_at = ? WHERE id = ? "
+                                   "AND status IN ('queued', 'running')", (time.time(), job_id)).rowcount == 1
+            if cancelled:
+                db.execute("UPDATE items SET status = 'cancelled' WHERE job_id = ? AND status = 'pending'", (job_id,))
+            db.execute("COMMIT")
+        except BaseException:
+            db.execute("ROLLBACK")
+            raise
+        return cancelled
+
+    async def cancel(self, job_id: str):
+        return await asyncio.to_thread(self._cancel, job_id)
+
+    def _results(self, job_id: str, after: int, limit: int):
+        return self._db().execute("SELECT idx, prompt, status, response, error FROM items WHERE job_id = ? "
+                                  "AND idx > ? AND status IN ('done', 'error') ORDER BY idx LIMIT ?",
+                                  (job_id, after, limit)).fetchall()
+
+    async def results(self, job_id: str, page: int = 500):
+        """The finished items of the job as JSON lines, read page by page so a big job is never all in memory."""
+        after = -1
+        while True:
+            rows = await asyncio.to_thread(self._results, job_id, after, page)
+            for idx, prompt, status, response, error in rows:
+                item = {"index": idx, "prompt": prompt}
+                item.update({"response": response} if status == "done" else {"error": error})
+                yield json.dumps(item) + "\n"
+            if len(rows) < page:
+                return
+            after = rows[-1][0]
+
+    async def progress(self, job_id: str, interval: float = 1):
+        """Progress events of the job until it is finished (NDJSON, like the other streaming endpoints)."""
+        while True:
+            job = await self.job(job_id)
+            yield json.dumps({"event": "progress", "data": job}) + "\n"
+            if job is None or job["status"] in ("done", "cancelled"):
+                return
+            await asyncio.sleep(interval)
+
+    # --- the worker side ---
+
+    def _claim(self):
+        now = time.time()
+        db = self._db()
+        db.execute("BEGIN IMMEDIATE")
+        try:
+            while True:
+                # items whose worker died (the lease ran out) first, they are the oldest; then the queue in order.
+                # an item waiting for its retry is skipped, those are few
+                row = db.execute("SELECT rowid, job_id, idx, prompt, attempts FROM items WHERE status = 'running' "
+                                 "AND lease_until < ? LIMIT 1", (now,)).fetchone()
+                if row is None:
+                    row = db.execute("SELECT rowid, job_id, idx, prompt, attempts FROM items "
+                                     "WHERE status = 'pending' AND available_at <= ? ORDER BY rowid LIMIT 1",
+                                     (now,)).fetchone()
+                if row is None:
+                    break
+                rowid, job_id, idx, prompt, attempts = row
+                job = db.execute("SELECT status, use_cache FROM jobs WHERE id = ?", (job_id,)).fetchone()
+                if job is None or job[0] not in ("queued", "running"):
+                    # a lease that ran out on an item of a cancelled job
+                    db.execute("UPDATE items SET status = 'cancelled' WHERE rowid = ?", (rowid,))
+                    continue
+                if attempts >= self.max_attempts:
+                    # its worker died every time (or it was retried until the end); don't try it forever
+                    self._give_up(db, job_id, idx, f"gave up after {attempts} attempts", now)
+                    continue
+                db.execute("UPDATE items SET status = 'running', lease_owner = ?, lease_until = ?, "
+                           "attempts = attempts + 1 WHERE rowid = ?", (self.owner, now + self.lease, rowid))
+                db.execute("UPDATE jobs SET status = 'running', updated_at = ? WHERE id = ? AND status = 'queued'",
+                           (now, job_id))
+                row = (job_id, idx, prompt, attempts, job[1])
+                break
+            db.execute("COMMIT")
+        except BaseException:
+            db.execute("ROLLBACK")
+            raise
+        return row
+
+    def _give_up(self, db, job_id: str, idx: int, error: str, now: float):
+        db.execute("UPDATE items SET status = 'error', error = COALESCE(error, ?), lease_until = NULL "
+                   "WHERE job_id = ? AND idx = ?", (error, job_id, idx))
+        self._count(db, job_id, 0, 1, now)
+
+    def _count(self, db, job_id: str, done: int, failed: int, now: float):
+        db.execute("UPDATE jobs SET done = done + ?, failed = failed + ?, updated_at = ?, status = CASE "
+                   "WHEN done + failed + 1 >= total AND status = 'running' THEN 'done' ELSE status END "
+                   "WHERE id = ?", (done, failed, now, job_id))
+
+    def _finish(self, job_id: str, idx: int, response: str = None, error: str = None):
+        now = time.time()
+        db = self._db()
+        db.execute("BEGIN IMMEDIATE")
+        try:
+            # only if the lease is still ours; otherwise another worker took over and will write it
+            updated = db.execute("UPDATE items SET status = ?, response = ?, error = ?, lease_until = NULL "
+                                 "WHERE job_id = ? AND idx = ? AND status = 'running' AND lease_owner = ?",
+                                 ("done" if error is None else "error", response, error, job_id, idx,
+                                  self.owner)).rowcount
+            if updated:
+                done, failed = (1, 0) if error is None else (0, 1)
+                self._count(db, job_id, done, failed, now)
+            db.execute("COMMIT")
+        except BaseException:
+            db.execute("ROLLBACK")
+            raise
+
+    def _release(self, job_id: str = None, idx: int = None, uncount: bool = False, delay: float = 0,
+                 error: str = None):
+        # give leased items back instead of waiting for the lease to run out; delay: not before that many seconds
+        # uncount: the attempt didn't get to the item (overload, open circuit) and doesn't count
+        attempts = ", attempts = attempts - 1" if uncount else ""
+        query = (f"UPDATE items SET status = 'pending', lease_until = NULL, available_at = ?, "
+                 f"error = COALESCE(?, error){attempts} WHERE status = 'running' AND lease_owner = ?")
+        params = [time.time() + delay, error, self.owner]
+        if job_id is not None:
+            query += " AND job_id = ? AND idx = ?"
+            params += [job_id, idx]
+        self._db().execute(query, params)
+
+    def backoff(self, attempt: int):
+        """Seconds before the next try after a failed attempt (1, 2, ...): exponential with full jitter."""
+        return random.uniform(0, min(self.retry_max, self.retry_backoff * 2 ** (attempt - 1)))
+
+    async def _work(self):
+        while True:
+            if self.busy():
+                await asyncio.sleep(self.poll)
+                continue
+            item = await asyncio.to_thread(self._claim)
+            if item is None:
+                self._wake.clear()
+                try:
+                    await asyncio.wait_for(self._wake.wait(), self.poll)
+                except asyncio.TimeoutError:
+                    pass
+                continue
+
+            job_id, idx, prompt, attempts, use_cache = item
+            try:
+                with priority("batch"):
+                    response = await self.compute(prompt, bool(use_cache))
+            except asyncio.CancelledError:
+                await asyncio.to_thread(self._release, job_id, idx)
+                raise
+            except (Overloaded, CircuitOpenError) as e:
+                # not the fault of the item; put it back (without counting it) and give the upstream a break
+                await asyncio.to_thread(self._release, job_id, idx, True, e.retry_after)
+                await asyncio.sleep(max(e.retry_after, self.poll))
+                continue
+            except Exception as e:
+                if attempts + 1 < self.max_attempts:
+                    # again later, not right away: whatever failed it is probably still failing
+                    await asyncio.to_thread(self._release, job_id, idx, False, self.backoff(attempts + 1),
+                                            str(e) or repr(e))
+                    continue
+                self.errors += 1
+                await asyncio.to_thread(self._finish, job_id, idx, None, str(e) or repr(e))
+                continue
+            self.answered += 1
+            await asyncio.to_thread(self._finish, job_id, idx, response)
+
+    def start(self):
+        self._tasks = [asyncio.create_task(self._work()) for _ in range(self.workers)]
+
+    async def stop(self):
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        await asyncio.to_thread(self._release)
+
+    def _counts(self):
+        return dict(self._db().execute("SELECT status, COUNT(*) FROM items GROUP BY status").fetchall())
+
+    async def stats(self):
+        return {"workers": self.workers, "answered": self.answered, "errors": self.errors,
+                "items": await asyncio.to_thread(self._counts)}
+
+
+def parse_jsonl(body: bytes):
+    """Prompts out of a JSONL body: one {"prompt": "..."} object (or just a JSON string) per line."""
+    prompts = []
+    for number, line in enumerate(body.decode().splitlines(), 1):
+        if not line.strip():
+            continue
+        try:
+            item = json.loads(line)
+        except ValueError:
+            raise ValueError(f"line {number} is not valid JSON")
+        prompt = item.get("prompt") if isinstance(item, dict) else item
+        if not isinstance(prompt, str) or not prompt.strip():
+            raise ValueError(f"line {number} has no prompt")
+        prompts.append(prompt)
+    return prompts
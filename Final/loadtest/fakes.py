@@ -0,0 +1,153 @@
+import asyncio
+import json
+import math
+import os
+import random
+import zlib
+from langchain_core.messages import AIMessage, AIMessageChunk
+
+
+# stand-ins for AsyncTavilyClient and ChatOpenAI, so the backend can be load tested without paying for the real
+# services. they are switched on with UPSTREAM_MODE=fake (see clients.py) and configured with these env variables
+def _env(name: str, default: float):
+    return float(os.environ.get(name, default))
+
+
+def _latency(median_ms: float, sigma: float):
+    """Log-normal latency in seconds; most calls are close to the median, a few are much slower (like real APIs)."""
+    return random.lognormvariate(math.log(median_ms / 1000), sigma) if median_ms > 0 else 0
+
+
+class InjectedError(Exception):
+    pass
+
+
+def _load_replay(path: str):
+    """Read a file written by the Recording* wrappers into {key: response}."""
+    replay = {}
+    if path and os.path.exists(path):
+        with open(path) as f:
+            for line in f:
+                record = json.loads(line)
+                replay[record["key"]] = record["response"]
+    return replay
+
+
+def _text(messages):
+    if isinstance(messages, str):
+        return messages
+    return "\n".join(m.content if hasattr(m, "content") else str(m) for m in messages)
+
+
+class FakeTavilyClient:
+    def __init__(self, latency_ms: float = None, sigma: float = None, error_rate: float = None,
+                 replay_path: str = None):
+        self.latency_ms = _env("FAKE_TAVILY_LATENCY_MS", 800) if latency_ms is None else latency_ms
+        self.sigma = _env("FAKE_LATENCY_SIGMA", 0.5) if sigma is None else sigma
+        self.error_rate = _env("FAKE_TAVILY_ERROR_RATE", 0) if error_rate is None else error_rate
+        self.replay = _load_replay(replay_path or os.environ.get("FAKE_TAVILY_REPLAY"))
+        # with the page stand-in running (python -m loadtest.page_server), the results link to its fixture pages;
+        # the last one links to a page that is too slow, to see it dropped
+        self.pages_url = os.environ.get("FAKE_PAGES_URL", "").rstrip("/")
+        fixtures = os.path.join(os.path.dirname(__file__), "fixtures")
+        self.pages = sorted(name for name in os.listdir(fixtures) if name.endswith(".html"))
+
+    def _url(self, seed: int, i: int):
+        if not self.pages_url:
+            return f"https://example.com/{seed}/{i}"
+        return f"{self.pages_url}/{'slow/' if i == 4 else ''}{self.pages[(seed + i) % len(self.pages)]}"
+
+    async def search(self, query: str, **kwargs):
+        await asyncio.sleep(_latency(self.latency_ms, self.sigma))
+        if random.random() < self.error_rate:
+            raise InjectedError("injected tavily error")
+        if query in self.replay:
+            return self.replay[query]
+
+        # made up but deterministic results, so the caches behave the same as with the real thing
+        seed = zlib.crc32(query.encode())
+        results = []
+        for i in range(5):
+            results.append({
+                "title": f"Result {i + 1} for {query}",
+                "url": self._url(seed, i),
+                "content": f"{query} ({i}). " + " ".join(f"word{(seed + i * j) % 97}" for j in range(60)),
+                "score": round(1 - i * 0.15, 2),
+            })
+        return {"query": query, "results": results}
+
+
+class FakeChatModel:
+    """Answers with filler text; the first token comes after a latency sample and then tokens_per_second."""
+
+    def __init__(self, latency_ms: float = None, sigma: float = None, tokens: int = None,
+                 tokens_per_second: float = None, error_rate: float = None, replay_path: str = None):
+        self.latency_ms = _env("FAKE_LLM_LATENCY_MS", 400) if latency_ms is None else latency_ms
+        self.sigma = _env("FAKE_LATENCY_SIGMA", 0.5) if sigma is None else sigma
+        self.tokens = int(_env("FAKE_LLM_TOKENS", 150)) if tokens is None else tokens
+        self.tokens_per_second = _env("FAKE_LLM_TOKENS_PER_S", 80) if tokens_per_second is None else tokens_per_second
+        self.error_rate = _env("FAKE_LLM_ERROR_RATE", 0) if error_rate is None else error_rate
+        self.replay = _load_replay(replay_path or os.environ.get("FAKE_LLM_REPLAY"))
+
+    def _tokens(self, messages):
+        text = _text(messages)
+        if text in self.replay:
+            words = self.replay[text].split(" ")
+            return [w + " " for w in words[:-1]] + words[-1:]
+        return [f"token{i} " for i in range(self.tokens)]
+
+    async def ainvoke(self, messages, **kwargs):
+        tokens = []
+        async for chunk in self.astream(messages):
+            tokens.append(chunk.content)
+        return AIMessage(content="".join(tokens))
+
+    async def astream(self, messages, **kwargs):
+        await asyncio.sleep(_latency(self.latency_ms, self.sigma))
+        if random.random() < self.error_rate:
+            raise InjectedError("injected llm error")
+        delay = 1 / self.tokens_per_second if self.tokens_per_second > 0 else 0
+        for token in self._tokens(messages):
+            yield AIMessageChunk(content=token)
+            await asyncio.sleep(delay)
+
+
+class RecordingTavilyClient:
+    """Wraps the real client and appends every search to a JSONL file that FakeTavilyClient can replay."""
+
+    def __init__(self, client, path: str):
+        self.client = client
+        self.path = path
+
+    async def search(self, query: str, **kwargs):
+        response = await self.client.search(query, **kwargs)
+        with open(self.path, "a") as f:
+            f.write(json.dumps({"key": query, "response": response}) + "\n")
+        return response
+
+
+class RecordingChatModel:
+    """Same for the llm; only the final text is recorded, the replay streams it again at the configured rate."""
+
+    def __init__(self, model, path: str):
+        self.model = model
+        self.path = path
+
+    def _record(self, messages, text: str):
+        with open(self.path, "a") as f:
+            f.write(json.dumps({"key": _text(messages), "response": text}) + "\n")
+
+    async def ainvoke(self, messages, **kwargs):
+        response = await self.model.ainvoke(messages, **kwargs)
+        self._record(messages, response.content)
+        return response
+
+    async def astream(self, messages, **kwargs):
+        text = ""
+        async for chunk in self.model.astream(messages, **kwargs):
+            text += chunk.content
+            yield chunk
+        self._record(messages, text)
+
+    def __getattr__(self, name):
+        return getattr(self.model, name)
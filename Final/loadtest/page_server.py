@@ -0,0 +1,83 @@
+"""Local stand-in for the web pages behind the search results, for trying out the read_pages mode offline.
+
+    python -m loadtest.page_server --port 8090
+    UPSTREAM_MODE=fake FAKE_PAGES_URL=http://localhost:8090 uvicorn main:app
+
+The fake tavily results then point to the pages in loadtest/fixtures. Besides the fixtures there are a few pages
+that misbehave on purpose:
+
+    /slow/<page>   answers after --slow-ms (should be dropped by the fetcher)
+    /big           an endless page (should be cut off at PAGE_MAX_BYTES)
+    /binary        not a text page (should be skipped)
+"""
+import argparse
+import os
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlparse
+from loadtest.fakes import _latency
+
+
+FIXTURES = os.path.join(os.path.dirname(__file__), "fixtures")
+
+
+def fixture_names():
+    return sorted(name for name in os.listdir(FIXTURES) if name.endswith(".html"))
+
+
+class PageHandler(BaseHTTPRequestHandler):
+    latency_ms = 100
+    sigma = 0.5
+    slow_ms = 10_000
+
+    def _send(self, status: int, body: bytes, content_type: str = "text/html; charset=utf-8"):
+        self.send_response(status)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        path = urlparse(self.path).path
+        time.sleep(_latency(self.latency_ms, self.sigma))
+
+        if path == "/big":
+            self.send_response(200)
+            self.send_header("Content-Type", "text/html")
+            self.end_headers()
+            paragraph = b"<p>" + b"filler text of an endless page " * 30 + b"</p>\n"
+            try:
+                self.wfile.write(b"<html><body>")
+                # about 100MB; the fetcher should hang up long before that
+                for _ in range(100_000):
+                    self.wfile.write(paragraph)
+            except (BrokenPipeError, ConnectionResetError):
+                pass
+            return
+        if path == "/binary":
+            return self._send(200, b"%PDF-1.4 not really a pdf", "application/pdf")
+        if path.startswith("/slow/"):
+            time.sleep(self.slow_ms / 1000)
+            path = path[len("/slow"):]
+
+        name = os.path.basename(path)
+        if name not in fixture_names():
+            return self._send(404, b"<html><body>not found</body></html>")
+        with open(os.path.join(FIXTURES, name), "rb") as f:
+            self._send(200, f.read())
+
+    def log_message(self, format, *args):
+        pass
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--port", type=int, default=8090)
+    parser.add_argument("--latency-ms", type=float, default=100, help="median latency of a page (log-normal)")
+    parser.add_argument("--slow-ms", type=float, default=10_000, help="extra latency of the /slow/ pages")
+    args = parser.parse_args()
+
+    PageHandler.latency_ms = args.latency_ms
+    PageHandler.slow_ms = args.slow_ms
+    print(f"serving {', '.join(fixture_names())} on http://localhost:{args.port}")
+    ThreadingHTTPServer(("", args.port), PageHandler).serve_forever()
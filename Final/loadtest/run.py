@@ -0,0 +1,137 @@
+"""Load generator for the backend.
+
+Start the backend with the local stand-ins, then run this from the Final directory:
+
+    UPSTREAM_MODE=fake uvicorn main:app
+    python -m loadtest.run --rps 20 --duration 30 --out results.json
+    python -m loadtest.run --compare old.json results.json
+"""
+import argparse
+import asyncio
+import json
+import random
+import time
+import httpx
+
+
+PROMPTS = [
+    "who is dimebag darrell",
+    "What is the capital of France?",
+    "latest news about the James Webb telescope",
+    "how do transformers work in machine learning",
+    "hey wassup",
+    "compare python and rust",
+    "who won the last world cup",
+    "explain the stock market in simple terms",
+]
+
+
+def percentile(values: list, p: float):
+    if not values:
+        return None
+    ordered = sorted(values)
+    return ordered[min(int(round(p / 100 * (len(ordered) - 1))), len(ordered) - 1)]
+
+
+def make_request(endpoint: str, prompts: list, key_name: str):
+    if endpoint == "/api-key-setup":
+        return {"name": key_name, "key": "loadtest-" + str(random.randint(0, 10 ** 6))}
+    return {"prompt": random.choice(prompts)}
+
+
+async def run(base_url: str, rps: float, duration: float, mix: dict, prompts: list, key_name: str, timeout: float):
+    samples = {endpoint: [] for endpoint in mix}
+    endpoints, weights = list(mix), list(mix.values())
+    limits = httpx.Limits(max_connections=1000, max_keepalive_connections=200)
+
+    async with httpx.AsyncClient(base_url=base_url, timeout=timeout, limits=limits) as client:
+        async def one(endpoint: str):
+            start = time.perf_counter()
+            try:
+                response = await client.post(endpoint, json=make_request(endpoint, prompts, key_name))
+                status = response.status_code
+            except httpx.HTTPError as e:
+                status = type(e).__name__
+            samples[endpoint].append((time.perf_counter() - start, status))
+
+        # open loop: requests are started on schedule (poisson arrivals) whether the earlier ones are done or not,
+        # otherwise a slow server would quietly lower the load it gets
+        tasks = []
+        start = time.perf_counter()
+        next_at = start
+        while next_at - start < duration:
+            await asyncio.sleep(max(next_at - time.perf_counter(), 0))
+            tasks.append(asyncio.create_task(one(random.choices(endpoints, weights)[0])))
+            next_at += random.expovariate(rps)
+        await asyncio.gather(*tasks)
+        elapsed = time.perf_counter() - start
+
+    return summarize(samples, elapsed, {"base_url": base_url, "rps": rps, "duration": duration, "mix": mix})
+
+
+def summarize(samples: dict, elapsed: float, config: dict):
+    report = {"config": config, "elapsed_s": round(elapsed, 2), "endpoints": {}}
+    for endpoint, results in samples.items():
+        ok = [latency for latency, status in results if status == 200]
+        errors = {}
+        for _, status in results:
+            if status != 200:
+                errors[str(status)] = errors.get(str(status), 0) + 1
+        report["endpoints"][endpoint] = {
+            "requests": len(results),
+            "throughput_rps": round(len(ok) / elapsed, 2) if elapsed else 0,
+            "error_rate": round(1 - len(ok) / len(results), 4) if results else 0,
+            "errors": errors,
+            "p50_ms": None if not ok else round(percentile(ok, 50) * 1000, 1),
+            "p95_ms": None if not ok else round(percentile(ok, 95) * 1000, 1),
+            "p99_ms": None if not ok else round(percentile(ok, 99) * 1000, 1),
+        }
+    return report
+
+
+def compare(old: dict, new: dict):
+    """Print the change of every metric between two result files."""
+    for endpoint, stats in new["endpoints"].items():
+        before = old["endpoints"].get(endpoint, {})
+        print(endpoint)
+        for metric in ("throughput_rps", "error_rate", "p50_ms", "p95_ms", "p99_ms"):
+            a, b = before.get(metric), stats.get(metric)
+            change = f"{(b - a) / a * 100:+.1f}%" if a and b is not None else "n/a"
+            print(f"  {metric:15} {a!s:>10} -> {b!s:>10}  ({change})")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Drive the backend at a target request rate")
+    parser.add_argument("--url", default="http://127.0.0.1:8000")
+    parser.add_argument("--rps", type=float, default=10)
+    parser.add_argument("--duration", type=float, default=30, help="seconds")
+    parser.add_argument("--mix", default="/ask-question=0.7,/query-llm=0.29,/api-key-setup=0.01",
+                        help="endpoint=weight pairs")
+    parser.add_argument("--prompts", help="text file with one prompt per line (default: a small built-in set)")
+    parser.add_argument("--key-name", default="LOADTEST_API_KEY",
+                        help="env variable /api-key-setup sets; use OPENAI_API_KEY to also load the client rebuild")
+    parser.add_argument("--timeout", type=float, default=60)
+    parser.add_argument("--out", help="write the results as JSON to this file")
+    parser.add_argument("--compare", nargs=2, metavar=("OLD", "NEW"), help="compare two result files and exit")
+    args = parser.parse_args()
+
+    if args.compare:
+        with open(args.compare[0]) as a, open(args.compare[1]) as b:
+            compare(json.load(a), json.load(b))
+        return
+
+    mix = {pair.split("=")[0]: float(pair.split("=")[1]) for pair in args.mix.split(",")}
+    prompts = PROMPTS
+    if args.prompts:
+        with open(args.prompts) as f:
+            prompts = [line.strip() for line in f if line.strip()]
+
+    report = asyncio.run(run(args.url, args.rps, args.duration, mix, prompts, args.key_name, args.timeout))
+    print(json.dumps(report, indent=2))
+    if args.out:
+        with open(args.out, "w") as f:
+            json.dump(report, f, indent=2, sort_keys=True)
+
+
+if __name__ == "__main__":
+    main()
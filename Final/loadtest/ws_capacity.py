@@ -0,0 +1,164 @@
+"""How many chat sessions the WebSocket endpoint holds, and what an idle one costs.
+
+Start the backend with the local stand-ins, then run this from the Final directory:
+
+    UPSTREAM_MODE=fake uvicorn main:app
+    python -m loadtest.ws_capacity --connections 5000 --active 50 --pid <pid of uvicorn>
+
+Opens the connections (a batch at a time), keeps them all open and measures while they are idle: the round trip of
+a ping over a sample of them, and a prompt per session on --active of them (time to first token, cancelling an
+answer with a new prompt). The prompts skip the answer cache, so every one of them reaches the (fake) upstreams.
+With --pid the memory of the server is read before and after, so the cost of one idle connection can be worked out;
+with --compare-http the same prompts are also sent as one POST each, on a new connection, for reference.
+Every connection is a file descriptor on both sides, so raise `ulimit -n` for big runs.
+"""
+import argparse
+import asyncio
+import json
+import resource
+import time
+import httpx
+from websockets.asyncio.client import connect
+from loadtest.run import PROMPTS, percentile
+
+
+def rss_mb(pid: int):
+    with open(f"/proc/{pid}/status") as f:
+        for line in f:
+            if line.startswith("VmRSS:"):
+                return int(line.split()[1]) / 1024
+
+
+def summary(values: list):
+    if not values:
+        return "-"
+    return (f"p50 {percentile(values, 50) * 1000:.1f} ms  p99 {percentile(values, 99) * 1000:.1f} ms  "
+            f"max {max(values) * 1000:.1f} ms")
+
+
+async def receive_until(ws, events: tuple):
+    while True:
+        event = json.loads(await ws.recv())
+        if event["event"] in events:
+            return event
+
+
+async def open_connections(url: str, count: int, batch: int, timeout: float):
+    connections, times, errors = [], [], {}
+
+    async def one():
+        start = time.perf_counter()
+        try:
+            # no protocol pings from the client, the server decides about the heartbeat
+            ws = await asyncio.wait_for(connect(url, ping_interval=None, max_queue=16), timeout)
+        except Exception as e:
+            errors[type(e).__name__] = errors.get(type(e).__name__, 0) + 1
+            return
+        times.append(time.perf_counter() - start)
+        connections.append(ws)
+
+    for start in range(0, count, batch):
+        await asyncio.gather(*(one() for _ in range(min(batch, count - start))))
+    return connections, times, errors
+
+
+async def ping(ws):
+    start = time.perf_counter()
+    await ws.send(json.dumps({"type": "ping"}))
+    await receive_until(ws, ("pong",))
+    return time.perf_counter() - start
+
+
+async def turn(ws, prompt: str):
+    """Time to first token and to the done event of one prompt."""
+    start = time.perf_counter()
+    await ws.send(json.dumps({"prompt": prompt, "use_cache": False}))
+    first = None
+    while True:
+        event = json.loads(await ws.recv())
+        if event["event"] == "token" and first is None:
+            first = time.perf_counter() - start
+        elif event["event"] in ("done", "error"):
+            return first, time.perf_counter() - start
+
+
+async def cancel(ws, prompt: str):
+    """Send a prompt, replace it with another one as soon as it answers; the time until the first is cancelled."""
+    await ws.send(json.dumps({"prompt": prompt, "use_cache": False, "id": "old"}))
+    await receive_until(ws, ("token", "done"))
+    start = time.perf_counter()
+    await ws.send(json.dumps({"prompt": prompt, "use_cache": False, "id": "new"}))
+    event = await receive_until(ws, ("cancelled", "done"))
+    elapsed = time.perf_counter() - start
+    await receive_until(ws, ("done",))
+    return elapsed if event["event"] == "cancelled" else None
+
+
+async def http_turn(base_url: str, prompt: str, timeout: float):
+    # a fresh connection per prompt, like a client without a session
+    start = time.perf_counter()
+    first = None
+    async with httpx.AsyncClient(base_url=base_url, timeout=timeout) as client:
+        payload = {"prompt": prompt, "use_cache": False}
+        async with client.stream("POST", "/ask-question/stream", json=payload) as response:
+            async for line in response.aiter_lines():
+                if line and first is None and json.loads(line)["event"] == "token":
+                    first = time.perf_counter() - start
+    return first, time.perf_counter() - start
+
+
+async def main(args):
+    base_url = args.url.replace("ws://", "http://").replace("wss://", "https://").split("/ws/")[0]
+    before = rss_mb(args.pid) if args.pid else None
+
+    start = time.perf_counter()
+    connections, connect_times, errors = await open_connections(args.url, args.connections, args.batch, args.timeout)
+    print(f"connected:      {len(connections)} of {args.connections} in {time.perf_counter() - start:.1f} s"
+          f"{'  failed: ' + str(errors) if errors else ''}")
+    print(f"connect:        {summary(connect_times)}")
+    await asyncio.sleep(args.hold)
+
+    if args.pid:
+        after = rss_mb(args.pid)
+        per_connection = (after - before) * 1024 / max(len(connections), 1)
+        print(f"server memory:  {before:.0f} MB -> {after:.0f} MB ({per_connection:.1f} KB per idle connection)")
+
+    sample = connections[::max(len(connections) // args.sample, 1)]
+    pings = await asyncio.gather(*(ping(ws) for ws in sample))
+    print(f"ping ({len(sample)}):     {summary(pings)}")
+
+    active = connections[:args.active]
+    turns = await asyncio.gather(*(turn(ws, PROMPTS[i % len(PROMPTS)]) for i, ws in enumerate(active)))
+    print(f"ttft ({len(active)}):      {summary([first for first, _ in turns if first is not None])}")
+    print(f"answer ({len(active)}):    {summary([total for _, total in turns])}")
+    cancels = await asyncio.gather(*(cancel(ws, PROMPTS[i % len(PROMPTS)]) for i, ws in enumerate(active)))
+    print(f"cancel ({len(active)}):    {summary([c for c in cancels if c is not None])}")
+
+    if args.compare_http:
+        http = await asyncio.gather(*(http_turn(base_url, PROMPTS[i % len(PROMPTS)], args.timeout)
+                                      for i in range(len(active))))
+        print(f"http ttft:      {summary([first for first, _ in http if first is not None])}")
+        print(f"http answer:    {summary([total for _, total in http])}")
+
+    async with httpx.AsyncClient(base_url=base_url) as client:
+        print(f"server:         {(await client.get('/chat-stats')).json()}")
+    await asyncio.gather(*(ws.close() for ws in connections), return_exceptions=True)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Concurrent connection capacity of the WebSocket chat")
+    parser.add_argument("--url", default="ws://127.0.0.1:8000/ws/chat")
+    parser.add_argument("--connections", type=int, default=1000)
+    parser.add_argument("--batch", type=int, default=200, help="connections opened at the same time")
+    parser.add_argument("--hold", type=float, default=5, help="seconds to keep them all idle before measuring")
+    parser.add_argument("--sample", type=int, default=200, help="idle connections to ping")
+    parser.add_argument("--active", type=int, default=20, help="connections that send prompts")
+    parser.add_argument("--pid", type=int, help="pid of the server, to read its memory (same machine only)")
+    parser.add_argument("--compare-http", action="store_true")
+    parser.add_argument("--timeout", type=float, default=60)
+    args = parser.parse_args()
+
+    # one file descriptor per connection
+    soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    resource.setrlimit(resource.RLIMIT_NOFILE, (hard, hard))
+    asyncio.run(main(args))
@@ -1,12 +1,27 @@
-from fastapi import FastAPI, HTTPException
-# from langgraph.graph import END
-# from langgraph.graph import MessageGraph
+from fastapi import FastAPI, HTTPException, Request, WebSocket
+from fastapi.responses import StreamingResponse, JSONResponse, PlainTextResponse
 import os
 from dotenv import load_dotenv
-from models import QueryRequest, QueryResponse, APIKeyModel
-from nodes import simple_response, get_info
-from utils import setup_api_key
+from models import QueryRequest, QueryResponse, APIKeyModel, CacheSettings, BatchQueryRequest, BatchQueryResponse
+from nodes import simple_response, stream_simple_response, stream_info, search_cache, answer_cache, \
+    context_totals, search_timings, tavily_policy, llm_policy, clients, load_shared_answers, tavily_gate, llm_gate, \
+    page_fetcher, doc_index, shared_store
+from utils import setup_api_key, ndjson_events, as_completed
+from cache import normalize_query
+from singleflight import SingleFlight
+from resilience import deadline, within_deadline, CircuitOpenError
+import metrics
+from refresher import HotQueryRefresher
+from graph import run_agent, choose_route
+from admission import Overloaded, PriorityMiddleware, priority, current_priority
+from jobs import JobQueue, parse_jsonl
+from sessions import ChatSessions
+from shared_cache import SharedSettings
+from clients import KEY_NAMES
 import asyncio
+import functools
+import json
+from contextlib import asynccontextmanager
 
 
 # TODO:
@@ -24,14 +39,142 @@ load_dotenv(dotenv_path=dotenv_path, override=True)
 """print(os.environ["OPENAI_API_KEY"])
 print(os.environ["TAVILY_API_KEY"])"""
 
+# runs once when the server starts (before the yield) and once when it stops (after the yield)
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    if shared_store is None and int(os.environ.get("WEB_CONCURRENCY", 1)) > 1:
+        print("WEB_CONCURRENCY > 1 without SHARED_CACHE: api keys and settings only reach the worker they are sent to")
+    if shared_store is not None:
+        # settings that were set on a worker before this one (re)started; the keys of .env stay
+        await settings.sync(startup=True)
+    await clients.warm_up()
+    loaded = await load_shared_answers()
+    if loaded:
+        print(f"loaded {loaded} answers from the shared cache")
+    print(f"loaded {hot_queries.load()} hot queries")
+    refresh_loop = asyncio.create_task(hot_queries.run())
+    job_queue.start()
+    heartbeat_loop = asyncio.create_task(chat_sessions.run())
+    settings_loop = asyncio.create_task(settings.run())
+    yield
+    settings_loop.cancel()
+    heartbeat_loop.cancel()
+    refresh_loop.cancel()
+    await hot_queries.stop()
+    # the items that were being answered go back to the queue and are picked up after the restart
+    await job_queue.stop()
+    if doc_index is not None:
+        await doc_index.stop()
+    await clients.close()
+    await page_fetcher.close()
+
+
+async def apply_api_key(name: str, key: str):
+    os.environ[name] = key
+    # the clients were built with the old key; swap in new ones and warm them up in the background
+    clients.rebuild(name)
+    clients.run_in_background(clients.warm_up())
+
+
+async def apply_threshold(threshold: float):
+    answer_cache.threshold = threshold
+
+
+# every worker process has its own clients and caches; an api key or a cache threshold set through one of them is
+# passed on to the others through the shared store (SHARED_CACHE). the keys are stored in it too, but only for
+# SETTINGS_SECRET_TTL seconds, and a worker that restarts goes back to the keys of .env
+settings = SharedSettings(shared_store, poll=float(os.environ.get("SETTINGS_POLL", 2)),
+                          secret_ttl=float(os.environ.get("SETTINGS_SECRET_TTL", 60)))
+for key_name in KEY_NAMES:
+    settings.on(key_name, functools.partial(apply_api_key, key_name), secret=True)
+settings.on("cache_threshold", apply_threshold)
+
+
 # this line instantiates an app
-app = FastAPI()
+app = FastAPI(lifespan=lifespan)
+# request ids, traces, in-flight and latency metrics for every request
+app.add_middleware(metrics.MetricsMiddleware)
+# interactive requests go ahead of batch ones when the upstreams are busy (X-Priority header or the path)
+app.add_middleware(PriorityMiddleware)
+
+# identical questions that come in at the same time share one tavily search + llm call (streamed ones share one
+# stream). the priority is part of the key: the shared task runs with the priority of whoever started it, and a
+# live user should not end up waiting in the batch queue behind a job that happened to ask the same thing
+inflight = SingleFlight()
+
+# upper limit for the number of prompts of one batch that run at the same time
+BATCH_CONCURRENCY = int(os.environ.get("BATCH_CONCURRENCY", 8))
+
+# max time (seconds) one question may take end-to-end, including retries
+REQUEST_DEADLINE = float(os.environ.get("REQUEST_DEADLINE", 45))
+
+
+async def refresh_answer(prompt: str):
+    # skip the caches, the point is to get a fresh answer; and don't get in the way of the live users
+    with deadline(REQUEST_DEADLINE), priority("batch"):
+        return await inflight.do(("ask-question", normalize_query(prompt), False, None, False, current_priority()),
+                                 run_agent, prompt, False)
+
+
+# no background refreshes while this many live requests are running
+HOT_QUERIES_BUSY = int(os.environ.get("HOT_QUERIES_BUSY", 20))
+
+# keeps the answers to the most asked questions ready and refreshes them in the background
+hot_queries = HotQueryRefresher(refresh_answer,
+                                top_k=int(os.environ.get("HOT_QUERIES_TOP_K", 50)),
+                                fresh_for=float(os.environ.get("HOT_QUERIES_FRESH_FOR", 300)),
+                                max_stale=float(os.environ.get("HOT_QUERIES_MAX_STALE", 3600)),
+                                interval=float(os.environ.get("HOT_QUERIES_INTERVAL", 30)),
+                                concurrency=int(os.environ.get("HOT_QUERIES_CONCURRENCY", 2)),
+                                busy=lambda: inflight.stats()["in_flight"] >= HOT_QUERIES_BUSY,
+                                path=os.environ.get("HOT_QUERIES_PATH", "data/hot_queries.json"),
+                                store=shared_store)
+
+
+async def answer_job_item(prompt: str, use_cache: bool):
+    with deadline(REQUEST_DEADLINE):
+        return await inflight.do(("ask-question", normalize_query(prompt), use_cache, None, False,
+                                  current_priority()),
+                                 run_agent, prompt, use_cache)
+
+
+# the job workers pause while this many live requests are running
+JOBS_BUSY = int(os.environ.get("JOBS_BUSY", 20))
+
+# batches that are too big for one request (thousands of prompts) are answered in the background, see /jobs
+job_queue = JobQueue(os.environ.get("JOBS_PATH", "data/jobs.db"), answer_job_item,
+                     workers=int(os.environ.get("JOBS_WORKERS", 2)),
+                     lease=float(os.environ.get("JOBS_LEASE", 120)),
+                     max_attempts=int(os.environ.get("JOBS_MAX_ATTEMPTS", 3)),
+                     retry_backoff=float(os.environ.get("JOBS_RETRY_BACKOFF", 5)),
+                     busy=lambda: inflight.stats()["in_flight"] >= JOBS_BUSY)
+
+
+# the upstream is failing and its circuit breaker is open; tell the client when to try again instead of hanging
+@app.exception_handler(CircuitOpenError)
+async def circuit_open_handler(request: Request, e: CircuitOpenError):
+    return JSONResponse(status_code=503, content={"detail": str(e)},
+                        headers={"Retry-After": str(max(int(e.retry_after), 1))})
+
+
+# the upstream queue is full (429) or the wait was too long (503); fail fast so the client can back off
+@app.exception_handler(Overloaded)
+async def overloaded_handler(request: Request, e: Overloaded):
+    return JSONResponse(status_code=e.status, content={"detail": str(e)},
+                        headers={"Retry-After": str(int(e.retry_after))})
+
+
+@app.exception_handler(TimeoutError)
+async def timeout_handler(request: Request, e: TimeoutError):
+    return JSONResponse(status_code=504, content={"detail": str(e) or "upstream timed out"})
 
 
 # this function is a wrapped into an endpoint with HTTP post
 @app.post("/query-llm", response_model=QueryResponse)
 async def query_llm(payload: QueryRequest):
-    response = await simple_response(payload.prompt)
+    with deadline(REQUEST_DEADLINE):
+        response = await inflight.do(("query-llm", normalize_query(payload.prompt), current_priority()),
+                                     simple_response, payload.prompt)
     return {
         "response": response
     }
@@ -39,17 +182,314 @@ async def query_llm(payload: QueryRequest):
 
 @app.post("/ask-question", response_model=QueryResponse)
 async def ask_question(payload: QueryRequest):
-    response = await get_info(payload.prompt)
+    # without a route the router decides between answering directly, searching and searching deeper
+    route = payload.route or ("deep" if payload.fan_out else None)
+    hot_queries.record(payload.prompt)
+    # the hot answers are snippet answers, a read_pages request wants more than that
+    hot = route is None and not payload.read_pages
+    if payload.use_cache and hot:
+        response = hot_queries.get(payload.prompt)
+        if response is not None:
+            return {
+                "response": response
+            }
+
+    with deadline(REQUEST_DEADLINE):
+        response = await inflight.do(("ask-question", normalize_query(payload.prompt), payload.use_cache, route,
+                                      payload.read_pages, current_priority()),
+                                     run_agent, payload.prompt, payload.use_cache, route, payload.read_pages)
+    if hot:
+        hot_queries.store(payload.prompt, response)
     return {
         "response": response
     }
 
 
+async def answer_batch(payload: BatchQueryRequest):
+    """Answer every unique prompt of the batch concurrently and yield (indices, item) as each one finishes."""
+    concurrency = min(payload.concurrency or BATCH_CONCURRENCY, BATCH_CONCURRENCY)
+    semaphore = asyncio.Semaphore(max(concurrency, 1))
+
+    # duplicate rows share one answer
+    positions = {}
+    for i, prompt in enumerate(payload.prompts):
+        positions.setdefault(normalize_query(prompt), []).append(i)
+
+    async def answer(key, indices):
+        prompt = payload.prompts[indices[0]]
+        async with semaphore:
+            try:
+                with deadline(REQUEST_DEADLINE):
+                    response = await inflight.do(("ask-question", key, payload.use_cache, None, False,
+                                                  current_priority()),
+                                                 run_agent, prompt, payload.use_cache)
+                return indices, {"prompt": prompt, "response": response}
+            except Exception as e:
+                # one failing prompt should not fail the whole batch
+                return indices, {"prompt": prompt, "error": str(e)}
+
+    # the prompts that are still running are cancelled when the client of the stream goes away
+    async for result in as_completed([answer(key, indices) for key, indices in positions.items()]):
+        yield result
+
+
+@app.post("/ask-question/batch", response_model=BatchQueryResponse)
+async def ask_question_batch(payload: BatchQueryRequest):
+    results = [None] * len(payload.prompts)
+    async for indices, item in answer_batch(payload):
+        for i in indices:
+            results[i] = {**item, "prompt": payload.prompts[i]}
+    return {
+        "results": results
+    }
+
+
+# same as above, but every result is sent as soon as it is ready (one JSON line per prompt, with its index)
+@app.post("/ask-question/batch/stream")
+async def ask_question_batch_stream(payload: BatchQueryRequest):
+    async def lines():
+        async for indices, item in answer_batch(payload):
+            for i in indices:
+                yield json.dumps({"index": i, **item, "prompt": payload.prompts[i]}) + "\n"
+
+    return StreamingResponse(lines(), media_type="application/x-ndjson")
+
+
+# streaming versions of the two endpoints above; every line of the response is one JSON event:
+# {"event": "token", "data": "..."} while the LLM is generating, then {"event": "sources", ...} (ask-question only)
+# and finally {"event": "done", "data": {"ttft_ms": ..., "total_ms": ...}}
+@app.post("/query-llm/stream")
+async def query_llm_stream(payload: QueryRequest):
+    events = inflight.stream(("query-llm-stream", normalize_query(payload.prompt), current_priority()),
+                             stream_simple_response, payload.prompt)
+    return StreamingResponse(ndjson_events(within_deadline(events, REQUEST_DEADLINE)),
+                             media_type="application/x-ndjson")
+
+
+def answer_events(payload: QueryRequest):
+    """The events of the answer, for /ask-question/stream and the WebSocket chat; ends with an error event when it
+    takes longer than REQUEST_DEADLINE."""
+    route = payload.route or ("deep" if payload.fan_out else None)
+    # the hot answers work like in /ask-question, a kept answer is sent as one token event
+    hot_queries.record(payload.prompt)
+    hot = route is None and not payload.read_pages
+    if payload.use_cache and hot:
+        response = hot_queries.get(payload.prompt)
+        if response is not None:
+            return replay_answer(response)
+
+    key = ("ask-question-stream", normalize_query(payload.prompt), payload.use_cache, route, payload.read_pages,
+           current_priority())
+    route = choose_route(payload.prompt, route)
+    if route == "direct":
+        events = inflight.stream(key, stream_simple_response, payload.prompt)
+    else:
+        events = inflight.stream(key, stream_info, payload.prompt, payload.use_cache, fan_out=route == "deep",
+                                 read_pages=payload.read_pages)
+    events = within_deadline(events, REQUEST_DEADLINE)
+    return keep_hot_answer(payload.prompt, events) if hot else events
+
+
+async def replay_answer(response: str):
+    # the whole text, sources included, like /ask-question returns it
+    yield {"event": "token", "data": response}
+
+
+async def keep_hot_answer(prompt: str, events):
+    """Pass the events through, and give the complete answer to the hot queries if the question is one of them."""
+    parts = []
+    failed = False
+    async for event in events:
+        if event["event"] in ("token", "sources"):
+            parts.append(event["data"])
+        elif event["event"] == "error":
+            failed = True
+        yield event
+    if not failed:
+        hot_queries.store(prompt, "".join(parts))
+
+
+@app.post("/ask-question/stream")
+async def ask_question_stream(payload: QueryRequest):
+    return StreamingResponse(ndjson_events(answer_events(payload)), media_type="application/x-ndjson")
+
+
+# one connection per chat session instead of one POST per prompt; send {"prompt": "..."} (same fields as
+# /ask-question, plus an optional "id") and get the events of /ask-question/stream back, tagged with that id.
+# a new prompt cancels the answer that is still coming, {"type": "cancel"} does the same without a new prompt
+chat_sessions = ChatSessions(answer_events,
+                             max_connections=int(os.environ.get("WS_MAX_CONNECTIONS", 10000)),
+                             heartbeat=float(os.environ.get("WS_HEARTBEAT", 30)),
+                             idle_timeout=float(os.environ.get("WS_IDLE_TIMEOUT", 300)))
+
+
+@app.websocket("/ws/chat")
+async def chat(websocket: WebSocket):
+    await chat_sessions.serve(websocket)
+
+
+@app.get("/chat-stats")
+async def chat_stats():
+    return chat_sessions.stats()
+
+
+# background jobs: POST a JSONL file (one {"prompt": "..."} per line), get a job id back right away and
+# follow the job with the endpoints below; the answers are kept in JOBS_PATH, so a restart doesn't lose them
+@app.post("/jobs")
+async def submit_job(request: Request, use_cache: bool = True):
+    try:
+        prompts = parse_jsonl(await request.body())
+    except (ValueError, UnicodeDecodeError) as e:
+        raise HTTPException(status_code=422, detail=str(e))
+    if not prompts:
+        raise HTTPException(status_code=422, detail="the job has no prompts")
+    job_id = await job_queue.submit(prompts, use_cache)
+    return {
+        "job_id": job_id,
+        "total": len(prompts)
+    }
+
+
+@app.get("/jobs")
+async def list_jobs(limit: int = 50):
+    return await job_queue.jobs(limit)
+
+
+@app.get("/jobs/{job_id}")
+async def get_job(job_id: str):
+    job = await job_queue.job(job_id)
+    if job is None:
+        raise HTTPException(status_code=404, detail="no such job")
+    return job
+
+
+# one progress line per second until the job is done
+@app.get("/jobs/{job_id}/stream")
+async def stream_job(job_id: str):
+    await get_job(job_id)
+    return StreamingResponse(job_queue.progress(job_id), media_type="application/x-ndjson")
+
+
+# the answers so far as JSONL, one line per prompt with its index; can be downloaded while the job is running
+@app.get("/jobs/{job_id}/results")
+async def job_results(job_id: str):
+    await get_job(job_id)
+    return StreamingResponse(job_queue.results(job_id), media_type="application/x-ndjson",
+                             headers={"Content-Disposition": f'attachment; filename="{job_id}.jsonl"'})
+
+
+@app.delete("/jobs/{job_id}")
+async def cancel_job(job_id: str):
+    await get_job(job_id)
+    if not await job_queue.cancel(job_id):
+        raise HTTPException(status_code=409, detail="the job is already finished")
+    return await get_job(job_id)
+
+
+def collect_stats():
+    """Turn the stats of the caches, the coalescing and the upstream policies into prometheus lines."""
+    lines = ["# TYPE cache_hit_ratio gauge"]
+    for name, cache in (("search", search_cache), ("answers", answer_cache)):
+        lines.append(f'cache_hit_ratio{{cache="{name}"}} {cache.stats()["hit_ratio"]}')
+    lines.append("# TYPE cache_lookups_total counter")
+    for name, cache in (("search", search_cache), ("answers", answer_cache)):
+        stats = cache.stats()
+        lines.append(f'cache_lookups_total{{cache="{name}",result="hit"}} {stats["hits"]}')
+        lines.append(f'cache_lookups_total{{cache="{name}",result="miss"}} {stats["misses"]}')
+    lines.append("# TYPE coalesced_requests_total counter")
+    lines.append(f"coalesced_requests_total {inflight.coalesced}")
+    lines.append("# TYPE context_tokens_saved_total counter")
+    lines.append(f"context_tokens_saved_total {context_totals['tokens_saved']}")
+    lines.append("# TYPE upstream_breaker_open gauge")
+    for policy in (tavily_policy, llm_policy):
+        lines.append(f'upstream_breaker_open{{upstream="{policy.name}"}} {int(policy.breaker.state == "open")}')
+    return lines
+
+
+metrics.collectors.append(collect_stats)
+
+
+# prometheus scrape endpoint
+@app.get("/metrics")
+async def get_metrics():
+    return PlainTextResponse(metrics.render(), media_type="text/plain; version=0.0.4")
+
+
+# the spans of the last requests; filter on the X-Request-ID the client sent (app_streamlit.py sends one)
+@app.get("/traces")
+async def get_traces(request_id: str = None, limit: int = 50):
+    traces = [t.to_dict() for t in metrics.recent_traces if request_id is None or t.request_id == request_id]
+    return traces[-limit:]
+
+
+# hit/miss/eviction counters of the caches
+@app.get("/cache-stats")
+async def cache_stats():
+    return {
+        "search": search_cache.stats(),
+        "answers": answer_cache.stats(),
+        "in_flight": inflight.stats(),
+        "hot_queries": hot_queries.stats(),
+        "doc_index": None if doc_index is None else doc_index.stats(),
+        "jobs": await job_queue.stats()
+    }
+
+
+# how many prompt tokens the context assembly (dedup + rerank + budget) saved so far
+@app.get("/context-stats")
+async def context_stats():
+    return context_totals
+
+
+# average search wall time of the single search vs the fan-out mode, and what the page reader did
+@app.get("/search-stats")
+async def search_stats():
+    stats = {
+        mode: {**timing, "avg_seconds": timing["seconds"] / timing["count"] if timing["count"] else 0.0}
+        for mode, timing in search_timings.items()
+    }
+    stats["pages"] = page_fetcher.stats()
+    return stats
+
+
+# state of the timeouts/retries/hedging and circuit breakers per upstream service
+@app.get("/resilience-stats")
+async def resilience_stats():
+    stats = {
+        "tavily": tavily_policy.stats(),
+        "openai": llm_policy.stats()
+    }
+    stats["admission"] = {"tavily": tavily_gate.stats(), "openai": llm_gate.stats()}
+    # per provider latency/error stats when LLM_PROVIDERS configures a provider pool (and it was used already)
+    provider_stats = clients.llm_stats()
+    if provider_stats is not None:
+        stats["llm_providers"] = provider_stats
+    return stats
+
+
+# sampled semantic cache hits (and near misses); check these to see if the threshold is too low or too high
+@app.get("/cache-samples")
+async def cache_samples():
+    return list(answer_cache.samples)
+
+
+@app.post("/cache-settings")
+async def cache_settings(payload: CacheSettings):
+    if not 0 < payload.threshold <= 1:
+        raise HTTPException(status_code=422, detail="threshold has to be between 0 and 1")
+    await apply_threshold(payload.threshold)
+    await settings.publish("cache_threshold", payload.threshold)
+    return answer_cache.stats()
+
+
 # send api keys over an endpoint
 @app.post("/api-key-setup")
 async def setup(payload: APIKeyModel):
     try:
         await setup_api_key(payload)
+        if payload.name in KEY_NAMES:
+            await apply_api_key(payload.name, payload.key)
+            await settings.publish(payload.name, payload.key)
         return
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
@@ -0,0 +1,260 @@
+import os
+import time
+import uuid
+from collections import deque
+from contextlib import contextmanager
+from contextvars import ContextVar
+from starlette.routing import Match
+
+
+# set METRICS_ENABLED=false to switch all instrumentation off; the time spent in the instrumentation itself is
+# counted in metrics_overhead_seconds_total, so the cost can be compared
+ENABLED = os.environ.get("METRICS_ENABLED", "true").lower() == "true"
+
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+
+
+def _labels(labels: dict):
+    if not labels:
+        return ""
+    return "{" + ",".join(f'{k}="{v}"' for k, v in sorted(labels.items())) + "}"
+
+
+class Counter:
+    def __init__(self, name: str, help: str, kind: str = "counter"):
+        self.name = name
+        self.help = help
+        self.kind = kind
+        self.values = {}
+
+    def inc(self, amount: float = 1, **labels):
+        if ENABLED:
+            key = tuple(sorted(labels.items()))
+            self.values[key] = self.values.get(key, 0) + amount
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} {self.kind}"]
+        for key, value in self.values.items():
+            lines.append(f"{self.name}{_labels(dict(key))} {value}")
+        return lines
+
+
+class Gauge(Counter):
+    def __init__(self, name: str, help: str):
+        super().__init__(name, help, kind="gauge")
+
+    def dec(self, amount: float = 1, **labels):
+        self.inc(-amount, **labels)
+
+    def set(self, value: float, **labels):
+        if ENABLED:
+            self.values[tuple(sorted(labels.items()))] = value
+
+
+class Histogram:
+    def __init__(self, name: str, help: str, buckets: tuple = DEFAULT_BUCKETS):
+        self.name = name
+        self.help = help
+        self.buckets = buckets
+        # labels -> [count per bucket..., sum, count]
+        self.values = {}
+
+    def observe(self, value: float, **labels):
+        if not ENABLED:
+            return
+        key = tuple(sorted(labels.items()))
+        series = self.values.get(key)
+        if series is None:
+            series = self.values[key] = [0] * (len(self.buckets) + 2)
+        for i, bound in enumerate(self.buckets):
+            if value <= bound:
+                series[i] += 1
+        series[-2] += value
+        series[-1] += 1
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} histogram"]
+        for key, series in self.values.items():
+            labels = dict(key)
+            for bound, count in zip(self.buckets, series):
+                lines.append(f"{self.name}_bucket{_labels({**labels, 'le': bound})} {count}")
+            lines.append(f"{self.name}_bucket{_labels({**labels, 'le': '+Inf'})} {series[-1]}")
+            lines.append(f"{self.name}_sum{_labels(labels)} {series[-2]}")
+            lines.append(f"{self.name}_count{_labels(labels)} {series[-1]}")
+        return lines
+
+
+stage_seconds = Histogram("stage_seconds", "Time spent per stage of a request (search, context, llm_first_token, "
+                                           "llm_total)")
+request_seconds = Histogram("request_seconds", "Total time per HTTP request, until the last byte was sent")
+llm_tokens = Counter("llm_tokens_total", "Tokens sent to (in) and received from (out) the llm")
+in_flight = Gauge("requests_in_flight", "Requests that are being handled right now")
+overhead = Counter("metrics_overhead_seconds_total", "Time spent in the instrumentation itself")
+router_decisions = Counter("router_decisions_total", "Routes picked by the agent router (direct, search, deep)")
+router_latency_saved = Counter("router_latency_saved_seconds_total",
+                               "Average search time saved by answering directly, summed over the direct routes")
+
+admission_queue_depth = Gauge("admission_queue_depth", "Requests waiting for an upstream slot, per priority")
+admission_wait_seconds = Histogram("admission_wait_seconds", "Time spent waiting for an upstream slot")
+admission_rejected = Counter("admission_rejected_total", "Requests turned away because the upstream was at its limits")
+websocket_connections = Gauge("websocket_connections", "Open WebSocket chat connections")
+websocket_turns = Counter("websocket_turns_total",
+                          "Answers over the WebSocket chat, by how they ended (done, cancelled, error)")
+websocket_turn_seconds = Histogram("websocket_turn_seconds",
+                                   "Time per answer over the WebSocket chat, until its last event was sent")
+
+METRICS = [stage_seconds, request_seconds, llm_tokens, in_flight, overhead, router_decisions, router_latency_saved,
+           admission_queue_depth, admission_wait_seconds, admission_rejected, websocket_connections, websocket_turns,
+           websocket_turn_seconds]
+# functions that return extra lines at scrape time (e.g. the cache stats); registered by main.py
+collectors = []
+
+
+def render():
+    lines = []
+    for metric in METRICS:
+        lines += metric.render()
+    for collect in collectors:
+        lines += collect()
+    return "\n".join(lines) + "\n"
+
+
+class Trace:
+    def __init__(self, request_id: str, path: str):
+        self.request_id = request_id
+        self.path = path
+        self.start = time.perf_counter()
+        self.spans = []
+        self.status = None
+        self.duration_ms = None
+
+    def to_dict(self):
+        return {"request_id": self.request_id, "path": self.path, "status": self.status,
+                "duration_ms": self.duration_ms, "spans": self.spans}
+
+
+_trace = ContextVar("trace", default=None)
+# the last finished traces, for /traces
+recent_traces = deque(maxlen=int(os.environ.get("TRACE_BUFFER", 500)))
+
+
+def current_request_id():
+    trace = _trace.get()
+    return None if trace is None else trace.request_id
+
+
+@contextmanager
+def span(name: str, **attributes):
+    """Time a stage of the request; it's added to the stage_seconds histogram and to the trace of the request.
+    The yielded dict can be used to add attributes to the span."""
+    if not ENABLED:
+        yield {}
+        return
+
+    start = time.perf_counter()
+    try:
+        yield attributes
+    finally:
+        end = time.perf_counter()
+        record_span(name, start, end, attributes)
+
+
+def record_span(name: str, start: float, end: float, attributes: dict = None):
+    if not ENABLED:
+        return
+    t = time.perf_counter()
+    stage_seconds.observe(end - start, stage=name)
+    trace = _trace.get()
+    if trace is not None:
+        trace.spans.append({"name": name, "start_ms": round((start - trace.start) * 1000, 2),
+                            "duration_ms": round((end - start) * 1000, 2), **(attributes or {})})
+    overhead.inc(time.perf_counter() - t)
+
+
+@contextmanager
+def traced(request_id: str, path: str):
+    """A trace for work that doesn't come through the middleware (a turn of the WebSocket chat): the spans inside
+    are added to it and it shows up in /traces like a request. The caller sets the status of the yielded trace."""
+    trace = Trace(request_id, path)
+    if not ENABLED:
+        yield trace
+        return
+
+    token = _trace.set(trace)
+    try:
+        yield trace
+    finally:
+        trace.duration_ms = round((time.perf_counter() - trace.start) * 1000, 2)
+        recent_traces.append(trace)
+        _trace.reset(token)
+
+
+def route_template(scope):
+    """The path template of the route the request goes to ("/jobs/{job_id}"), or "unmatched" (404s, scanners).
+
+    The metrics are labelled with this instead of the raw path, so every job id or random url doesn't become a new
+    series that is kept forever.
+    """
+    partial = None
+    for route in getattr(getattr(scope.get("app"), "router", None), "routes", []):
+        match, _ = route.matches(scope)
+        if match == Match.FULL:
+            return route.path
+        if match == Match.PARTIAL and partial is None:
+            # the path matches but the method doesn't (405)
+            partial = route.path
+    return partial or "unmatched"
+
+
+class MetricsMiddleware:
+    """ASGI middleware: gives every request an id (taken from the X-Request-ID header if the client sent one),
+    starts its trace and keeps the in-flight gauge and the request histogram up to date. It's plain ASGI instead of
+    a FastAPI http middleware so streamed responses are counted until their last chunk."""
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http" or not ENABLED or scope["path"] == "/metrics":
+            return await self.app(scope, receive, send)
+
+        t = time.perf_counter()
+        headers = dict(scope["headers"])
+        request_id = headers.get(b"x-request-id", b"").decode() or uuid.uuid4().hex
+        # the trace keeps the real path, the metrics get the template
+        trace = Trace(request_id, scope["path"])
+        path = route_template(scope)
+        token = _trace.set(trace)
+        in_flight.inc(path=path)
+        overhead.inc(time.perf_counter() - t)
+
+        async def send_with_id(message):
+            if message["type"] == "http.response.start":
+                trace.status = message["status"]
+                message["headers"] = list(message.get("headers", [])) + [(b"x-request-id", request_id.encode())]
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_with_id)
+        finally:
+            t = time.perf_counter()
+            in_flight.dec(path=path)
+            trace.duration_ms = round((t - trace.start) * 1000, 2)
+            request_seconds.observe(t - trace.start, path=path, status=trace.status or 500)
+            recent_traces.append(trace)
+            _trace.reset(token)
+            overhead.inc(time.perf_counter() - t)
+
+
+if __name__ == "__main__":
+    # rough cost of one span, with the instrumentation on and off
+    n = 100_000
+    for enabled in (True, False):
+        ENABLED = enabled
+        _trace.set(Trace("benchmark", "/benchmark"))
+        start = time.perf_counter()
+        for _ in range(n):
+            with span("benchmark"):
+                pass
+        print(f"enabled={enabled}: {(time.perf_counter() - start) / n * 1e6:.2f} us per span")
+        _trace.get().spans.clear()
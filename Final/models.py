@@ -1,4 +1,5 @@
 from pydantic import BaseModel
+from typing import Optional, Literal
 
 # create a Pydantic model for the data; any data that you use this model to send or receive data has to adhere to this
 # structure
@@ -8,6 +9,15 @@ from pydantic import BaseModel
 class QueryRequest(BaseModel):
     # only one parameter in the request model; possible to add more; possible to use typing lib to use other datatypes
     prompt: str
+    # set to False to skip the cached answers and search results and always ask Tavily and the LLM
+    use_cache: bool = True
+    # set to True to split broad questions into a few searches that run at the same time (same as route="deep")
+    fan_out: bool = False
+    # skip the router of /ask-question: "direct" (llm only), "search" or "deep" (search with fan-out)
+    route: Optional[Literal["direct", "search", "deep"]] = None
+    # set to True to read the result pages and answer from their most relevant passages instead of only the short
+    # snippets of tavily; slower (up to PAGES_TOTAL_TIMEOUT seconds more) but more detailed
+    read_pages: bool = False
 
 
 class QueryResponse(BaseModel):
@@ -15,7 +25,30 @@ class QueryResponse(BaseModel):
     response: str
 
 
+class BatchQueryRequest(BaseModel):
+    # a list of prompts instead of one; duplicates in the list are only answered once
+    prompts: list[str]
+    use_cache: bool = True
+    # how many prompts are answered at the same time; capped by the server
+    concurrency: Optional[int] = None
+
+
+class BatchItem(BaseModel):
+    # one result per prompt, in the same order as the request; either response or error is filled in
+    prompt: str
+    response: Optional[str] = None
+    error: Optional[str] = None
+
+
+class BatchQueryResponse(BaseModel):
+    results: list[BatchItem]
+
+
 class APIKeyModel(BaseModel):
     name: str
     key: str
 
+
+class CacheSettings(BaseModel):
+    # similarity (0-1) above which a cached answer is served for a new prompt
+    threshold: float
@@ -1,11 +1,22 @@
 import openai
 from langchain_openai import ChatOpenAI
 from langchain_core.messages import SystemMessage
-from tavily import AsyncTavilyClient, TavilyClient
 import asyncio
 from dotenv import load_dotenv
 import os
 import json
+import re
+import time
+from cache import SearchCache, SemanticCache, normalize_query
+from clients import Clients
+from context import assemble_context, count_tokens
+import metrics
+from metrics import span, record_span
+from resilience import UpstreamPolicy
+from shared_cache import open_store
+from admission import AdmissionController, Overloaded
+from pages import PageFetcher, select_passages
+from doc_index import open_index
 
 
 # load API key;
@@ -13,46 +24,412 @@ dotenv_path = os.path.join(os.path.dirname(__file__), '.env')
 
 # use override=True if you have the API key set up in your env variables
 load_dotenv(dotenv_path=dotenv_path, override=True)
-print(os.environ["OPENAI_API_KEY"])
-print(os.environ["TAVILY_API_KEY"])
 
 
-# Step 1. Setup (asynchronous) TavilyClient to query Tavily search engine
-atavily_client = AsyncTavilyClient(api_key=os.environ["TAVILY_API_KEY"])
-tavily_client = TavilyClient(api_key=os.environ["TAVILY_API_KEY"])
+# Step 1. The (asynchronous) TavilyClient and the llm model live in `clients`; they are created when they are first
+# used, warmed up when the app starts and rebuilt when a key is changed through /api-key-setup
+clients = Clients()
 
 # Step 2. Executing a simple search query
 # q = "Who is Dimebag Darrell?"
-# resp = asyncio.run(atavily_client.search(q))
+# resp = asyncio.run(clients.tavily().search(q))
 # print(json.dumps(resp, indent=4, sort_keys=True))
 
 # info = "\n".join([result["content"] for result in response["results"]])
 
-# create llm model instance
-llm = ChatOpenAI(model="gpt-4o-mini")
+# cache for the tavily results; a lot of questions repeat, so there is no need to search (and pay) for them again
+search_cache = SearchCache(ttl=float(os.environ.get("SEARCH_CACHE_TTL", 300)),
+                           max_entries=int(os.environ.get("SEARCH_CACHE_MAX_ENTRIES", 1024)),
+                           max_bytes=int(os.environ.get("SEARCH_CACHE_MAX_BYTES", 32 * 1024 * 1024)))
 
+# cache for the final answers, matched on similarity of the prompt; a hit skips both tavily and the llm
+answer_cache = SemanticCache(threshold=float(os.environ.get("ANSWER_CACHE_THRESHOLD", 0.95)),
+                             max_entries=int(os.environ.get("ANSWER_CACHE_MAX_ENTRIES", 2048)),
+                             ttl=float(os.environ.get("ANSWER_CACHE_TTL", 3600)))
 
-async def get_info(query: str):
-    result = await atavily_client.search(query)
-    info = "\n".join([r["content"] for r in result["results"]])
-    response = await llm.ainvoke([SystemMessage(
+# max number of tokens of search results that go into the prompt
+CONTEXT_TOKEN_BUDGET = int(os.environ.get("CONTEXT_TOKEN_BUDGET", 2000))
+context_totals = {"requests": 0, "tokens_before": 0, "tokens_used": 0, "tokens_saved": 0, "duplicates_removed": 0}
+
+
+# timeouts, retries and circuit breakers for the upstream services; tavily searches are safe to send twice,
+# so slow ones get a hedged duplicate request; for openai that would double the token bill, so it's off by default
+tavily_policy = UpstreamPolicy("tavily", timeout=float(os.environ.get("TAVILY_TIMEOUT", 10)),
+                               retries=int(os.environ.get("TAVILY_RETRIES", 2)),
+                               hedge=os.environ.get("TAVILY_HEDGE", "true").lower() == "true")
+llm_policy = UpstreamPolicy("openai", timeout=float(os.environ.get("OPENAI_TIMEOUT", 30)),
+                            retries=int(os.environ.get("OPENAI_RETRIES", 2)),
+                            hedge=os.environ.get("OPENAI_HEDGE", "false").lower() == "true",
+                            no_retry=(openai.AuthenticationError, openai.BadRequestError))
+
+# how much we send to each upstream at once and per second; whatever doesn't fit waits in a bounded queue
+# (interactive before batch, see admission.py) or gets a 429/503 right away
+tavily_gate = AdmissionController("tavily", max_concurrency=int(os.environ.get("TAVILY_MAX_CONCURRENCY", 16)),
+                                  rate=float(os.environ.get("TAVILY_RATE", 0)),
+                                  max_queue=int(os.environ.get("TAVILY_MAX_QUEUE", 200)),
+                                  max_wait=float(os.environ.get("ADMISSION_MAX_WAIT", 10)))
+llm_gate = AdmissionController("openai", max_concurrency=int(os.environ.get("OPENAI_MAX_CONCURRENCY", 32)),
+                               rate=float(os.environ.get("OPENAI_RATE", 0)),
+                               max_queue=int(os.environ.get("OPENAI_MAX_QUEUE", 200)),
+                               max_wait=float(os.environ.get("ADMISSION_MAX_WAIT", 10)))
+
+
+async def call_tavily(query: str):
+    async with tavily_gate.slot():
+        return await tavily_policy.call(clients.tavily().search, query)
+
+
+# cache shared by all worker processes and kept across restarts, behind the in-process caches above;
+# off unless SHARED_CACHE is set (see shared_cache.py)
+shared_store = open_store()
+
+
+# answers of the fan-out search are kept apart from the ones of the single search; same question, other answer
+FAN_OUT_PREFIX = "fan_out:"
+
+
+def answer_variant(fan_out: bool):
+    return "fan_out" if fan_out else ""
+
+
+def answer_key(query: str, fan_out: bool = False):
+    """Key of an answer in the shared store."""
+    return (FAN_OUT_PREFIX if fan_out else "") + normalize_query(query)
+
+
+async def load_shared_answers(limit: int = 1000):
+    """Fill the in-process answer cache with the most recent answers of the shared store (after a restart)."""
+    if shared_store is None:
+        return 0
+    entries = await shared_store.recent("answers", limit)
+    for key, value in reversed(entries):
+        fan_out = key.startswith(FAN_OUT_PREFIX)
+        answer_cache.put(key[len(FAN_OUT_PREFIX):] if fan_out else key, value, answer_variant(fan_out))
+    return len(entries)
+
+
+# persistent index of all the search results seen so far (see doc_index.py); a question it knows enough about is
+# answered from it without asking tavily. off unless DOC_INDEX=true
+doc_index = open_index()
+# enough means at least DOC_INDEX_MIN_HITS chunks with a similarity of DOC_INDEX_MIN_SCORE, added (or seen again)
+# in the last DOC_INDEX_MAX_AGE seconds
+DOC_INDEX_TOP_K = int(os.environ.get("DOC_INDEX_TOP_K", 8))
+DOC_INDEX_MIN_SCORE = float(os.environ.get("DOC_INDEX_MIN_SCORE", 0.25))
+DOC_INDEX_MIN_HITS = int(os.environ.get("DOC_INDEX_MIN_HITS", 2))
+DOC_INDEX_MAX_AGE = float(os.environ.get("DOC_INDEX_MAX_AGE", 24 * 3600))
+
+
+async def local_search(query: str):
+    """Search results from the document index, or None if it doesn't know enough about the question."""
+    with span("local_search") as attributes:
+        hits = await doc_index.search_async(query, DOC_INDEX_TOP_K, DOC_INDEX_MAX_AGE)
+        hits = [hit for hit in hits if hit["score"] >= DOC_INDEX_MIN_SCORE]
+        attributes["hits"] = len(hits)
+    if len(hits) < DOC_INDEX_MIN_HITS:
+        doc_index.misses += 1
+        return None
+    doc_index.hits += 1
+    return {"query": query, "results": hits, "local": True}
+
+
+async def search(query: str, use_cache: bool = True):
+    if use_cache:
+        result = search_cache.get(query)
+        if result is not None:
+            return result
+        if doc_index is not None:
+            result = await local_search(query)
+            if result is not None:
+                return result
+
+    if shared_store is not None:
+        # with several workers, the other processes may already have this search (or be running it right now)
+        result = await shared_store.get_or_compute("search", normalize_query(query), search_cache.ttl,
+                                                   lambda: call_tavily(query), use_cache)
+    else:
+        result = await call_tavily(query)
+    # a bypassed request still refreshes the cache for the next one
+    search_cache.put(query, result)
+    if doc_index is not None:
+        # in the background, the answer doesn't need it
+        doc_index.add_later(result["results"])
+    return result
+
+
+# settings of the fan-out mode: how many extra searches and how long each one is allowed to take
+MAX_SUBQUERIES = int(os.environ.get("MAX_SUBQUERIES", 3))
+SUBQUERY_TIMEOUT = float(os.environ.get("SUBQUERY_TIMEOUT", 5))
+# wall time of the searches per mode, to compare the fan-out with the single search
+search_timings = {"single": {"count": 0, "seconds": 0.0}, "fan_out": {"count": 0, "seconds": 0.0}}
+
+
+# a part of a question that can be searched on its own starts with a question word
+CLAUSE = re.compile(r"^(who|what|when|where|why|how|which|is|are|was|were|do|does|did|can|could|should|will|would)\b",
+                    re.IGNORECASE)
+CONJUNCTION = re.compile(r"(\s*(?:,|;)\s*(?:and\s+|or\s+)?|\s+(?:and|or)\s+)", re.IGNORECASE)
+# comparisons of two things; the parts are the things, not the words around them
+COMPARISONS = [
+    re.compile(r"\b(?:differences?|similarities) between (?P<a>.+?) and (?P<b>.+)$", re.IGNORECASE),
+    re.compile(r"^(?:compare|comparing|comparison of) (?P<a>.+?) (?:and|with|to|vs\.?|versus) (?P<b>.+)$",
+               re.IGNORECASE),
+    re.compile(r"^(?P<a>.+?) (?:vs\.?|versus) (?P<b>.+)$", re.IGNORECASE),
+]
+
+
+def share_words(a: str, b: str):
+    """Give both sides of a comparison the words they share: "black" and "white tea" -> "black tea" and
+    "white tea"; "should i learn python" and "rust" -> "... python" and "should i learn rust"."""
+    a_words, b_words = a.split(), b.split()
+    if len(a_words) == 1 and len(b_words) > 1:
+        a = " ".join(a_words + b_words[1:])
+    elif len(b_words) == 1 and len(a_words) > 1:
+        b = " ".join(a_words[:-1] + b_words)
+    return [a, b]
+
+
+def split_query(query: str):
+    """The parts of a question that can be searched separately, or just the question if it can't be split.
+
+    Only two kinds of split are made: questions that are a list of full questions ("who founded pantera and when
+    did dimebag die"), and comparisons of two things. "pros and cons of nuclear energy" or "history of rock and
+    roll" stay in one piece.
+    """
+    query = query.strip().rstrip("?.!")
+    pieces = CONJUNCTION.split(query)
+    # pieces alternate text, separator, text, ...; a piece that isn't a question goes back onto the one before
+    clauses = [pieces[0]]
+    for separator, piece in zip(pieces[1::2], pieces[2::2]):
+        if CLAUSE.match(piece) and CLAUSE.match(clauses[0]):
+            clauses.append(piece)
+        else:
+            clauses[-1] += separator + piece
+    if len(clauses) > 1:
+        return clauses
+
+    for pattern in COMPARISONS:
+        match = pattern.search(query)
+        if match:
+            return share_words(match["a"].strip(), match["b"].strip())
+    return [query]
+
+
+def decompose_query(query: str, max_subqueries: int = MAX_SUBQUERIES):
+    """Split a broad question into a few narrower searches; the original query is always the first one."""
+    subqueries = [query]
+    seen = {normalize_query(query)}
+    for part in split_query(query):
+        part = part.strip(" ?.!")
+        if part and normalize_query(part) not in seen:
+            seen.add(normalize_query(part))
+            subqueries.append(part)
+    return subqueries[:max_subqueries + 1]
+
+
+async def fan_out_search(query: str, use_cache: bool = True):
+    """Search all sub-queries at the same time and merge the results, keeping the best score per url."""
+    subqueries = decompose_query(query)
+    results = await asyncio.gather(*[asyncio.wait_for(search(q, use_cache), SUBQUERY_TIMEOUT) for q in subqueries],
+                                   return_exceptions=True)
+
+    merged = {}
+    for result in results:
+        if isinstance(result, BaseException):
+            continue
+        for r in result["results"]:
+            if r["url"] not in merged or r.get("score", 0) > merged[r["url"]].get("score", 0):
+                merged[r["url"]] = r
+
+    if not merged and isinstance(results[0], BaseException):
+        raise results[0]
+
+    ranked = sorted(merged.values(), key=lambda r: -r.get("score", 0))
+    return {"query": query, "subqueries": subqueries, "results": ranked}
+
+
+async def timed_search(query: str, use_cache: bool = True, fan_out: bool = False):
+    start = time.perf_counter()
+    result = await (fan_out_search(query, use_cache) if fan_out else search(query, use_cache))
+    timing = search_timings["fan_out" if fan_out else "single"]
+    timing["count"] += 1
+    timing["seconds"] += time.perf_counter() - start
+    return result
+
+
+# settings of the read_pages mode: how many result pages are read, how many passages of them go into the prompt
+# and how long/how much a page may take; slow pages are dropped, the answer doesn't wait for them
+MAX_PAGES = int(os.environ.get("MAX_PAGES", 5))
+MAX_PASSAGES = int(os.environ.get("MAX_PASSAGES", 8))
+PAGES_TOKEN_BUDGET = int(os.environ.get("PAGES_TOKEN_BUDGET", 4000))
+page_fetcher = PageFetcher(max_connections=int(os.environ.get("PAGE_MAX_CONNECTIONS", 10)),
+                           page_timeout=float(os.environ.get("PAGE_TIMEOUT", 2)),
+                           total_timeout=float(os.environ.get("PAGES_TOTAL_TIMEOUT", 3)),
+                           max_bytes=int(os.environ.get("PAGE_MAX_BYTES", 512 * 1024)))
+
+
+async def add_passages(query: str, result: dict):
+    """Read the pages of the search results and add their most relevant passages to the result."""
+    results = result["results"][:MAX_PAGES]
+    with span("pages") as attributes:
+        texts, report = await page_fetcher.fetch_all([r["url"] for r in results])
+        passages = select_passages(query, [(r, texts[r["url"]]) for r in results if r["url"] in texts], MAX_PASSAGES)
+        attributes.update(report, passages=len(passages))
+    return {**result, "passages": passages}
+
+
+def build_messages(query: str, result: dict):
+    # the passages of the pages (read_pages mode) compete with the snippets for the (larger) budget
+    passages = result.get("passages", [])
+    with span("context") as attributes:
+        info, report = assemble_context(query, passages + result["results"],
+                                        PAGES_TOKEN_BUDGET if passages else CONTEXT_TOKEN_BUDGET)
+        attributes.update(report)
+    context_totals["requests"] += 1
+    for k in ("tokens_before", "tokens_used", "tokens_saved", "duplicates_removed"):
+        context_totals[k] += report[k]
+
+    return [SystemMessage(
         content="Combine the information from these sources and explain the information to the user.\n"
                 "Provide a general overview of the subject of the information.\n" + info +
-                "\nUser original prompt:" + query)])
+                "\nUser original prompt:" + query)]
+
+
+def format_sources(result: dict):
+    # answers from the document index can have several chunks of the same page
+    sources = dict.fromkeys(f"{r['title']}\n{r['url']}" for r in result["results"])
+    return "\n\nSources:\n\n" + "\n".join(sources)
+
+
+def count_llm_tokens(messages, answer: str):
+    if metrics.ENABLED:
+        prompt = messages if isinstance(messages, str) else "\n".join(m.content for m in messages)
+        metrics.llm_tokens.inc(count_tokens(prompt), direction="in")
+        metrics.llm_tokens.inc(count_tokens(answer), direction="out")
+
+
+async def invoke_llm(messages, model: ChatOpenAI = None):
+    """llm.ainvoke through the upstream policy, timed and with the tokens counted."""
+    model = model or clients.llm()
+    async with llm_gate.slot():
+        with span("llm_total"):
+            response = await llm_policy.call(model.ainvoke, messages)
+    count_llm_tokens(messages, response.content)
+    return response.content
+
+
+async def stream_llm(messages, model: ChatOpenAI = None):
+    """llm.astream through the upstream policy; yields the text of the chunks and times the first token."""
+    model = model or clients.llm()
+    answer = ""
+    async with llm_gate.slot():
+        start = time.perf_counter()
+        async for chunk in llm_policy.stream(model.astream, messages):
+            if chunk.content:
+                if not answer:
+                    record_span("llm_first_token", start, time.perf_counter())
+                answer += chunk.content
+                yield chunk.content
 
-    sources = "\n\nSources:\n\n" + "\n".join([f"{r['title']}\n{r['url']}" for r in result["results"]])
+        record_span("llm_total", start, time.perf_counter())
+    count_llm_tokens(messages, answer)
+
+
+async def compose_answer(query: str, use_cache: bool = True, fan_out: bool = False, read_pages: bool = False):
+    """Search (+ read the pages) + llm; returns the answer and the sources separately."""
+    try:
+        with span("search", fan_out=fan_out):
+            result = await timed_search(query, use_cache, fan_out)
+    except Overloaded:
+        # answering without sources would only move the pile-up to the llm
+        raise
+    except Exception as e:
+        # tavily is down (or its breaker is open); an answer without sources is better than no answer
+        print(f"search failed, answering without sources: {e!r}")
+        return {"answer": await simple_response(query), "sources": "", "degraded": True}
+
+    if read_pages:
+        result = await add_passages(query, result)
+    answer = await invoke_llm(build_messages(query, result))
+    return {"answer": answer, "sources": format_sources(result)}
+
+
+async def get_info(query: str, use_cache: bool = True, fan_out: bool = False, read_pages: bool = False):
+    # answers from the full pages are kept out of the answer cache, so they don't replace the snippet answers;
+    # the search results and the page texts are still cached
+    variant = answer_variant(fan_out)
+    cached = answer_cache.get(query, variant) if use_cache and not read_pages else None
+    if cached is None:
+        if read_pages:
+            cached = await compose_answer(query, use_cache, fan_out, read_pages)
+        elif shared_store is not None:
+            cached = await shared_store.get_or_compute("answers", answer_key(query, fan_out), answer_cache.ttl,
+                                                       lambda: compose_answer(query, use_cache, fan_out), use_cache,
+                                                       should_store=lambda value: not value.get("degraded"))
+        else:
+            cached = await compose_answer(query, use_cache, fan_out)
+        # degraded answers (no sources) are not cached, the next request should try the search again
+        if not cached.get("degraded") and not read_pages:
+            answer_cache.put(query, cached, variant)
 
     return (
-            response.content + sources)
+            cached["answer"] + cached["sources"])
+
+
+async def stream_info(query: str, use_cache: bool = True, fan_out: bool = False, read_pages: bool = False):
+    """Same as get_info, but yields the answer token by token and the sources as a trailing event."""
+    variant = answer_variant(fan_out)
+    cached = answer_cache.get(query, variant) if use_cache and not read_pages else None
+    if cached is None and use_cache and not read_pages and shared_store is not None:
+        cached = await shared_store.get("answers", answer_key(query, fan_out))
+    if cached is not None:
+        yield {"event": "token", "data": cached["answer"]}
+        yield {"event": "sources", "data": cached["sources"]}
+        return
+
+    try:
+        with span("search", fan_out=fan_out):
+            result = await timed_search(query, use_cache, fan_out)
+    except Overloaded:
+        raise
+    except Exception as e:
+        print(f"search failed, answering without sources: {e!r}")
+        async for event in stream_simple_response(query):
+            yield event
+        return
+
+    if read_pages:
+        result = await add_passages(query, result)
+    answer = ""
+    async for token in stream_llm(build_messages(query, result)):
+        answer += token
+        yield {"event": "token", "data": token}
+
+    sources = format_sources(result)
+    if read_pages:
+        yield {"event": "sources", "data": sources}
+        return
+    answer_cache.put(query, {"answer": answer, "sources": sources}, variant)
+    if shared_store is not None:
+        await shared_store.put("answers", answer_key(query, fan_out), {"answer": answer, "sources": sources},
+                               answer_cache.ttl)
+    yield {"event": "sources", "data": sources}
 
 
-async def simple_response(prompt: str, model: ChatOpenAI = llm):
+async def simple_response(prompt: str, model: ChatOpenAI = None):
     try:
-        response = await model.ainvoke(prompt)
+        return await invoke_llm(prompt, model)
     except openai.AuthenticationError as e:
         print(f"yo the API key isnt right: \n{e}")
         return "wrong key provided"
-    return response.content
+
+
+async def stream_simple_response(prompt: str, model: ChatOpenAI = None):
+    """Streaming version of simple_response; yields token events."""
+    try:
+        async for token in stream_llm(prompt, model):
+            yield {"event": "token", "data": token}
+    except openai.AuthenticationError as e:
+        print(f"yo the API key isnt right: \n{e}")
+        yield {"event": "error", "data": "wrong key provided"}
 
 
 if __name__ == "__main__":
@@ -61,7 +438,7 @@ if __name__ == "__main__":
     print("-" * 50)
 
     # check the function
-    output = asyncio.run(simple_response("hey wassup", model=llm))
+    output = asyncio.run(simple_response("hey wassup"))
     print(output)
 
     output = asyncio.run(get_info("dimebag darrell"))
@@ -0,0 +1,229 @@
+import asyncio
+import codecs
+import time
+from urllib.parse import urldefrag
+from html.parser import HTMLParser
+import httpx
+from cache import SearchCache
+from context import relevance_scores
+from resilience import remaining
+
+
+# tavily only gives a short snippet per result; the "read pages" mode downloads the result pages themselves,
+# turns them into text and keeps only the passages that are relevant to the question
+
+# everything inside these tags is not part of the content
+SKIP_TAGS = {"script", "style", "noscript", "head", "nav", "header", "footer", "aside", "form", "svg", "iframe",
+             "template", "button"}
+# these start a new line, so paragraphs don't get glued together
+BLOCK_TAGS = {"p", "div", "br", "li", "ul", "ol", "tr", "td", "th", "table", "section", "article", "main", "pre",
+              "blockquote", "h1", "h2", "h3", "h4", "h5", "h6", "dd", "dt", "figcaption"}
+
+
+class TextExtractor(HTMLParser):
+    """HTML to plain text, fed chunk by chunk while the page is downloading; stops collecting at max_chars."""
+
+    def __init__(self, max_chars: int = 100_000):
+        super().__init__(convert_charrefs=True)
+        self.max_chars = max_chars
+        self.parts = []
+        self.chars = 0
+        self._skip = 0
+
+    @property
+    def full(self):
+        return self.chars >= self.max_chars
+
+    def handle_starttag(self, tag, attrs):
+        if tag in SKIP_TAGS:
+            self._skip += 1
+        elif tag in BLOCK_TAGS:
+            self.parts.append("\n")
+
+    def handle_endtag(self, tag):
+        if tag in SKIP_TAGS:
+            self._skip = max(self._skip - 1, 0)
+        elif tag in BLOCK_TAGS:
+            self.parts.append("\n")
+
+    def handle_data(self, data):
+        if self._skip or self.full:
+            return
+        self.parts.append(data)
+        self.chars += len(data)
+
+    def text(self):
+        lines = (" ".join(line.split()) for line in "".join(self.parts).splitlines())
+        return "\n".join(line for line in lines if line)
+
+
+def split_passages(text: str, size: int = 120):
+    """Cut the text into passages of about `size` words, along the paragraphs where possible."""
+    passages, current = [], []
+    for paragraph in text.split("\n"):
+        words = paragraph.split()
+        # a paragraph that is too long on its own is cut up
+        while len(words) > size:
+            if current:
+                passages.append(" ".join(current))
+                current = []
+            passages.append(" ".join(words[:size]))
+            words = words[size:]
+        if current and len(current) + len(words) > size:
+            passages.append(" ".join(current))
+            current = []
+        current += words
+    if current:
+        passages.append(" ".join(current))
+    return passages
+
+
+def select_passages(query: str, pages: list, max_passages: int = 8, size: int = 120):
+    """The most relevant passages of the pages, as search results (title/url/score of the page they come from).
+
+    `pages` is a list of (result, text). Passages without any word of the query are never picked.
+    """
+    passages, owners = [], []
+    for result, text in pages:
+        for passage in split_passages(text, size):
+            passages.append(passage)
+            owners.append(result)
+    scores = relevance_scores(query, passages)
+    ranked = sorted((i for i in range(len(passages)) if scores[i] > 0), key=lambda i: -scores[i])
+    return [{"title": owners[i].get("title", ""), "url": owners[i]["url"], "content": passages[i],
+             "score": owners[i].get("score", 0)} for i in ranked[:max_passages]]
+
+
+class PageFetcher:
+    """Downloads pages concurrently through one bounded connection pool.
+
+    Every page gets at most page_timeout seconds and max_bytes bytes (the rest is not downloaded), and the whole
+    batch at most total_timeout seconds: pages that are not there by then are dropped, not waited for. The text of
+    the pages is cached for a while, since the same results come back for similar questions.
+    """
+
+    def __init__(self, max_connections: int = 10, page_timeout: float = 2, total_timeout: float = 3,
+                 max_bytes: int = 512 * 1024, max_chars: int = 100_000, cache_ttl: float = 900,
+                 cache_max_bytes: int = 16 * 1024 * 1024):
+        self.max_connections = max_connections
+        self.page_timeout = page_timeout
+        self.total_timeout = total_timeout
+        self.max_bytes = max_bytes
+        self.max_chars = max_chars
+        # keyed on the exact url: paths and queries are case sensitive, only the #fragment never reaches the server
+        self.cache = SearchCache(ttl=cache_ttl, max_entries=4096, max_bytes=cache_max_bytes,
+                                 key=lambda url: urldefrag(url).url)
+        self._client = None
+        self.fetched = 0
+        self.failed = 0
+        self.dropped = 0
+        self.truncated = 0
+        self.bytes = 0
+
+    def client(self):
+        if self._client is None:
+            self._client = httpx.AsyncClient(
+                limits=httpx.Limits(max_connections=self.max_connections,
+                                    max_keepalive_connections=self.max_connections),
+                timeout=httpx.Timeout(self.page_timeout), follow_redirects=True,
+                headers={"User-Agent": "Mozilla/5.0 (compatible; enigma-workshop-reader)"})
+        return self._client
+
+    async def fetch(self, url: str):
+        """The text of one page; HTML is turned into text while it comes in, and the download stops at max_bytes."""
+        cached = self.cache.get(url)
+        if cached is not None:
+            return cached
+
+        parser = TextExtractor(self.max_chars)
+        received = 0
+        async with self.client().stream("GET", url) as response:
+            response.raise_for_status()
+            content_type = response.headers.get("content-type", "text/html")
+            if "html" not in content_type and "text/plain" not in content_type:
+                # pdfs, images, ...
+                raise ValueError(f"not a text page: {content_type}")
+            try:
+                decoder = codecs.getincrementaldecoder(response.charset_encoding or "utf-8")(errors="replace")
+            except LookupError:
+                decoder = codecs.getincrementaldecoder("utf-8")(errors="replace")
+
+            async for chunk in response.aiter_bytes():
+                received += len(chunk)
+                parser.feed(decoder.decode(chunk))
+                if received >= self.max_bytes or parser.full:
+                    self.truncated += 1
+                    break
+        self.bytes += received
+
+        text = parser.text()
+        self.cache.put(url, text)
+        return text
+
+    async def fetch_all(self, urls: list):
+        """Fetch all urls at the same time; returns {url: text} of the pages that made it in time and a report."""
+        start = time.perf_counter()
+        budget = self.total_timeout
+        left = remaining()
+        if left is not None:
+            # leave the llm some time of the request deadline
+            budget = min(budget, max(left / 2, 0))
+
+        # fan-out results can link the same page twice
+        urls = list(dict.fromkeys(urls))
+        tasks = {asyncio.create_task(asyncio.wait_for(self.fetch(url), self.page_timeout)): url for url in urls}
+        try:
+            done, pending = await asyncio.wait(tasks, timeout=budget) if tasks else (set(), set())
+        finally:
+            for task in tasks:
+                task.cancel()
+
+        texts, failed, dropped = {}, 0, len(pending)
+        for task in done:
+            error = task.exception()
+            if isinstance(error, asyncio.TimeoutError):
+                dropped += 1
+            elif error is not None:
+                failed += 1
+                print(f"could not read {tasks[task]}: {error!r}")
+            elif task.result():
+                texts[tasks[task]] = task.result()
+        if pending:
+            await asyncio.gather(*pending, return_exceptions=True)
+
+        self.fetched += len(texts)
+        self.failed += failed
+        self.dropped += dropped
+        report = {"pages": len(urls), "pages_read": len(texts), "pages_failed": failed, "pages_dropped": dropped,
+                  "fetch_ms": round((time.perf_counter() - start) * 1000, 1)}
+        return texts, report
+
+    async def close(self):
+        if self._client is not None:
+            await self._client.aclose()
+
+    def stats(self):
+        return {
+            "fetched": self.fetched,
+            "failed": self.failed,
+            "dropped": self.dropped,
+            "truncated": self.truncated,
+            "bytes": self.bytes,
+            "max_connections": self.max_connections,
+            "cache": self.cache.stats(),
+        }
+
+
+if __name__ == "__main__":
+    # python pages.py "question" url1 url2 ...; try it against the local stand-in (python -m loadtest.page_server)
+    import sys
+
+    async def demo(query: str, urls: list):
+        fetcher = PageFetcher()
+        texts, report = await fetcher.fetch_all(urls)
+        print(report)
+        for passage in select_passages(query, [({"url": url}, text) for url, text in texts.items()], 3):
+            print(f"\n{passage['url']}\n{passage['content'][:300]}...")
+        await fetcher.close()
+
+    asyncio.run(demo(sys.argv[1], sys.argv[2:]))
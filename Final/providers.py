@@ -0,0 +1,247 @@
+import asyncio
+import random
+import re
+import time
+from langchain_core.messages import AIMessage
+from resilience import DeadlineExceeded, remaining
+
+
+def make_chat_model(provider: str, model: str):
+    """Build the langchain chat model for "openai", "anthropic" or "google"; the last two are optional installs."""
+    if provider == "openai":
+        from langchain_openai import ChatOpenAI
+        return ChatOpenAI(model=model)
+    if provider == "anthropic":
+        from langchain_anthropic import ChatAnthropic
+        return ChatAnthropic(model=model)
+    if provider == "google":
+        from langchain_google_genai import ChatGoogleGenerativeAI
+        return ChatGoogleGenerativeAI(model=model)
+    if provider == "fake":
+        from loadtest.fakes import FakeChatModel
+        return FakeChatModel()
+    raise ValueError(f"unknown llm provider: {provider}")
+
+
+def is_rate_limit(error: Exception):
+    return "RateLimit" in type(error).__name__ or getattr(error, "status_code", None) == 429
+
+
+# answers that give up or hedge; the cascade asks the larger model instead
+UNSURE = re.compile(r"\b(i'?m not sure|i don'?t know|i do not know|i cannot|i can'?t (help|answer)|as an ai|"
+                    r"no information)\b", re.IGNORECASE)
+
+
+def confident(answer: str, min_chars: int = 40):
+    """Cheap check if the answer of the small model is good enough."""
+    return len(answer.strip()) >= min_chars and not UNSURE.search(answer)
+
+
+class Provider:
+    def __init__(self, name: str, model, weight: float = 1):
+        self.name = name
+        self.model = model
+        self.weight = weight
+        self.calls = 0
+        self.errors = 0
+        self.rate_limited = 0
+        self.timeouts = 0
+        self.cancelled = 0
+        # moving averages, so routing follows how the provider does right now
+        self.latency = None
+        self.error_rate = 0.0
+        self.cooldown_until = 0.0
+
+    def available(self):
+        return time.monotonic() >= self.cooldown_until
+
+    def record(self, seconds: float = None, error: Exception = None, alpha: float = 0.2):
+        if isinstance(error, asyncio.CancelledError):
+            # the caller gave up (a new prompt, a disconnect, a hedge that won); says nothing about the provider
+            self.cancelled += 1
+            return
+        self.calls += 1
+        self.error_rate = (1 - alpha) * self.error_rate + alpha * (error is not None)
+        if error is None:
+            self.latency = seconds if self.latency is None else (1 - alpha) * self.latency + alpha * seconds
+            return
+        self.errors += 1
+        if isinstance(error, TimeoutError):
+            self.timeouts += 1
+        elif is_rate_limit(error):
+            self.rate_limited += 1
+            retry_after = getattr(getattr(error, "response", None), "headers", {}).get("retry-after")
+            self.cooldown_until = time.monotonic() + (float(retry_after) if retry_after else 10)
+
+    def stats(self):
+        return {
+            "weight": self.weight,
+            "calls": self.calls,
+            "errors": self.errors,
+            "rate_limited": self.rate_limited,
+            "timeouts": self.timeouts,
+            "cancelled": self.cancelled,
+            "latency_ms": None if self.latency is None else round(self.latency * 1000, 1),
+            "error_rate": round(self.error_rate, 3),
+            "cooling_down": not self.available(),
+        }
+
+
+class ProviderPool:
+    """Spreads llm calls over several chat models and behaves like one (ainvoke/astream).
+
+    - routing: "weighted" picks by the configured weights, "latency" favours the providers that are fast and
+      error-free right now (weight / measured latency, scaled down by the recent error rate)
+    - failover: when a provider errors (rate limit, outage) or takes longer than `timeout` the next one is tried;
+      rate limited providers are skipped until their Retry-After has passed
+    - cascade: with a `large` provider, an answer that fails the `confident` check is asked again to the large model
+    """
+
+    def __init__(self, providers: list, routing: str = "weighted", large: Provider = None, check=confident,
+                 timeout: float = 10):
+        self.providers = providers
+        self.routing = routing
+        self.large = large
+        self.check = check
+        # seconds one provider gets (for the whole answer, or for the first chunk of a stream) before the next one
+        self.timeout = timeout
+        self.cascaded = 0
+
+    def _budget(self):
+        """The time the next provider gets, and whether the request deadline made it shorter than usual."""
+        left = remaining()
+        if left is None or left >= self.timeout:
+            return self.timeout, False
+        if left <= 0:
+            raise DeadlineExceeded("request deadline passed before calling the llm providers")
+        return left, True
+
+    def _score(self, provider: Provider):
+        if self.routing != "latency":
+            return provider.weight
+        known = [p.latency for p in self.providers if p.latency]
+        # a provider without measurements yet gets the best known latency, so it gets tried
+        latency = provider.latency or (min(known) if known else 1.0)
+        return provider.weight / latency * (1 - provider.error_rate) + 1e-6
+
+    def order(self):
+        """Providers in the order to try them: one weighted random pick first, the rest by score."""
+        candidates = [p for p in self.providers if p.available()] or list(self.providers)
+        first = random.choices(candidates, [self._score(p) for p in candidates])[0]
+        rest = sorted((p for p in candidates if p is not first), key=self._score, reverse=True)
+        return [first] + rest
+
+    async def _invoke(self, providers: list, messages, **kwargs):
+        error = None
+        for provider in providers:
+            budget, cut = self._budget()
+            start = time.monotonic()
+            try:
+                response = await asyncio.wait_for(provider.model.ainvoke(messages, **kwargs), budget)
+            except asyncio.CancelledError as e:
+                provider.record(error=e)
+                raise
+            except TimeoutError as e:
+                if cut:
+                    # the request ran out of time, not the provider; the next one wouldn't have any either
+                    raise DeadlineExceeded("request deadline passed while calling the llm providers") from e
+                provider.record(error=e)
+                print(f"llm provider {provider.name} took longer than {budget:g}s, trying the next one")
+                error = e
+                continue
+            except Exception as e:
+                provider.record(error=e)
+                print(f"llm provider {provider.name} failed, trying the next one: {e!r}")
+                error = e
+                continue
+            provider.record(time.monotonic() - start)
+            return response
+        raise error
+
+    async def ainvoke(self, messages, **kwargs):
+        response = await self._invoke(self.order(), messages, **kwargs)
+        if self.large is not None and not self.check(response.content):
+            self.cascaded += 1
+            try:
+                return await self._invoke([self.large], messages, **kwargs)
+            except Exception as e:
+                # the small answer is still better than none
+                print(f"cascade to {self.large.name} failed: {e!r}")
+        return response
+
+    async def astream(self, messages, **kwargs):
+        # failover only works until the first chunk went out; the cascade would need the whole answer first,
+        # so streams are answered by the pool only
+        error = None
+        for provider in self.order():
+            start = time.monotonic()
+            started = False
+            stream = provider.model.astream(messages, **kwargs).__aiter__()
+            try:
+                # the budget covers the first chunk; after that the chunks are timed by the caller (UpstreamPolicy)
+                budget, cut = self._budget()
+                while True:
+                    try:
+                        chunk = await (stream.__anext__() if started else asyncio.wait_for(stream.__anext__(), budget))
+                    except StopAsyncIteration:
+                        break
+                    started = True
+                    yield chunk
+            except asyncio.CancelledError as e:
+                provider.record(error=e)
+                raise
+            except TimeoutError as e:
+                if cut:
+                    raise DeadlineExceeded("request deadline passed while calling the llm providers") from e
+                provider.record(error=e)
+                print(f"llm provider {provider.name} sent nothing for {budget:g}s, trying the next one")
+                error = e
+                continue
+            except Exception as e:
+                provider.record(error=e)
+                if started:
+                    raise
+                print(f"llm provider {provider.name} failed, trying the next one: {e!r}")
+                error = e
+                continue
+            finally:
+                if hasattr(stream, "aclose"):
+                    await stream.aclose()
+            provider.record(time.monotonic() - start)
+            return
+        raise error
+
+    def stats(self):
+        stats = {"routing": self.routing, "cascaded": self.cascaded,
+                 "providers": {p.name: p.stats() for p in self.providers}}
+        if self.large is not None:
+            stats["large"] = {self.large.name: self.large.stats()}
+        return stats
+
+
+def parse_providers(spec: str):
+    """"openai:gpt-4o-mini:3,anthropic:claude-3-5-haiku-latest:1" -> list of Providers (weight defaults to 1)."""
+    providers = []
+    for item in filter(None, (part.strip() for part in spec.split(","))):
+        parts = item.split(":")
+        weight = float(parts[2]) if len(parts) > 2 else 1
+        providers.append(Provider(f"{parts[0]}:{parts[1]}", make_chat_model(parts[0], parts[1]), weight))
+    return providers
+
+
+if __name__ == "__main__":
+    # offline demo with fake models: a fast flaky one, a slow reliable one and a large model for the cascade
+    from loadtest.fakes import FakeChatModel
+
+    pool = ProviderPool([Provider("fast", FakeChatModel(latency_ms=50, error_rate=0.3, tokens=5, sigma=0.1)),
+                         Provider("slow", FakeChatModel(latency_ms=300, tokens=30, sigma=0.1))],
+                        routing="latency",
+                        large=Provider("large", FakeChatModel(latency_ms=500, tokens=50, sigma=0.1)))
+
+    async def demo():
+        for _ in range(30):
+            response = await pool.ainvoke("hey wassup")
+            assert isinstance(response, AIMessage)
+        print(pool.stats())
+
+    asyncio.run(demo())
@@ -0,0 +1,206 @@
+import asyncio
+import json
+import os
+import time
+import uuid
+from cache import normalize_query
+
+
+class HotQueryRefresher:
+    """Keeps the answers to the most popular questions pre-computed (stale-while-revalidate).
+
+    Every question is counted (with decay, so old popularity fades). For the top_k questions the answer is kept here:
+    a request gets it immediately while it is younger than max_stale, and once it is older than fresh_for a refresh
+    is started in the background. A loop also refreshes hot answers before they get stale, with at most
+    `concurrency` refreshes at a time and none while the live traffic is busy.
+
+    With a shared store (several workers) only the worker holding the "hot-queries" lease refreshes and saves the
+    file; it puts the fresh answers into the store and the other workers take them from there every tick.
+    """
+
+    def __init__(self, compute, top_k: int = 50, fresh_for: float = 300, max_stale: float = 3600,
+                 interval: float = 30, decay: float = 0.9, concurrency: int = 2, busy=lambda: False,
+                 path: str = None, store=None):
+        self.compute = compute
+        self.top_k = top_k
+        self.fresh_for = fresh_for
+        self.max_stale = max_stale
+        self.interval = interval
+        self.decay = decay
+        self.busy = busy
+        self.path = path
+        self.shared = store
+        self.worker_id = uuid.uuid4().hex
+        self.leader = store is None
+        self._semaphore = asyncio.Semaphore(concurrency)
+
+        # key -> decayed request count
+        self.counts = {}
+        # key -> {"prompt", "value", "fetched_at" (time.time())}
+        self.entries = {}
+        self._refreshing = set()
+        # count the top_k-th question had at the last tick
+        self._hot_threshold = 0
+        self._tasks = set()
+        self.hits = 0
+        self.stale_hits = 0
+        self.refreshes = 0
+        self.refresh_errors = 0
+
+    def record(self, prompt: str):
+        key = normalize_query(prompt)
+        self.counts[key] = self.counts.get(key, 0) + 1
+        # the threshold is updated every tick, so a request doesn't have to sort all the counts
+        if key not in self.entries and self.counts[key] >= self._hot_threshold:
+            self.entries[key] = {"prompt": prompt, "value": None, "fetched_at": 0}
+
+    def hot_keys(self):
+        return sorted(self.counts, key=self.counts.get, reverse=True)[:self.top_k]
+
+    def get(self, prompt: str):
+        """The kept answer if there is one that isn't too old; starts a background refresh if it isn't fresh."""
+        entry = self.entries.get(normalize_query(prompt))
+        if entry is None or entry["value"] is None:
+            return None
+        age = time.time() - entry["fetched_at"]
+        if age > self.max_stale:
+            return None
+        if age > self.fresh_for:
+            self.stale_hits += 1
+            if self.leader:
+                self.schedule(normalize_query(prompt))
+        self.hits += 1
+        return entry["value"]
+
+    def store(self, prompt: str, value):
+        """Keep an answer that was computed by a live request, if the question is hot."""
+        key = normalize_query(prompt)
+        if key in self.entries:
+            self.entries[key].update(value=value, fetched_at=time.time())
+
+    def schedule(self, key: str):
+        if key in self._refreshing or key not in self.entries:
+            return
+        self._refreshing.add(key)
+        task = asyncio.create_task(self._refresh(key))
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+
+    async def _refresh(self, key: str):
+        try:
+            async with self._semaphore:
+                entry = self.entries.get(key)
+                if entry is None:
+                    return
+                value = await self.compute(entry["prompt"])
+                entry.update(value=value, fetched_at=time.time())
+                self.refreshes += 1
+                if self.shared is not None:
+                    await self.shared.put("hot", key, {"value": value, "fetched_at": entry["fetched_at"]},
+                                         self.max_stale)
+        except Exception as e:
+            # the old answer stays; it is retried at the next tick
+            self.refresh_errors += 1
+            print(f"refreshing '{key}' failed: {e!r}")
+        finally:
+            self._refreshing.discard(key)
+
+    def tick(self):
+        """Decay the counts, drop questions that are not hot anymore and refresh the ones that are about to expire."""
+        for key in list(self.counts):
+            self.counts[key] *= self.decay
+            if self.counts[key] < 0.05:
+                del self.counts[key]
+
+        hot_keys = self.hot_keys()
+        hot = set(hot_keys)
+        self._hot_threshold = self.counts[hot_keys[-1]] if len(hot_keys) == self.top_k else 0
+        for key in list(self.entries):
+            if key not in hot:
+                del self.entries[key]
+
+        if not self.leader or self.busy():
+            return
+        # refresh a bit before fresh_for runs out, so popular questions are never served stale
+        refresh_after = self.fresh_for - 2 * self.interval
+        now = time.time()
+        for key in hot:
+            entry = self.entries.get(key)
+            if entry is not None and now - entry["fetched_at"] > refresh_after:
+                self.schedule(key)
+
+    async def elect(self):
+        # the lease outlives a few ticks, so a leader that died is replaced within 3 intervals
+        was_leader = self.leader
+        self.leader = await self.shared.lead("hot-queries", self.worker_id, 3 * self.interval)
+        if self.leader and not was_leader:
+            print("this worker refreshes the hot queries now")
+
+    async def pull(self):
+        """Take the answers the leader refreshed for the questions that are hot here too."""
+        for key, entry in list(self.entries.items()):
+            fresh = await self.shared.get("hot", key)
+            if fresh is not None and fresh["fetched_at"] > entry["fetched_at"]:
+                entry.update(value=fresh["value"], fetched_at=fresh["fetched_at"])
+
+    async def run(self):
+        while True:
+            await asyncio.sleep(self.interval)
+            if self.shared is not None:
+                try:
+                    await self.elect()
+                except Exception as e:
+                    # can't tell if another worker leads; better no refresh for a tick than one per worker
+                    self.leader = False
+                    print(f"hot query lease failed: {e!r}")
+            self.tick()
+            if not self.leader:
+                try:
+                    await self.pull()
+                except Exception as e:
+                    print(f"taking the refreshed hot answers failed: {e!r}")
+                continue
+            self.save()
+
+    def save(self):
+        if not self.path:
+            return
+        os.makedirs(os.path.dirname(os.path.abspath(self.path)), exist_ok=True)
+        tmp = f"{self.path}.{os.getpid()}.tmp"
+        with open(tmp, "w") as f:
+            json.dump({"counts": self.counts, "entries": self.entries}, f)
+            f.flush()
+            os.fsync(f.fileno())
+        # rename is atomic, so a crash while saving never leaves a half written file
+        os.replace(tmp, self.path)
+
+    def load(self):
+        if not self.path or not os.path.exists(self.path):
+            return 0
+        try:
+            with open(self.path) as f:
+                data = json.load(f)
+        except (OSError, ValueError) as e:
+            print(f"could not load the hot queries: {e!r}")
+            return 0
+        self.counts = data.get("counts", {})
+        self.entries = data.get("entries", {})
+        return len(self.entries)
+
+    async def stop(self):
+        for task in list(self._tasks):
+            task.cancel()
+        if self.leader:
+            self.save()
+
+    def stats(self):
+        return {
+            "tracked": len(self.counts),
+            "hot": len(self.entries),
+            "hits": self.hits,
+            "stale_hits": self.stale_hits,
+            "refreshes": self.refreshes,
+            "refresh_errors": self.refresh_errors,
+            "refreshing": len(self._refreshing),
+            "leader": self.leader,
+        }
@@ -0,0 +1,272 @@
+import asyncio
+import random
+import time
+from collections import deque
+from contextlib import contextmanager
+from contextvars import ContextVar
+
+
+class CircuitOpenError(Exception):
+    """Raised instead of calling an upstream that has been failing; retry_after is in seconds."""
+
+    def __init__(self, name: str, retry_after: float):
+        super().__init__(f"{name} is unavailable, circuit breaker is open")
+        self.name = name
+        self.retry_after = retry_after
+
+
+class DeadlineExceeded(TimeoutError):
+    pass
+
+
+# end-to-end deadline of the current request (time.monotonic() value); tasks created inside inherit it
+_deadline = ContextVar("deadline", default=None)
+
+
+@contextmanager
+def deadline(seconds: float):
+    token = _deadline.set(time.monotonic() + seconds)
+    try:
+        yield
+    finally:
+        _deadline.reset(token)
+
+
+def remaining():
+    """Seconds left until the request deadline, or None if there is no deadline."""
+    end = _deadline.get()
+    return None if end is None else end - time.monotonic()
+
+
+async def within_deadline(events, seconds: float):
+    """Pass the items of an async generator (a streamed answer) through for at most `seconds` in total, then end it
+    with DeadlineExceeded. The upstream calls made for the items get the deadline too, like with `deadline`."""
+    end = time.monotonic() + seconds
+    # set() instead of reset(): a generator that is never finished is closed later, in another context
+    previous = _deadline.get()
+    _deadline.set(end)
+    iterator = events.__aiter__()
+    try:
+        while True:
+            try:
+                item = await asyncio.wait_for(iterator.__anext__(), end - time.monotonic())
+            except StopAsyncIteration:
+                return
+            except TimeoutError as e:
+                if time.monotonic() < end:
+                    # a timeout of the upstream itself
+                    raise
+                raise DeadlineExceeded(f"request deadline of {seconds:g}s passed while streaming") from e
+            yield item
+    finally:
+        _deadline.set(previous)
+        if hasattr(iterator, "aclose"):
+            await iterator.aclose()
+
+
+class CircuitBreaker:
+    """Stops calling an upstream after a number of failures in a row, and lets one trial call through
+    after reset_timeout to see if it is back."""
+
+    def __init__(self, name: str, failure_threshold: int = 5, reset_timeout: float = 30):
+        self.name = name
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.state = "closed"
+        self.consecutive_failures = 0
+        self.opened_at = 0.0
+        self.trips = 0
+        self._trial_running = False
+
+    def check(self):
+        if self.state == "open":
+            waited = time.monotonic() - self.opened_at
+            if waited < self.reset_timeout:
+                raise CircuitOpenError(self.name, self.reset_timeout - waited)
+            self.state = "half_open"
+        if self.state == "half_open":
+            if self._trial_running:
+                raise CircuitOpenError(self.name, self.reset_timeout)
+            self._trial_running = True
+
+    def release_trial(self):
+        # the trial call was cancelled or ran out of the request's time, so it told us nothing; let the next call try
+        self._trial_running = False
+
+    def record_success(self):
+        self.state = "closed"
+        self.consecutive_failures = 0
+        self._trial_running = False
+
+    def record_failure(self):
+        self.consecutive_failures += 1
+        self._trial_running = False
+        if self.state == "half_open" or self.consecutive_failures >= self.failure_threshold:
+            if self.state != "open":
+                self.trips += 1
+                print(f"circuit breaker for {self.name} opened after {self.consecutive_failures} failures")
+            self.state = "open"
+            self.opened_at = time.monotonic()
+
+    def stats(self):
+        return {
+            "state": self.state,
+            "consecutive_failures": self.consecutive_failures,
+            "trips": self.trips,
+        }
+
+
+class UpstreamPolicy:
+    """Timeout, retries with exponential backoff and full jitter, optional hedging and a circuit breaker
+    around the calls to one upstream service."""
+
+    def __init__(self, name: str, timeout: float = 10, retries: int = 2, backoff_base: float = 0.2,
+                 backoff_max: float = 2, hedge: bool = False, hedge_min_samples: int = 20,
+                 failure_threshold: int = 5, reset_timeout: float = 30, no_retry: tuple = ()):
+        self.name = name
+        self.timeout = timeout
+        self.retries = retries
+        self.backoff_base = backoff_base
+        self.backoff_max = backoff_max
+        self.hedge = hedge
+        self.hedge_min_samples = hedge_min_samples
+        # errors that will not get better by trying again (e.g. a wrong API key)
+        self.no_retry = no_retry
+        self.breaker = CircuitBreaker(name, failure_threshold, reset_timeout)
+
+        self._latencies = deque(maxlen=500)
+        self.calls = 0
+        self.failures = 0
+        self.timeouts = 0
+        self.retried = 0
+        self.hedged = 0
+        # calls that ran out of the request's own deadline; they say nothing about the upstream
+        self.deadline_exceeded = 0
+
+    def p95(self):
+        if not self._latencies:
+            return None
+        ordered = sorted(self._latencies)
+        return ordered[int(0.95 * (len(ordered) - 1))]
+
+    def _attempt_timeout(self):
+        """The timeout of the next attempt, and whether the request deadline made it shorter than usual."""
+        left = remaining()
+        if left is None or left >= self.timeout:
+            return self.timeout, False
+        if left <= 0:
+            raise DeadlineExceeded(f"request deadline passed before calling {self.name}")
+        return left, True
+
+    async def _attempt(self, func, args, kwargs):
+        timeout, cut = self._attempt_timeout()
+        first = asyncio.ensure_future(asyncio.wait_for(func(*args, **kwargs), timeout))
+        tasks = {first}
+        try:
+            if self.hedge and len(self._latencies) >= self.hedge_min_samples:
+                # if the call is slower than 95% of the earlier ones, send a second one and take whichever is first
+                delay = self.p95()
+                done, _ = await asyncio.wait(tasks, timeout=delay)
+                if not done and timeout - delay > 0:
+                    self.hedged += 1
+                    tasks.add(asyncio.ensure_future(asyncio.wait_for(func(*args, **kwargs), timeout - delay)))
+
+            error = None
+            while tasks:
+                done, tasks = await asyncio.wait(tasks, return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    if task.exception() is None:
+                        return task.result()
+                    error = task.exception()
+            if cut and isinstance(error, TimeoutError):
+                # the request ran out of time, the upstream was still within its timeout
+                raise DeadlineExceeded(f"request deadline passed while calling {self.name}") from error
+            raise error
+        finally:
+            for task in tasks:
+                task.cancel()
+
+    async def call(self, func, *args, **kwargs):
+        self.calls += 1
+        for attempt in range(self.retries + 1):
+            self.breaker.check()
+            start = time.monotonic()
+            try:
+                result = await self._attempt(func, args, kwargs)
+            except asyncio.CancelledError:
+                self.breaker.release_trial()
+                raise
+            except DeadlineExceeded:
+                # not the upstream's fault: no failure for the breaker, and no time left for a retry
+                self.deadline_exceeded += 1
+                self.breaker.release_trial()
+                raise
+            except self.no_retry:
+                self.breaker.record_success()
+                raise
+            except Exception as e:
+                self._record_failure(e)
+                left = remaining()
+                delay = random.uniform(0, min(self.backoff_max, self.backoff_base * 2 ** attempt))
+                if attempt == self.retries or self.breaker.state == "open" or (left is not None and left <= delay):
+                    raise
+                self.retried += 1
+                await asyncio.sleep(delay)
+            else:
+                self._latencies.append(time.monotonic() - start)
+                self.breaker.record_success()
+                return result
+
+    async def stream(self, func, *args, **kwargs):
+        """Like call, for async generators. The timeout is applied to the wait for every chunk; there are no retries
+        because the chunks that were already sent to the client can't be taken back."""
+        self.calls += 1
+        self.breaker.check()
+        iterator = func(*args, **kwargs).__aiter__()
+        try:
+            while True:
+                timeout, cut = self._attempt_timeout()
+                try:
+                    chunk = await asyncio.wait_for(iterator.__anext__(), timeout)
+                except StopAsyncIteration:
+                    break
+                except TimeoutError as e:
+                    if cut:
+                        raise DeadlineExceeded(f"request deadline passed while streaming from {self.name}") from e
+                    raise
+                yield chunk
+        except DeadlineExceeded:
+            self.deadline_exceeded += 1
+            raise
+        except self.no_retry:
+            self.breaker.record_success()
+            raise
+        except Exception as e:
+            self._record_failure(e)
+            raise
+        else:
+            self.breaker.record_success()
+        finally:
+            self.breaker.release_trial()
+            if hasattr(iterator, "aclose"):
+                await iterator.aclose()
+
+    def _record_failure(self, error: Exception):
+        self.failures += 1
+        if isinstance(error, TimeoutError):
+            self.timeouts += 1
+        print(f"call to {self.name} failed: {error!r}")
+        self.breaker.record_failure()
+
+    def stats(self):
+        p95 = self.p95()
+        return {
+            "calls": self.calls,
+            "failures": self.failures,
+            "timeouts": self.timeouts,
+            "retries": self.retried,
+            "hedged": self.hedged,
+            "deadline_exceeded": self.deadline_exceeded,
+            "p95_ms": None if p95 is None else round(p95 * 1000, 1),
+            "breaker": self.breaker.stats(),
+        }
@@ -0,0 +1,182 @@
+import asyncio
+import itertools
+import json
+import time
+import uuid
+from pydantic import ValidationError
+from starlette.websockets import WebSocket, WebSocketDisconnect
+import metrics
+from models import QueryRequest
+from utils import timed_events
+
+
+class ChatSession:
+    """One WebSocket connection; holds at most one answer that is being generated (the current turn)."""
+
+    def __init__(self, websocket: WebSocket):
+        self.websocket = websocket
+        self.turn_id = None
+        self.task = None
+        self.last_seen = time.monotonic()
+        self.last_sent = self.last_seen
+        self.ids = itertools.count(1)
+        # the turn and the heartbeat both send, one message at a time
+        self._send_lock = asyncio.Lock()
+
+    async def send(self, event: dict):
+        async with self._send_lock:
+            await self.websocket.send_text(json.dumps(event))
+        self.last_sent = time.monotonic()
+
+    async def cancel_turn(self):
+        """Stop the answer that is being generated (if any) and wait until its "cancelled" event is sent."""
+        task = self.task
+        if task is not None and not task.done():
+            task.cancel()
+            await asyncio.wait([task])
+
+
+class ChatSessions:
+    """The WebSocket chat: a client keeps one connection open and sends prompts over it; the answers come back as
+    the same events as the NDJSON streams (token, sources, error, done), tagged with the id of the prompt, plus
+    status events. A new prompt while an answer is still being generated cancels that answer.
+
+    The middleware only sees the connection, so every turn gets its own request id (the "request_id" of the prompt,
+    like X-Request-ID, or a new one), sent along with all of its events, and its own trace and metrics.
+
+    An idle connection costs one waiting coroutine and a small object; the heartbeat and the idle timeout are
+    handled by a single loop over all the sessions instead of a timer per connection.
+    """
+
+    def __init__(self, answer, max_connections: int = 10000, heartbeat: float = 30, idle_timeout: float = 300):
+        # answer(payload) -> async generator of events
+        self.answer = answer
+        self.max_connections = max_connections
+        self.heartbeat = heartbeat
+        self.idle_timeout = idle_timeout
+        self.sessions = set()
+        self.accepted = 0
+        self.rejected = 0
+        self.idle_closed = 0
+        self.turns = {"done": 0, "cancelled": 0, "error": 0}
+
+    async def serve(self, websocket: WebSocket):
+        await websocket.accept()
+        if len(self.sessions) >= self.max_connections:
+            # 1013: try again later
+            self.rejected += 1
+            await websocket.close(code=1013, reason="too many connections")
+            return
+
+        session = ChatSession(websocket)
+        self.sessions.add(session)
+        self.accepted += 1
+        metrics.websocket_connections.inc()
+        try:
+            while True:
+                text = await websocket.receive_text()
+                session.last_seen = time.monotonic()
+                await self.handle(session, text)
+        except WebSocketDisconnect:
+            pass
+        finally:
+            self.sessions.discard(session)
+            metrics.websocket_connections.dec()
+            # nobody is listening anymore, don't spend tokens on the answer
+            if session.task is not None:
+                session.task.cancel()
+
+    async def handle(self, session: ChatSession, text: str):
+        """One message of the client: {"type": "prompt", "prompt": ..., "id": ..., "request_id": ...},
+        {"type": "cancel"} or {"type": "ping"}; the prompt message takes the same fields as the body of
+        /ask-question."""
+        try:
+            message = json.loads(text)
+            if not isinstance(message, dict):
+                raise ValueError
+        except ValueError:
+            await session.send({"event": "error", "data": "messages have to be JSON objects"})
+            return
+
+        kind = message.pop("type", "prompt")
+        if kind == "ping":
+            await session.send({"event": "pong"})
+        elif kind == "cancel":
+            await session.cancel_turn()
+        elif kind == "prompt":
+            turn_id = message.pop("id", None)
+            request_id = str(message.pop("request_id", None) or uuid.uuid4().hex)
+            try:
+                payload = QueryRequest(**message)
+            except (ValidationError, TypeError) as e:
+                await session.send({"event": "error", "id": turn_id, "request_id": request_id, "data": str(e)})
+                return
+            # a new prompt replaces the one that is still being answered
+            await session.cancel_turn()
+            session.turn_id = turn_id if turn_id is not None else next(session.ids)
+            session.task = asyncio.create_task(self._turn(session, session.turn_id, request_id, payload))
+        else:
+            await session.send({"event": "error", "data": f"unknown message type {kind!r}"})
+
+    async def _turn(self, session: ChatSession, turn_id, request_id: str, payload: QueryRequest):
+        result = "done"
+        path = session.websocket.scope.get("path", "/ws/chat")
+        tag = {"id": turn_id, "request_id": request_id}
+        with metrics.traced(request_id, path) as trace:
+            metrics.in_flight.inc(path=path)
+            try:
+                await session.send({"event": "status", **tag, "data": "started"})
+                answering = False
+                async for event in timed_events(self.answer(payload)):
+                    if event["event"] == "token" and not answering:
+                        answering = True
+                        await session.send({"event": "status", **tag, "data": "answering"})
+                    elif event["event"] == "error":
+                        result = "error"
+                    await session.send({**event, **tag})
+            except asyncio.CancelledError:
+                result = "cancelled"
+                try:
+                    await session.send({"event": "cancelled", **tag})
+                except Exception:
+                    pass
+                raise
+            except Exception:
+                # the client is gone; serve() cleans up
+                result = "error"
+            finally:
+                trace.status = result
+                self.turns[result] += 1
+                metrics.in_flight.dec(path=path)
+                metrics.websocket_turns.inc(result=result)
+                metrics.websocket_turn_seconds.observe(time.perf_counter() - trace.start, result=result)
+
+    async def _beat(self, session: ChatSession, now: float):
+        try:
+            generating = session.task is not None and not session.task.done()
+            if not generating and now - session.last_seen > self.idle_timeout:
+                self.idle_closed += 1
+                await session.websocket.close(code=1000, reason="idle timeout")
+            elif now - session.last_sent >= self.heartbeat:
+                # keeps proxies from dropping a quiet connection, and finds the dead ones
+                await session.send({"event": "ping"})
+        except Exception:
+            # the connection is broken; its receive loop in serve() ends and removes it
+            pass
+
+    async def run(self):
+        """The heartbeat loop; closes the connections that didn't send anything for idle_timeout seconds."""
+        while True:
+            await asyncio.sleep(self.heartbeat)
+            now = time.monotonic()
+            await asyncio.gather(*(self._beat(session, now) for session in list(self.sessions)))
+
+    def stats(self):
+        return {
+            "connections": len(self.sessions),
+            "generating": sum(1 for s in self.sessions if s.task is not None and not s.task.done()),
+            "accepted": self.accepted,
+            "rejected": self.rejected,
+            "idle_closed": self.idle_closed,
+            "turns": self.turns,
+        }
@@ -0,0 +1,312 @@
+import asyncio
+import json
+import os
+import sqlite3
+import threading
+import time
+import uuid
+from abc import ABC, abstractmethod
+from contextlib import asynccontextmanager
+
+try:
+    import redis.asyncio as aioredis
+except ImportError:
+    aioredis = None
+
+
+class SharedStore(ABC):
+    """Cache that is shared by all worker processes (and survives a restart), used behind the in-process caches.
+
+    Subclasses implement get/put/lock/lead; get_or_compute uses the lock so that only one process computes a missing
+    value while the others wait for it (single-flight across processes).
+    """
+
+    @abstractmethod
+    async def get(self, namespace: str, key: str):
+        ...
+
+    @abstractmethod
+    async def put(self, namespace: str, key: str, value, ttl: float):
+        ...
+
+    @abstractmethod
+    def lock(self, name: str):
+        ...
+
+    async def recent(self, namespace: str, limit: int):
+        """The most recently used entries, to warm up the in-process caches after a restart."""
+        return []
+
+    @abstractmethod
+    async def lead(self, name: str, owner: str, lease: float):
+        """Take the lease on name, or renew it if owner already has it; True while owner is the one holding it.
+        Used to pick one worker for a job that only one of them should do."""
+
+    async def get_or_compute(self, namespace: str, key: str, ttl: float, func, use_cache: bool = True,
+                             should_store=lambda value: True):
+        if use_cache:
+            value = await self.get(namespace, key)
+            if value is not None:
+                return value
+
+        async with self.lock(f"{namespace}:{key}"):
+            # another process may have filled it in while we were waiting for the lock
+            if use_cache:
+                value = await self.get(namespace, key)
+                if value is not None:
+                    return value
+            value = await func()
+            if should_store(value):
+                await self.put(namespace, key, value, ttl)
+            return value
+
+
+class SQLiteStore(SharedStore):
+    """SQLite in WAL mode: readers don't block the writer, so many workers can use one file without a server."""
+
+    def __init__(self, path: str, max_entries: int = 100_000, lock_lease: float = 60, lock_poll: float = 0.05,
+                 touch_batch: int = 256, touch_interval: float = 10):
+        self.path = path
+        self.max_entries = max_entries
+        self.lock_lease = lock_lease
+        self.lock_poll = lock_poll
+        self.touch_batch = touch_batch
+        self.touch_interval = touch_interval
+        self._local = threading.local()
+        self._puts = 0
+        # (namespace, key) -> last read time; written in one go instead of an UPDATE (a write lock) on every read
+        self._touched = {}
+        self._touch_lock = threading.Lock()
+        self._touched_at = time.monotonic()
+
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        db = self._db()
+        db.execute("PRAGMA journal_mode=WAL")
+        db.execute("CREATE TABLE IF NOT EXISTS entries (namespace TEXT, key TEXT, value TEXT, expires_at REAL, "
+                   "last_access REAL, PRIMARY KEY (namespace, key))")
+        db.execute("CREATE INDEX IF NOT EXISTS entries_lru ON entries (namespace, last_access)")
+        db.execute("CREATE TABLE IF NOT EXISTS locks (name TEXT PRIMARY KEY, owner TEXT, expires_at REAL)")
+
+    def _db(self):
+        # sqlite connections can't be shared between threads, so every thread of the pool gets its own
+        db = getattr(self._local, "db", None)
+        if db is None:
+            db = sqlite3.connect(self.path, isolation_level=None, timeout=5)
+            db.execute("PRAGMA synchronous=NORMAL")
+            self._local.db = db
+        return db
+
+    def _get(self, namespace: str, key: str):
+        now = time.time()
+        row = self._db().execute("SELECT value, expires_at FROM entries WHERE namespace = ? AND key = ?",
+                                 (namespace, key)).fetchone()
+        if row is None or row[1] < now:
+            return None
+        with self._touch_lock:
+            self._touched[(namespace, key)] = now
+        self._flush_touched()
+        return json.loads(row[0])
+
+    def _flush_touched(self, force: bool = False):
+        """Write the last access times of the reads since the last flush; the LRU order only has to be roughly right."""
+        with self._touch_lock:
+            due = len(self._touched) >= self.touch_batch or time.monotonic() - self._touched_at >= self.touch_interval
+            if not self._touched or not (force or due):
+                return
+            touched, self._touched = self._touched, {}
+            self._touched_at = time.monotonic()
+        db = self._db()
+        # one transaction for the whole batch; in autocommit mode every UPDATE would be a commit of its own
+        db.execute("BEGIN IMMEDIATE")
+        try:
+            db.executemany("UPDATE entries SET last_access = ? WHERE namespace = ? AND key = ?",
+                           [(at, namespace, key) for (namespace, key), at in touched.items()])
+            db.execute("COMMIT")
+        except BaseException:
+            db.execute("ROLLBACK")
+            raise
+
+    def _put(self, namespace: str, key: str, value, ttl: float):
+        now = time.time()
+        db = self._db()
+        db.execute("INSERT OR REPLACE INTO entries VALUES (?, ?, ?, ?, ?)",
+                   (namespace, key, json.dumps(value), now + ttl, now))
+        self._puts += 1
+        # evicting on every put would make every write scan the index; every 100 puts is plenty
+        if self._puts % 100 == 0:
+            self._flush_touched(force=True)
+            db.execute("DELETE FROM entries WHERE expires_at < ?", (now,))
+            count = db.execute("SELECT COUNT(*) FROM entries WHERE namespace = ?", (namespace,)).fetchone()[0]
+            if count > self.max_entries:
+                db.execute("DELETE FROM entries WHERE namespace = ? AND key IN (SELECT key FROM entries "
+                           "WHERE namespace = ? ORDER BY last_access LIMIT ?)",
+                           (namespace, namespace, count - self.max_entries))
+
+    def _try_lock(self, name: str, owner: str):
+        now = time.time()
+        db = self._db()
+        db.execute("BEGIN IMMEDIATE")
+        try:
+            # a lock whose lease ran out belonged to a worker that crashed or hung
+            db.execute("DELETE FROM locks WHERE name = ? AND expires_at < ?", (name, now))
+            acquired = db.execute("INSERT OR IGNORE INTO locks VALUES (?, ?, ?)",
+                                  (name, owner, now + self.lock_lease)).rowcount == 1
+            db.execute("COMMIT")
+        except BaseException:
+            db.execute("ROLLBACK")
+            raise
+        return acquired
+
+    def _lead(self, name: str, owner: str, lease: float):
+        now = time.time()
+        db = self._db()
+        db.execute("BEGIN IMMEDIATE")
+        try:
+            db.execute("DELETE FROM locks WHERE name = ? AND expires_at < ?", (name, now))
+            db.execute("INSERT OR IGNORE INTO locks VALUES (?, ?, ?)", (name, owner, now + lease))
+            held = db.execute("UPDATE locks SET expires_at = ? WHERE name = ? AND owner = ?",
+                              (now + lease, name, owner)).rowcount == 1
+            db.execute("COMMIT")
+        except BaseException:
+            db.execute("ROLLBACK")
+            raise
+        return held
+
+    def _unlock(self, name: str, owner: str):
+        self._db().execute("DELETE FROM locks WHERE name = ? AND owner = ?", (name, owner))
+
+    def _recent(self, namespace: str, limit: int):
+        self._flush_touched(force=True)
+        rows = self._db().execute("SELECT key, value FROM entries WHERE namespace = ? AND expires_at > ? "
+                                  "ORDER BY last_access DESC LIMIT ?", (namespace, time.time(), limit)).fetchall()
+        return [(key, json.loads(value)) for key, value in rows]
+
+    async def get(self, namespace: str, key: str):
+        return await asyncio.to_thread(self._get, namespace, key)
+
+    async def put(self, namespace: str, key: str, value, ttl: float):
+        await asyncio.to_thread(self._put, namespace, key, value, ttl)
+
+    async def recent(self, namespace: str, limit: int):
+        return await asyncio.to_thread(self._recent, namespace, limit)
+
+    async def lead(self, name: str, owner: str, lease: float):
+        return await asyncio.to_thread(self._lead, name, owner, lease)
+
+    @asynccontextmanager
+    async def lock(self, name: str):
+        owner = uuid.uuid4().hex
+        while not await asyncio.to_thread(self._try_lock, name, owner):
+            await asyncio.sleep(self.lock_poll)
+        try:
+            yield
+        finally:
+            await asyncio.to_thread(self._unlock, name, owner)
+
+
+class RedisStore(SharedStore):
+    """Same thing on Redis, for when the workers run on more than one machine. Size limits and eviction are left to
+    Redis itself (maxmemory + maxmemory-policy allkeys-lru)."""
+
+    def __init__(self, url: str, prefix: str = "enigma", lock_lease: float = 60, lock_poll: float = 0.05):
+        if aioredis is None:
+            raise ImportError("SHARED_CACHE=redis needs the redis package: pip install redis")
+        self.redis = aioredis.from_url(url)
+        self.prefix = prefix
+        self.lock_lease = lock_lease
+        self.lock_poll = lock_poll
+
+    async def get(self, namespace: str, key: str):
+        value = await self.redis.get(f"{self.prefix}:{namespace}:{key}")
+        return None if value is None else json.loads(value)
+
+    async def put(self, namespace: str, key: str, value, ttl: float):
+        await self.redis.set(f"{self.prefix}:{namespace}:{key}", json.dumps(value), ex=max(int(ttl), 1))
+
+    async def lead(self, name: str, owner: str, lease: float):
+        lease_key = f"{self.prefix}:lock:{name}"
+        return bool(await self.redis.eval(
+            "if redis.call('set', KEYS[1], ARGV[1], 'NX', 'PX', ARGV[2]) then return 1 end "
+            "if redis.call('get', KEYS[1]) == ARGV[1] then return redis.call('pexpire', KEYS[1], ARGV[2]) end "
+            "return 0", 1, lease_key, owner, int(lease * 1000)))
+
+    @asynccontextmanager
+    async def lock(self, name: str):
+        owner = uuid.uuid4().hex
+        lock_key = f"{self.prefix}:lock:{name}"
+        while not await self.redis.set(lock_key, owner, nx=True, px=int(self.lock_lease * 1000)):
+            await asyncio.sleep(self.lock_poll)
+        try:
+            yield
+        finally:
+            # only delete the lock if it is still ours (the lease may have run out in the meantime)
+            await self.redis.eval("if redis.call('get', KEYS[1]) == ARGV[1] then return redis.call('del', KEYS[1]) "
+                                  "end return 0", 1, lock_key, owner)
+
+
+class SharedSettings:
+    """Settings every worker process has to follow (API keys, the cache threshold), passed around through the store.
+
+    The worker that gets the change applies it and publishes it with a version; the others poll the store every
+    `poll` seconds and apply what is newer than what they have, with the handler registered for that setting.
+    Without a store (a single worker) publish does nothing.
+
+    A secret setting (an API key) is only kept in the store for `secret_ttl` seconds, long enough for the other
+    workers to take it, and a worker that starts keeps the secrets of its environment (.env) instead of taking the
+    ones that were sent to another worker before.
+    """
+
+    def __init__(self, store, poll: float = 2, secret_ttl: float = 60):
+        self.store = store
+        self.poll = poll
+        self.secret_ttl = secret_ttl
+        self._handlers = {}
+        self._secrets = set()
+        self._versions = {}
+        self.applied = 0
+
+    def on(self, name: str, handler, secret: bool = False):
+        self._handlers[name] = handler
+        if secret:
+            self._secrets.add(name)
+
+    async def publish(self, name: str, value):
+        version = time.time()
+        self._versions[name] = version
+        if self.store is not None:
+            # ten years for the others; a setting stays until it is replaced
+            ttl = self.secret_ttl if name in self._secrets else 10 * 365 * 86400
+            await self.store.put("settings", name, {"version": version, "value": value}, ttl)
+
+    async def sync(self, startup: bool = False):
+        for name, handler in self._handlers.items():
+            entry = await self.store.get("settings", name)
+            if entry is None or entry["version"] <= self._versions.get(name, 0):
+                continue
+            self._versions[name] = entry["version"]
+            if startup and name in self._secrets:
+                # the key of the environment wins over one that was sent to a worker before this one started
+                continue
+            await handler(entry["value"])
+            self.applied += 1
+
+    async def run(self):
+        if self.store is None:
+            return
+        while True:
+            try:
+                await self.sync()
+            except Exception as e:
+                print(f"syncing the settings failed: {e!r}")
+            await asyncio.sleep(self.poll)
+
+
+def open_store():
+    """Pick the shared store from SHARED_CACHE (sqlite / redis); returns None when it is off (the default)."""
+    kind = os.environ.get("SHARED_CACHE", "").lower()
+    if kind == "sqlite":
+        return SQLiteStore(os.environ.get("SHARED_CACHE_PATH", "data/cache.db"),
+                           max_entries=int(os.environ.get("SHARED_CACHE_MAX_ENTRIES", 100_000)))
+    if kind == "redis":
+        return RedisStore(os.environ.get("REDIS_URL", "redis://localhost:6379/0"))
+    return None
@@ -0,0 +1,117 @@
+import asyncio
+
+
+class SingleFlight:
+    """Coalesce concurrent calls with the same key into one shared task.
+
+    The first caller starts the work, everyone who asks for the same key while it is running awaits the same task
+    and gets the same result (or the same exception). A caller that gets cancelled (e.g. the client disconnected)
+    only stops waiting; the work is cancelled only when nobody is waiting for it anymore.
+
+    stream() does the same for an async generator (a streamed answer): one producer, and every caller gets all of
+    its items, from the first one on, however late it joined.
+    """
+
+    def __init__(self):
+        # key -> [task, number of callers waiting on it]
+        self._inflight = {}
+        # key -> _Broadcast
+        self._streams = {}
+        self.started = 0
+        self.coalesced = 0
+
+    async def do(self, key, func, *args, **kwargs):
+        entry = self._inflight.get(key)
+        if entry is None:
+            task = asyncio.create_task(func(*args, **kwargs))
+            task.add_done_callback(lambda t: self._done(key, t))
+            entry = self._inflight[key] = [task, 0]
+            self.started += 1
+        else:
+            self.coalesced += 1
+
+        task = entry[0]
+        entry[1] += 1
+        try:
+            # shield, so cancelling this caller does not cancel the shared task for the others
+            return await asyncio.shield(task)
+        except asyncio.CancelledError:
+            if not task.done() and entry[1] == 1:
+                task.cancel()
+            raise
+        finally:
+            entry[1] -= 1
+
+    async def stream(self, key, func, *args, **kwargs):
+        broadcast = self._streams.get(key)
+        if broadcast is None:
+            broadcast = self._streams[key] = _Broadcast(func(*args, **kwargs))
+            broadcast.task.add_done_callback(lambda t: self._stream_done(key, broadcast))
+            self.started += 1
+        else:
+            self.coalesced += 1
+
+        broadcast.subscribers += 1
+        try:
+            sent = 0
+            while True:
+                if sent < len(broadcast.items):
+                    sent += 1
+                    yield broadcast.items[sent - 1]
+                elif broadcast.finished:
+                    if broadcast.error is not None:
+                        raise broadcast.error
+                    return
+                else:
+                    await broadcast.changed.wait()
+        finally:
+            broadcast.subscribers -= 1
+            # the last one that leaves (disconnected, cancelled) stops the producer
+            if broadcast.subscribers == 0 and not broadcast.task.done():
+                broadcast.task.cancel()
+
+    def _stream_done(self, key, broadcast):
+        if self._streams.get(key) is broadcast:
+            del self._streams[key]
+
+    def _done(self, key, task: asyncio.Task):
+        if self._inflight.get(key, [None])[0] is task:
+            del self._inflight[key]
+        # mark the exception as retrieved in case every caller was gone before it finished
+        if not task.cancelled():
+            task.exception()
+
+    def stats(self):
+        return {
+            "in_flight": len(self._inflight) + len(self._streams),
+            "started": self.started,
+            "coalesced": self.coalesced,
+        }
+
+
+class _Broadcast:
+    """The items of one async generator, kept for every caller of SingleFlight.stream that reads them."""
+
+    def __init__(self, items):
+        self.items = []
+        self.finished = False
+        self.error = None
+        self.subscribers = 0
+        # replaced after every change; the readers wait on the one they saw
+        self.changed = asyncio.Event()
+        self.task = asyncio.create_task(self._pump(items))
+
+    def _notify(self):
+        changed, self.changed = self.changed, asyncio.Event()
+        changed.set()
+
+    async def _pump(self, items):
+        try:
+            async for item in items:
+                self.items.append(item)
+                self._notify()
+        except Exception as e:
+            self.error = e
+        finally:
+            self.finished = True
+            self._notify()
@@ -0,0 +1,5 @@
+import os
+import sys
+
+# the modules of the backend are imported flat (like uvicorn main:app does from this directory)
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
@@ -0,0 +1,88 @@
+import asyncio
+import pytest
+from admission import AdmissionController, Overloaded, priority
+
+
+async def hold(gate, level, order, release):
+    with priority(level):
+        async with gate.slot():
+            order.append(level)
+            await release.wait()
+
+
+def test_interactive_goes_before_batch():
+    async def run():
+        gate = AdmissionController("upstream", max_concurrency=1)
+        order, release = [], asyncio.Event()
+        first = asyncio.create_task(hold(gate, "batch", order, release))
+        await asyncio.sleep(0)
+        waiting = [asyncio.create_task(hold(gate, level, order, asyncio.Event()))
+                   for level in ("batch", "batch", "interactive")]
+        await asyncio.sleep(0.01)
+        release.set()
+        await first
+        await asyncio.sleep(0.01)
+        for task in waiting:
+            task.cancel()
+        await asyncio.gather(*waiting, return_exceptions=True)
+        return order
+
+    # the slot that freed up goes to the interactive request, even though it came last
+    assert asyncio.run(run()) == ["batch", "interactive"]
+
+
+def test_full_queue_is_rejected_with_429():
+    async def run():
+        gate = AdmissionController("upstream", max_concurrency=1, max_queue=1)
+        order, release = [], asyncio.Event()
+        tasks = [asyncio.create_task(hold(gate, "interactive", order, release)) for _ in range(2)]
+        await asyncio.sleep(0.01)
+        try:
+            with pytest.raises(Overloaded) as error:
+                await hold(gate, "interactive", order, release)
+            return error.value.status, gate.stats()
+        finally:
+            release.set()
+            await asyncio.gather(*tasks)
+
+    status, stats = asyncio.run(run())
+    assert status == 429
+    assert stats["rejected"] == 1 and stats["queued"] == 1
+
+
+def test_full_queue_evicts_a_batch_waiter_for_an_interactive_one():
+    async def run():
+        gate = AdmissionController("upstream", max_concurrency=1, max_queue=1)
+        order, release = [], asyncio.Event()
+        active = asyncio.create_task(hold(gate, "interactive", order, release))
+        batch = asyncio.create_task(hold(gate, "batch", order, release))
+        await asyncio.sleep(0.01)
+        interactive = asyncio.create_task(hold(gate, "interactive", order, release))
+        await asyncio.sleep(0.01)
+        release.set()
+        results = await asyncio.gather(active, batch, interactive, return_exceptions=True)
+        return results, order
+
+    results, order = asyncio.run(run())
+    assert isinstance(results[1], Overloaded) and results[1].status == 429
+    assert order == ["interactive", "interactive"]
+
+
+def test_waiting_too_long_is_rejected_with_503():
+    gate = AdmissionController("upstream", max_concurrency=1, max_wait=0.05)
+
+    async def run():
+        order, release = [], asyncio.Event()
+        active = asyncio.create_task(hold(gate, "interactive", order, release))
+        await asyncio.sleep(0)
+        try:
+            with pytest.raises(Overloaded) as error:
+                await hold(gate, "interactive", order, release)
+            return error.value.status
+        finally:
+            release.set()
+            await active
+
+    assert asyncio.run(run()) == 503
+    # the waiter that gave up left the queue and didn't take a slot
+    assert gate.stats()["queued"] == 0 and gate.stats()["active"] == 0
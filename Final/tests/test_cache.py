@@ -0,0 +1,101 @@
+import pytest
+from cache import SearchCache, SemanticCache, hash_embed, key_terms, normalize_query
+
+
+@pytest.mark.parametrize("a, b", [
+    ("Who is Dimebag Darrell?", "who is  dimebag darrell"),
+    ("what is the capital of France!", "What is the capital of France"),
+])
+def test_normalize_same_question(a, b):
+    assert normalize_query(a) == normalize_query(b)
+
+
+@pytest.mark.parametrize("a, b", [
+    ("what is C++", "what is C#"),
+    ("what is C++", "what is C"),
+    ("is -5 > 5?", "is 5 > -5?"),
+    ("/wiki/a-b", "/wiki/a/b"),
+])
+def test_normalize_keeps_symbols(a, b):
+    assert normalize_query(a) != normalize_query(b)
+
+
+def test_search_cache_does_not_mix_up_languages():
+    cache = SearchCache()
+    cache.put("what is C++", "c++ results")
+    assert cache.get("what is C#") is None
+    assert cache.get("What is C++?") == "c++ results"
+
+
+def make_semantic_cache():
+    cache = SemanticCache(sample_rate=0)
+    cache.put("what is the population of new york city", "about 8.3 million")
+    cache.put("who won the world cup in 2018", "france")
+    cache.put("best restaurants in paris", "a list")
+    cache.put("is -5 > 5", "no")
+    return cache
+
+
+@pytest.mark.parametrize("prompt, expected", [
+    ("What is the population of New York City?", "about 8.3 million"),
+    ("Who won the World Cup in 2018?", "france"),
+])
+def test_semantic_cache_hits_rephrased_prompts(prompt, expected):
+    assert make_semantic_cache().get(prompt) == expected
+
+
+def test_semantic_cache_hits_who_is_vs_who_was():
+    cache = SemanticCache(sample_rate=0)
+    cache.put("who is dimebag darrell", "guitarist of pantera")
+    assert cache.get("Who was Dimebag Darrell?") == "guitarist of pantera"
+
+
+@pytest.mark.parametrize("prompt", [
+    "what is the population of new york city in 1900",
+    "who won the world cup in 2022",
+    "worst restaurants in paris",
+    "is 5 > -5",
+    "what is the population of new york city today",
+])
+def test_semantic_cache_rejects_other_numbers_dates_and_qualifiers(prompt):
+    cache = make_semantic_cache()
+    assert cache.get(prompt) is None
+
+
+def test_semantic_cache_guard_holds_with_a_low_threshold():
+    # 0.931 similar: a hit on the similarity alone, turned away by the numbers
+    cache = SemanticCache(threshold=0.9, sample_rate=0)
+    cache.put("what is the population of new york city", "about 8.3 million")
+    assert cache.get("what is the population of new york city in 1900") is None
+    assert cache.stats()["rejected"] == 1
+    assert cache.stats()["hits"] == 0
+
+
+def test_key_terms():
+    assert key_terms("GDP of france in 2020 vs 2021, -3% before covid") == (
+        ("2020", "2021", "-3"), frozenset({"before"}))
+
+
+def test_hash_embed_is_deterministic_and_normalized():
+    a, b = hash_embed("who is dimebag darrell"), hash_embed("who is dimebag darrell")
+    assert (a == b).all()
+    assert abs(float(a @ a) - 1) < 1e-5
+
+
+def test_page_cache_keys_on_the_exact_url():
+    from pages import PageFetcher
+    cache = PageFetcher().cache
+    cache.put("https://example.com/Wiki/Page?id=A", "page a")
+    assert cache.get("https://example.com/Wiki/Page?id=A#history") == "page a"
+    assert cache.get("https://example.com/wiki/page?id=a") is None
+    assert cache.get("https://example.com/Wiki/Page?id=A.") is None
+
+
+def test_semantic_cache_keeps_variants_apart():
+    cache = SemanticCache(sample_rate=0)
+    cache.put("who is dimebag darrell", "single search answer")
+    assert cache.get("who is dimebag darrell", "fan_out") is None
+    cache.put("who is dimebag darrell", "fan-out answer", "fan_out")
+    assert cache.get("who is dimebag darrell", "fan_out") == "fan-out answer"
+    assert cache.get("who is dimebag darrell") == "single search answer"
+    assert cache.stats()["entries"] == 2
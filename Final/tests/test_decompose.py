@@ -0,0 +1,28 @@
+import pytest
+from nodes import decompose_query
+
+
+@pytest.mark.parametrize("query", [
+    "pros and cons of nuclear energy",
+    "history of rock and roll",
+    "what is the capital of france and germany",
+    "who is dimebag darrell",
+])
+def test_no_split(query):
+    assert decompose_query(query) == [query]
+
+
+@pytest.mark.parametrize("query, parts", [
+    ("difference between black and white tea", ["black tea", "white tea"]),
+    ("compare python and rust for web servers", ["python for web servers", "rust for web servers"]),
+    ("should i learn python vs rust", ["should i learn python", "should i learn rust"]),
+    ("who founded pantera and when did dimebag darrell die?", ["who founded pantera", "when did dimebag darrell die"]),
+    ("what is rock and roll and who invented it", ["what is rock and roll", "who invented it"]),
+])
+def test_split(query, parts):
+    assert decompose_query(query) == [query] + parts
+
+
+def test_max_subqueries():
+    query = "what is a, what is b, what is c, what is d and what is e"
+    assert decompose_query(query, max_subqueries=2) == [query, "what is a", "what is b"]
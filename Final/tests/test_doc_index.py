@@ -0,0 +1,43 @@
+import asyncio
+from doc_index import DocIndex
+
+
+def result(i: int):
+    # 10 chunks of 120 words each
+    return {"url": f"https://example.com/{i}", "title": f"page {i}",
+            "content": " ".join(f"word{i}x{j}" for j in range(1200))}
+
+
+def test_add_later_adds_and_compacts_in_the_background(tmp_path):
+    index = DocIndex(str(tmp_path), max_chunks=1500, max_pending=1000)
+
+    async def add_all():
+        for i in range(250):
+            index.add_later([result(i)])
+        # nothing was added on the caller's time
+        assert index.added == 0
+        await index.stop()
+
+    asyncio.run(add_all())
+    stats = index.stats()
+    assert stats["chunks"] == 1500 and stats["pending_adds"] == 0
+    assert stats["compactions"] >= 1 and not index.needs_compaction
+    # the newest results survive the eviction and the renumbering
+    assert index.search("word249x5", 1)[0]["url"] == "https://example.com/249"
+    index.db.close()
+
+    reopened = DocIndex(str(tmp_path), max_chunks=1500)
+    assert reopened.stats()["chunks"] == 1500
+    assert reopened.search("word249x5", 1)[0]["url"] == "https://example.com/249"
+
+
+def test_add_later_drops_when_too_many_are_waiting(tmp_path):
+    index = DocIndex(str(tmp_path), max_pending=2)
+
+    async def add_all():
+        for i in range(5):
+            index.add_later([result(i)])
+        await index.stop()
+
+    asyncio.run(add_all())
+    assert index.dropped == 3 and index.added == 20
@@ -0,0 +1,87 @@
+import asyncio
+import time
+import pytest
+from jobs import JobQueue, parse_jsonl
+
+
+async def answer(prompt, use_cache):
+    return f"answer to {prompt}"
+
+
+def make_queue(tmp_path, **kwargs):
+    return JobQueue(str(tmp_path / "jobs.db"), answer, **kwargs)
+
+
+def test_expired_lease_is_claimed_again(tmp_path):
+    crashed = make_queue(tmp_path, lease=0.05)
+    job_id = crashed._submit(["a"], True)
+    assert crashed._claim()[:2] == (job_id, 0)
+    # the lease is still running, nobody else gets the item
+    other = make_queue(tmp_path)
+    assert other._claim() is None
+
+    time.sleep(0.06)
+    claimed = other._claim()
+    assert claimed[:2] == (job_id, 0) and claimed[3] == 1
+    other._finish(job_id, 0, "late answer")
+    # the first worker comes back, but its lease is gone, so it doesn't overwrite the answer
+    crashed._finish(job_id, 0, "stale answer")
+    assert other._job(job_id)["done"] == 1
+    assert other._results(job_id, -1, 10)[0][3] == "late answer"
+
+
+def test_item_is_given_up_after_max_attempts(tmp_path):
+    queue = make_queue(tmp_path, lease=0.01, max_attempts=2)
+    job_id = queue._submit(["a"], True)
+    for _ in range(2):
+        assert queue._claim() is not None
+        time.sleep(0.02)
+    assert queue._claim() is None
+    job = queue._job(job_id)
+    assert job["status"] == "done" and job["failed"] == 1
+
+
+def test_failed_item_waits_for_its_backoff(tmp_path):
+    queue = make_queue(tmp_path, retry_backoff=0.05)
+    job_id = queue._submit(["a"], True)
+    queue._claim()
+    queue._release(job_id, 0, delay=0.05, error="boom")
+    assert queue._claim() is None
+    time.sleep(0.06)
+    assert queue._claim()[:2] == (job_id, 0)
+
+
+def test_released_items_are_claimed_right_away(tmp_path):
+    queue = make_queue(tmp_path)
+    queue._submit(["a", "b"], True)
+    queue._claim()
+    queue._release()
+    assert [queue._claim()[1] for _ in range(2)] == [0, 1]
+
+
+def test_cancelled_job_is_not_claimed(tmp_path):
+    queue = make_queue(tmp_path)
+    job_id = queue._submit(["a", "b"], True)
+    assert queue._cancel(job_id)
+    assert queue._claim() is None
+
+
+def test_workers_answer_a_job(tmp_path):
+    queue = make_queue(tmp_path, poll=0.01)
+
+    async def run():
+        queue.start()
+        job_id = await queue.submit([f"prompt {i}" for i in range(5)])
+        while (await queue.job(job_id))["status"] != "done":
+            await asyncio.sleep(0.01)
+        await queue.stop()
+        return [line async for line in queue.results(job_id, page=2)]
+
+    lines = asyncio.run(run())
+    assert len(lines) == 5 and '"answer to prompt 4"' in lines[-1]
+
+
+def test_parse_jsonl():
+    assert parse_jsonl(b'{"prompt": "a"}\n\n"b"\n') == ["a", "b"]
+    with pytest.raises(ValueError, match="line 2"):
+        parse_jsonl(b'"a"\n{"prompt": ""}\n')
@@ -0,0 +1,26 @@
+import asyncio
+import nodes
+from cache import SemanticCache
+
+
+def test_fan_out_answers_are_cached_apart(monkeypatch):
+    calls = []
+
+    async def compose_answer(query, use_cache=True, fan_out=False, read_pages=False):
+        calls.append(fan_out)
+        return {"answer": "fan-out answer" if fan_out else "single answer", "sources": ""}
+
+    monkeypatch.setattr(nodes, "compose_answer", compose_answer)
+    monkeypatch.setattr(nodes, "answer_cache", SemanticCache(sample_rate=0))
+    monkeypatch.setattr(nodes, "shared_store", None)
+
+    async def run():
+        return [await nodes.get_info("who is dimebag darrell", fan_out=fan_out) for fan_out in (False, True, True)]
+
+    assert asyncio.run(run()) == ["single answer", "fan-out answer", "fan-out answer"]
+    # the second fan-out request is the one that came from the cache
+    assert calls == [False, True]
+
+
+def test_shared_answer_keys_keep_the_fan_out():
+    assert nodes.answer_key("Who is Dimebag Darrell?") != nodes.answer_key("Who is Dimebag Darrell?", fan_out=True)
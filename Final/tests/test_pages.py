@@ -0,0 +1,90 @@
+import asyncio
+import httpx
+from pages import PageFetcher, TextExtractor, select_passages, split_passages
+
+PAGE = """<html><head><title>t</title><style>p {color: red}</style></head><body>
+<nav>home | about</nav>
+<h1>Dimebag Darrell</h1><p>Darrell Abbott was the guitarist of&nbsp;Pantera.</p>
+<script>var tracking = 1;</script>
+<p>He was born in 1966 in Texas.</p>
+<footer>copyright</footer></body></html>"""
+
+
+def extract(html: str, chunk: int = 7, max_chars: int = 100_000):
+    parser = TextExtractor(max_chars)
+    # the page comes in pieces while it downloads; tags can be cut in half
+    for i in range(0, len(html), chunk):
+        parser.feed(html[i:i + chunk])
+    return parser.text()
+
+
+def test_extractor_keeps_the_content_only():
+    assert extract(PAGE) == ("Dimebag Darrell\nDarrell Abbott was the guitarist of Pantera.\n"
+                             "He was born in 1966 in Texas.")
+
+
+def test_extractor_stops_at_max_chars():
+    text = extract("<p>" + "word " * 1000 + "</p>", max_chars=100)
+    assert 100 <= len(text) < 200
+
+
+def test_split_passages_keeps_paragraphs_together():
+    text = "one two three\nfour five\n" + " ".join(["long"] * 7)
+    assert split_passages(text, size=5) == ["one two three four five", "long long long long long", "long long"]
+
+
+def test_select_passages_picks_the_relevant_ones():
+    pages = [({"url": "https://a", "title": "A", "score": 0.9}, "pantera was a metal band from texas\ncooking pasta"),
+             ({"url": "https://b", "title": "B", "score": 0.5}, "dimebag darrell played guitar in pantera")]
+    passages = select_passages("who played guitar in pantera", pages, size=6)
+    assert [p["url"] for p in passages] == ["https://b", "https://a"]
+    assert passages[0]["title"] == "B" and "dimebag" in passages[0]["content"]
+    # no word of the question, never picked
+    assert all("pasta" not in p["content"] for p in passages)
+
+
+async def handler(request: httpx.Request):
+    if request.url.path == "/slow":
+        await asyncio.sleep(1)
+    if request.url.path == "/pdf":
+        return httpx.Response(200, content=b"%PDF", headers={"content-type": "application/pdf"})
+    if request.url.path == "/missing":
+        return httpx.Response(404)
+    return httpx.Response(200, text=PAGE, headers={"content-type": "text/html; charset=utf-8"})
+
+
+def make_fetcher(**kwargs):
+    fetcher = PageFetcher(**kwargs)
+    fetcher._client = httpx.AsyncClient(transport=httpx.MockTransport(handler))
+    return fetcher
+
+
+def fetch_all(fetcher, urls):
+    async def run():
+        try:
+            return await fetcher.fetch_all(urls)
+        finally:
+            await fetcher.close()
+
+    return asyncio.run(run())
+
+
+def test_fetch_all_reads_the_pages_and_reports_the_failures():
+    fetcher = make_fetcher()
+    texts, report = fetch_all(fetcher, ["http://pages/a", "http://pages/a", "http://pages/pdf", "http://pages/missing"])
+    assert list(texts) == ["http://pages/a"] and "Pantera" in texts["http://pages/a"]
+    assert report["pages"] == 3 and report["pages_read"] == 1 and report["pages_failed"] == 2
+    # the text is cached for the next question
+    assert fetcher.cache.get("http://pages/a#history") == texts["http://pages/a"]
+
+
+def test_slow_page_is_dropped_after_the_page_timeout():
+    texts, report = fetch_all(make_fetcher(page_timeout=0.1, total_timeout=2), ["http://pages/a", "http://pages/slow"])
+    assert list(texts) == ["http://pages/a"]
+    assert report["pages_dropped"] == 1 and report["fetch_ms"] < 500
+
+
+def test_pages_are_not_waited_for_after_the_total_timeout():
+    texts, report = fetch_all(make_fetcher(page_timeout=2, total_timeout=0.1), ["http://pages/a", "http://pages/slow"])
+    assert list(texts) == ["http://pages/a"]
+    assert report["pages_dropped"] == 1 and report["fetch_ms"] < 500
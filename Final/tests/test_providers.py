@@ -0,0 +1,60 @@
+import asyncio
+from langchain_core.messages import AIMessage, AIMessageChunk
+from providers import ProviderPool, Provider
+
+
+class Hanging:
+    async def ainvoke(self, messages, **kwargs):
+        await asyncio.sleep(60)
+
+    async def astream(self, messages, **kwargs):
+        await asyncio.sleep(60)
+        yield AIMessageChunk(content="late")
+
+
+class Answering:
+    async def ainvoke(self, messages, **kwargs):
+        return AIMessage(content="an answer that is long enough to pass the check")
+
+    async def astream(self, messages, **kwargs):
+        for word in ("an", " answer"):
+            yield AIMessageChunk(content=word)
+
+
+def make_pool():
+    # the hanging provider always goes first
+    hanging, answering = Provider("hanging", Hanging(), weight=1e9), Provider("answering", Answering(), weight=1e-9)
+    return ProviderPool([hanging, answering], timeout=0.1), hanging, answering
+
+
+def test_invoke_fails_over_after_the_provider_timeout():
+    pool, hanging, answering = make_pool()
+    response = asyncio.run(pool.ainvoke("q"))
+    assert response.content.startswith("an answer")
+    assert hanging.timeouts == 1 and hanging.errors == 1
+    assert answering.calls == 1 and answering.errors == 0
+
+
+def test_stream_fails_over_before_the_first_chunk():
+    pool, hanging, _ = make_pool()
+
+    async def collect():
+        return [chunk.content async for chunk in pool.astream("q")]
+
+    assert asyncio.run(collect()) == ["an", " answer"]
+    assert hanging.timeouts == 1
+
+
+def test_cancelled_call_is_not_an_error():
+    pool, hanging, _ = make_pool()
+
+    async def cancel():
+        task = asyncio.create_task(pool.ainvoke("q"))
+        await asyncio.sleep(0.01)
+        task.cancel()
+        await asyncio.gather(task, return_exceptions=True)
+
+    asyncio.run(cancel())
+    # counted, but not held against the provider
+    assert hanging.cancelled == 1
+    assert hanging.errors == 0 and hanging.error_rate == 0 and hanging.calls == 0
@@ -0,0 +1,33 @@
+import asyncio
+from refresher import HotQueryRefresher
+from shared_cache import SQLiteStore
+
+
+async def compute(prompt):
+    return f"answer to {prompt}"
+
+
+def test_live_answers_are_kept_with_a_shared_store(tmp_path):
+    refresher = HotQueryRefresher(compute, store=SQLiteStore(str(tmp_path / "shared.db")))
+    refresher.record("who is dimebag darrell")
+    refresher.store("Who is Dimebag Darrell?", "a guitarist")
+    assert refresher.get("who is dimebag darrell") == "a guitarist"
+
+
+def test_followers_take_the_answers_of_the_leader(tmp_path):
+    async def run():
+        store = SQLiteStore(str(tmp_path / "shared.db"))
+        leader = HotQueryRefresher(compute, store=store)
+        follower = HotQueryRefresher(compute, store=store)
+        await leader.elect()
+        await follower.elect()
+        assert leader.leader and not follower.leader
+
+        for refresher in (leader, follower):
+            refresher.record("hot question")
+        leader.schedule("hot question")
+        await asyncio.gather(*leader._tasks)
+        await follower.pull()
+        return follower.get("hot question")
+
+    assert asyncio.run(run()) == "answer to hot question"
@@ -0,0 +1,107 @@
+import asyncio
+import time
+import pytest
+from resilience import CircuitBreaker, CircuitOpenError, DeadlineExceeded, remaining, within_deadline
+
+
+def open_breaker(reset_timeout=0.05):
+    breaker = CircuitBreaker("upstream", failure_threshold=3, reset_timeout=reset_timeout)
+    for _ in range(3):
+        breaker.check()
+        breaker.record_failure()
+    return breaker
+
+
+def test_opens_after_the_threshold():
+    breaker = CircuitBreaker("upstream", failure_threshold=3)
+    for _ in range(2):
+        breaker.record_failure()
+    assert breaker.state == "closed"
+    breaker.check()
+    breaker.record_failure()
+    assert breaker.state == "open" and breaker.trips == 1
+    with pytest.raises(CircuitOpenError) as error:
+        breaker.check()
+    assert 0 < error.value.retry_after <= 30
+
+
+def test_success_resets_the_count():
+    breaker = CircuitBreaker("upstream", failure_threshold=3)
+    breaker.record_failure()
+    breaker.record_failure()
+    breaker.record_success()
+    breaker.record_failure()
+    assert breaker.state == "closed" and breaker.consecutive_failures == 1
+
+
+def test_half_open_lets_one_trial_through():
+    breaker = open_breaker()
+    time.sleep(0.06)
+    breaker.check()
+    assert breaker.state == "half_open"
+    # only the one trial, the others still get turned away
+    with pytest.raises(CircuitOpenError):
+        breaker.check()
+
+
+def test_successful_trial_closes():
+    breaker = open_breaker()
+    time.sleep(0.06)
+    breaker.check()
+    breaker.record_success()
+    assert breaker.state == "closed"
+    breaker.check()
+
+
+def test_failed_trial_opens_again():
+    breaker = open_breaker()
+    time.sleep(0.06)
+    breaker.check()
+    breaker.record_failure()
+    assert breaker.state == "open" and breaker.trips == 2
+    with pytest.raises(CircuitOpenError):
+        breaker.check()
+
+
+def test_released_trial_lets_the_next_call_try():
+    breaker = open_breaker()
+    time.sleep(0.06)
+    breaker.check()
+    breaker.release_trial()
+    breaker.check()
+    assert breaker.state == "half_open"
+
+
+async def endless_tokens(seen):
+    while True:
+        seen.append(remaining())
+        await asyncio.sleep(0.01)
+        yield "token"
+
+
+def test_stream_ends_at_the_deadline():
+    seen = []
+
+    async def run():
+        tokens = []
+        with pytest.raises(DeadlineExceeded):
+            async for token in within_deadline(endless_tokens(seen), 0.1):
+                tokens.append(token)
+        return tokens
+
+    tokens = asyncio.run(run())
+    assert 3 <= len(tokens) <= 10
+    # the upstream calls for the stream see the deadline too
+    assert all(left is not None and left <= 0.1 for left in seen)
+
+
+def test_stream_within_the_deadline_is_passed_through():
+    async def tokens():
+        for word in ("a", "b"):
+            yield word
+
+    async def run():
+        items = [item async for item in within_deadline(tokens(), 1)]
+        return items, remaining()
+
+    assert asyncio.run(run()) == (["a", "b"], None)
@@ -0,0 +1,45 @@
+import pytest
+from graph import classify
+
+
+@pytest.mark.parametrize("prompt", [
+    "hey",
+    "hi there!",
+    "thanks",
+    "thank you so much!",
+    "good morning",
+    "how are you?",
+    "hey, how are you doing",
+    "what is 17 * 23",
+    "2 + 2 =",
+    "(3+4)^2?",
+    "translate to french: the meeting is moved to thursday afternoon, please bring the slides",
+    'fix the grammar in "me and him goes to the store every days because we was hungry"',
+    "summarize this: the company sold 2 million units in 2019 and plans to open three more factories",
+])
+def test_direct(prompt):
+    assert classify(prompt) == "direct"
+
+
+@pytest.mark.parametrize("prompt", [
+    "hey who is dimebag darrell",
+    "hi, who won the 2024 election?",
+    "thanks, and what is the capital of peru?",
+    "2024",
+    "-5",
+    "write a summary of today's news about nvidia",
+    "summarize the latest news: anything about the nvidia earnings call would be good to know",
+    "translate the name of the current german chancellor",
+    "tell me about the weather in paris",
+])
+def test_search(prompt):
+    assert classify(prompt) == "search"
+
+
+@pytest.mark.parametrize("prompt", [
+    "compare black tea vs green tea",
+    "pros and cons of nuclear energy",
+    "history of rock and roll",
+])
+def test_deep(prompt):
+    assert classify(prompt) == "deep"
@@ -0,0 +1,52 @@
+import asyncio
+import time
+import pytest
+from shared_cache import SharedSettings, SharedStore, SQLiteStore
+
+
+def make_worker(store, applied):
+    async def apply(name, value):
+        applied[name] = value
+
+    settings = SharedSettings(store, secret_ttl=0.1)
+    settings.on("cache_threshold", lambda value: apply("cache_threshold", value))
+    settings.on("OPENAI_API_KEY", lambda value: apply("OPENAI_API_KEY", value), secret=True)
+    return settings
+
+
+def test_settings_reach_the_other_workers(tmp_path):
+    store = SQLiteStore(str(tmp_path / "shared.db"))
+    applied = {}
+    sender, other = make_worker(store, {}), make_worker(store, applied)
+
+    async def run():
+        await sender.publish("cache_threshold", 0.9)
+        await sender.publish("OPENAI_API_KEY", "sk-new")
+        await other.sync()
+
+    asyncio.run(run())
+    assert applied == {"cache_threshold": 0.9, "OPENAI_API_KEY": "sk-new"}
+
+
+def test_keys_expire_and_a_starting_worker_keeps_its_own(tmp_path):
+    store = SQLiteStore(str(tmp_path / "shared.db"))
+    starting, late = {}, {}
+
+    async def run():
+        await make_worker(store, {}).publish("OPENAI_API_KEY", "sk-test")
+        await make_worker(store, starting).sync(startup=True)
+        time.sleep(0.15)
+        await make_worker(store, late).sync()
+        return await store.get("settings", "OPENAI_API_KEY")
+
+    assert asyncio.run(run()) is None
+    assert starting == {} and late == {}
+
+
+def test_store_without_all_the_methods_cant_be_made():
+    class Incomplete(SharedStore):
+        async def get(self, namespace, key):
+            return None
+
+    with pytest.raises(TypeError):
+        Incomplete()
@@ -0,0 +1,145 @@
+import asyncio
+from singleflight import SingleFlight
+
+
+def test_concurrent_callers_share_one_call():
+    calls = []
+
+    async def work(value):
+        calls.append(value)
+        await asyncio.sleep(0.01)
+        return value * 2
+
+    async def run():
+        flight = SingleFlight()
+        return await asyncio.gather(*(flight.do("key", work, 21) for _ in range(5)))
+
+    assert asyncio.run(run()) == [42] * 5
+    assert calls == [21]
+
+
+def test_cancelled_caller_does_not_cancel_the_shared_work():
+    async def work():
+        await asyncio.sleep(0.05)
+        return "answer"
+
+    async def run():
+        flight = SingleFlight()
+        leaving = asyncio.create_task(flight.do("key", work))
+        staying = asyncio.create_task(flight.do("key", work))
+        await asyncio.sleep(0.01)
+        leaving.cancel()
+        await asyncio.gather(leaving, return_exceptions=True)
+        return leaving.cancelled(), await staying
+
+    assert asyncio.run(run()) == (True, "answer")
+
+
+def test_work_is_cancelled_when_the_last_caller_leaves():
+    cancelled = asyncio.Event()
+
+    async def work():
+        try:
+            await asyncio.sleep(60)
+        except asyncio.CancelledError:
+            cancelled.set()
+            raise
+
+    async def run():
+        flight = SingleFlight()
+        caller = asyncio.create_task(flight.do("key", work))
+        await asyncio.sleep(0.01)
+        caller.cancel()
+        await asyncio.wait_for(cancelled.wait(), 1)
+        await asyncio.sleep(0)
+        return flight.stats()["in_flight"]
+
+    assert asyncio.run(run()) == 0
+
+
+def test_errors_reach_every_waiter():
+    async def work():
+        await asyncio.sleep(0.01)
+        raise ValueError("upstream broke")
+
+    async def run():
+        flight = SingleFlight()
+        results = await asyncio.gather(*(flight.do("key", work) for _ in range(3)), return_exceptions=True)
+        # a failure isn't kept, the next call tries again
+        return results, flight.stats()["in_flight"]
+
+    results, in_flight = asyncio.run(run())
+    assert [type(r) for r in results] == [ValueError] * 3
+    assert all(str(r) == "upstream broke" for r in results)
+    assert in_flight == 0
+
+
+async def tokens(calls, words):
+    calls.append(words)
+    for word in words:
+        await asyncio.sleep(0.01)
+        yield word
+
+
+async def collect(events):
+    return [event async for event in events]
+
+
+def test_concurrent_streams_share_one_producer():
+    calls = []
+
+    async def run():
+        flight = SingleFlight()
+        first = asyncio.create_task(collect(flight.stream("key", tokens, calls, ["a", "b", "c"])))
+        await asyncio.sleep(0.015)
+        # joins after the first token, still gets all of them
+        second = asyncio.create_task(collect(flight.stream("key", tokens, calls, ["a", "b", "c"])))
+        return await first, await second, flight.stats()
+
+    first, second, stats = asyncio.run(run())
+    assert first == second == ["a", "b", "c"]
+    assert len(calls) == 1 and stats == {"in_flight": 0, "started": 1, "coalesced": 1}
+
+
+def test_stream_keeps_going_for_the_callers_that_stay():
+    calls = []
+
+    async def run():
+        flight = SingleFlight()
+        leaving = asyncio.create_task(collect(flight.stream("key", tokens, calls, ["a", "b", "c"])))
+        staying = asyncio.create_task(collect(flight.stream("key", tokens, calls, ["a", "b", "c"])))
+        await asyncio.sleep(0.015)
+        leaving.cancel()
+        await asyncio.gather(leaving, return_exceptions=True)
+        return await staying
+
+    assert asyncio.run(run()) == ["a", "b", "c"]
+
+
+def test_stream_errors_reach_every_caller():
+    async def failing():
+        yield "a"
+        await asyncio.sleep(0.01)
+        raise ValueError("upstream broke")
+
+    async def run():
+        flight = SingleFlight()
+        return await asyncio.gather(*(collect(flight.stream("key", failing)) for _ in range(2)),
+                                    return_exceptions=True)
+
+    assert [type(r) for r in asyncio.run(run())] == [ValueError] * 2
+
+
+def test_stream_stops_when_the_last_caller_leaves():
+    calls = []
+
+    async def run():
+        flight = SingleFlight()
+        caller = asyncio.create_task(collect(flight.stream("key", tokens, calls, ["a"] * 100)))
+        await asyncio.sleep(0.015)
+        caller.cancel()
+        await asyncio.gather(caller, return_exceptions=True)
+        await asyncio.sleep(0.01)
+        return flight.stats()["in_flight"]
+
+    assert asyncio.run(run()) == 0
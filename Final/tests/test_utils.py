@@ -0,0 +1,36 @@
+import asyncio
+from utils import as_completed
+
+
+def test_as_completed_yields_in_finishing_order():
+    async def answer(delay, value):
+        await asyncio.sleep(delay)
+        return value
+
+    async def run():
+        return [value async for value in as_completed([answer(0.03, "slow"), answer(0.01, "fast")])]
+
+    assert asyncio.run(run()) == ["fast", "slow"]
+
+
+def test_client_that_disconnects_cancels_the_rest():
+    cancelled = []
+
+    async def answer(i):
+        try:
+            await asyncio.sleep(0.01 if i == 0 else 60)
+        except asyncio.CancelledError:
+            cancelled.append(i)
+            raise
+        return i
+
+    async def run():
+        results = as_completed([answer(i) for i in range(4)])
+        first = await results.__anext__()
+        # the client is gone after the first line
+        await results.aclose()
+        return first
+
+    assert asyncio.run(run()) == 0
+    assert sorted(cancelled) == [1, 2, 3]
+
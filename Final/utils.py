@@ -1,4 +1,7 @@
 import os
+import asyncio
+import json
+import time
 from models import APIKeyModel
 from asyncio import run
 
@@ -10,6 +13,48 @@ async def setup_api_key(api_key: APIKeyModel):
     print(f"{api_key.name} has been set up. {full}")
 
 
+async def timed_events(events):
+    """Pass the events through, turn an error into an "error" event and add a final "done" event with the timings."""
+    start = time.perf_counter()
+    first_token = None
+    try:
+        async for event in events:
+            if first_token is None and event["event"] == "token":
+                first_token = time.perf_counter() - start
+            yield event
+    except Exception as e:
+        # the status code is already sent at this point, so errors travel as an event
+        yield {"event": "error", "data": str(e)}
+
+    # time to first token is what the user actually feels, total time is just for reference
+    timings = {
+        "ttft_ms": None if first_token is None else round(first_token * 1000, 1),
+        "total_ms": round((time.perf_counter() - start) * 1000, 1),
+    }
+    yield {"event": "done", "data": timings}
+
+
+async def ndjson_events(events):
+    """Turn an async generator of events into NDJSON lines, with the "done" event of timed_events at the end."""
+    async for event in timed_events(events):
+        yield json.dumps(event) + "\n"
+
+
+async def as_completed(coros):
+    """Run the coroutines concurrently and yield their results as they finish. The ones that are still running are
+    cancelled when the caller stops early (e.g. the client of a stream disconnected)."""
+    pending = {asyncio.create_task(coro) for coro in coros}
+    try:
+        while pending:
+            done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+            for task in done:
+                yield task.result()
+    finally:
+        for task in pending:
+            task.cancel()
+        await asyncio.gather(*pending, return_exceptions=True)
+
+
 if __name__ == "__main__":
     api_key = {
         "name": "VERY_COOL_API_KEY",